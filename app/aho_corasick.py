@@ -0,0 +1,81 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class _PurePythonAutomaton:
+    # Textbook Aho-Corasick: trie with failure links; each node's output
+    # includes the patterns of its dictionary-suffix chain.
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[str]] = [[]]
+        for pattern in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(pattern)
+
+        # Depth-one nodes fail to the root; deeper ones follow their parent's
+        # failure chain.
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def find(self, text: str) -> Set[str]:
+        goto, fail, out = self.goto, self.fail, self.out
+        found: Set[str] = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+class _PyAhoCorasickAutomaton:
+    def __init__(self, patterns: Iterable[str]):
+        self.automaton = ahocorasick.Automaton()
+        for pattern in patterns:
+            self.automaton.add_word(pattern, pattern)
+        self.automaton.make_automaton()
+
+    def find(self, text: str) -> Set[str]:
+        return {pattern for _, pattern in self.automaton.iter(text)}
+
+
+class PatternMatcher:
+    # Which of a fixed set of literal patterns occur in a text, in one pass
+    # over the text however many patterns there are. Uses pyahocorasick when
+    # installed, else a pure-Python automaton.
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = sorted({p for p in patterns if p})
+        if not self.patterns:
+            self._automaton = None
+        elif ahocorasick is not None:
+            self._automaton = _PyAhoCorasickAutomaton(self.patterns)
+        else:
+            self._automaton = _PurePythonAutomaton(self.patterns)
+
+    def find(self, text: str) -> Set[str]:
+        return self._automaton.find(text) if self._automaton is not None else set()
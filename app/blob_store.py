@@ -0,0 +1,70 @@
+import hashlib
+import mmap
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+BLOB_ROOT = Path(os.getenv("BLOB_ROOT", "blobs"))
+# sha256 hex is sharded as ab/cd/abcd... so no directory grows past 65k entries.
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_path(digest: str, root: Path = BLOB_ROOT) -> Path:
+    shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return root.joinpath(*shards, digest)
+
+
+def has_blob(digest: Optional[str], root: Path = BLOB_ROOT) -> bool:
+    return bool(digest) and blob_path(digest, root).exists()
+
+
+def put_blob(data: bytes, digest: Optional[str] = None, root: Path = BLOB_ROOT) -> str:
+    digest = digest or blob_hash(data)
+    path = blob_path(digest, root)
+    if path.exists():
+        return digest
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{digest}.{os.getpid()}.{id(data)}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    # Same content always lands on the same name, so a concurrent writer
+    # replacing it is harmless.
+    os.replace(tmp, path)
+    return digest
+
+
+@contextmanager
+def open_blob(digest: str, root: Path = BLOB_ROOT):
+    path = blob_path(digest, root)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        # Copy-on-write so the mapping is a writable buffer (pdfium needs one);
+        # nothing writes to it, so pages stay shared with the page cache.
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def read_blob(digest: str, root: Path = BLOB_ROOT) -> bytes:
+    with open_blob(digest, root) as mm:
+        return bytes(mm)
+
+
+def delete_blob(digest: str, root: Path = BLOB_ROOT) -> bool:
+    try:
+        blob_path(digest, root).unlink()
+        return True
+    except FileNotFoundError:
+        return False
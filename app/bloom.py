@@ -0,0 +1,80 @@
+import hashlib
+import math
+import re
+from pathlib import Path
+from typing import Iterable, List, Dict, Any, Optional
+
+
+BLOOM_FP_RATE = 0.01
+BLOOM_FILE = "bloom.bin"
+# Identifiers such as "INV-00123" or "amazon.com" are also indexed as their
+# alphanumeric pieces, so probes do not depend on surrounding punctuation.
+PIECE_PATTERN = re.compile(r"[a-z0-9]+")
+MIN_PIECE_LEN = 3
+
+
+class BloomFilter:
+    def __init__(self, num_bits: int, num_hashes: int, bits: Optional[bytearray] = None):
+        self.num_bits = max(8, num_bits)
+        self.num_hashes = max(1, num_hashes)
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, items: int, fp_rate: float = BLOOM_FP_RATE) -> "BloomFilter":
+        items = max(1, items)
+        num_bits = int(math.ceil(-items * math.log(fp_rate) / (math.log(2) ** 2)))
+        num_hashes = int(round(num_bits / items * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, token: str):
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, token: str):
+        for pos in self._positions(token):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, token: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(token))
+
+    def save(self, path: Path) -> Dict[str, Any]:
+        with open(path, "wb") as f:
+            f.write(self.bits)
+        return {"bits": self.num_bits, "hashes": self.num_hashes, "path": path.name}
+
+    @classmethod
+    def load(cls, batch_dir: Path, meta: Dict[str, Any]) -> "BloomFilter":
+        with open(batch_dir / meta.get("path", BLOOM_FILE), "rb") as f:
+            return cls(meta["bits"], meta["hashes"], bytearray(f.read()))
+
+
+def token_pieces(token: str) -> List[str]:
+    return [p for p in PIECE_PATTERN.findall(token.lower()) if len(p) >= MIN_PIECE_LEN]
+
+
+def build_bloom(tokenized: Iterable[List[str]], fp_rate: float = BLOOM_FP_RATE) -> BloomFilter:
+    # Covers the BM25 vocabulary plus the alphanumeric pieces of every token.
+    vocab = set()
+    for tokens in tokenized:
+        for tok in tokens:
+            vocab.add(tok)
+            vocab.update(token_pieces(tok))
+    bloom = BloomFilter.for_capacity(len(vocab), fp_rate)
+    for tok in vocab:
+        bloom.add(tok)
+    return bloom
+
+
+def bloom_may_contain(bloom: BloomFilter, identifier: str) -> bool:
+    # An identifier is possibly present if its whole lowercased form is a BM25
+    # token or all of its pieces are. False means certainly absent as a token.
+    ident = identifier.lower().strip()
+    if not ident:
+        return True
+    if ident in bloom:
+        return True
+    pieces = token_pieces(ident)
+    return bool(pieces) and all(p in bloom for p in pieces)
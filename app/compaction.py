@@ -0,0 +1,206 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from app.partitions import UNDATED_PARTITION, partition_key
+from app.rag_pipeline import INDEX_ROOT, has_exact_vectors, load_embeddings, save_json, write_batch
+from app.segment_store import chunk_email_key, load_chunks
+from app.segments import (
+    load_catalog, new_segment_id, purge_retired, replace_segments, segment_dir_name,
+)
+
+
+SMALL_SEGMENT_CHUNKS = 2000
+# Segments with at least this share of tombstoned chunks are rewritten.
+TOMBSTONE_REWRITE_RATIO = 0.2
+TARGET_SEGMENT_CHUNKS = 20000
+MAX_LIVE_SEGMENTS = 16
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "300"))
+
+_compaction_lock = threading.Lock()
+_compaction_thread: Optional[threading.Thread] = None
+_stop_event = threading.Event()
+
+
+def plan_compaction(catalog: Dict[str, Any], small_chunks: int = SMALL_SEGMENT_CHUNKS,
+                    target_chunks: int = TARGET_SEGMENT_CHUNKS,
+                    max_segments: int = MAX_LIVE_SEGMENTS) -> List[List[Dict[str, Any]]]:
+    # Small segments of the same date partition and accounts are merged in
+    # creation order into groups of up to `target_chunks`, so a segment never
+    # mixes mailboxes that were apart. When a partition holds more than
+    # `max_segments` live segments its smallest ones are pulled in too, so
+    # query fan-out stays bounded. Segments with many tombstones are
+    # rewritten on their own. Unpartitioned segments are left to
+    # repartition_segments.
+    by_partition: Dict[tuple, List[Dict[str, Any]]] = {}
+    for seg in catalog["segments"]:
+        if seg.get("partition"):
+            by_partition.setdefault((seg["partition"], tuple(seg.get("accounts", ()))), []).append(seg)
+
+    groups = []
+    for partition, segments in sorted(by_partition.items()):
+        by_size = sorted(segments, key=lambda s: s["chunks"])
+        candidates = [s for s in by_size if s["chunks"] < small_chunks]
+        excess = len(segments) - max_segments
+        if excess > 0 and len(candidates) <= excess:
+            candidates = by_size[:excess + 1]
+
+        current: List[Dict[str, Any]] = []
+        total = 0
+        for seg in sorted(candidates, key=lambda s: s.get("created", 0)):
+            if current and total + seg["chunks"] > target_chunks:
+                if len(current) > 1:
+                    groups.append(current)
+                current, total = [], 0
+            current.append(seg)
+            total += seg["chunks"]
+        if len(current) > 1:
+            groups.append(current)
+
+    grouped = {seg["id"] for group in groups for seg in group}
+    for seg in catalog["segments"]:
+        if seg["id"] not in grouped and seg.get("partition") and \
+                seg.get("deleted", 0) >= TOMBSTONE_REWRITE_RATIO * seg["chunks"] > 0:
+            groups.append([seg])
+    return groups
+
+
+def _live_chunks(group: List[Dict[str, Any]], catalog: Dict[str, Any], storage_root: Path):
+    # Chunks survive only while the registry still points their email at
+    # their segment; anything else was re-indexed elsewhere or deleted.
+    # Repeated copies of the same email's chunk are dropped as well.
+    registry = catalog["indexed"]["emails"]
+    seen_chunks = set()
+    dropped = 0
+    live = []
+    for seg in group:
+        batch_dir = storage_root / seg["dir"]
+        chunks = load_chunks(batch_dir, lazy=False)
+        vectors = load_embeddings(batch_dir)
+        for i, chunk in enumerate(chunks):
+            meta = chunk.get("metadata", {})
+            email_id = chunk_email_key(meta)
+            key = (email_id, meta.get("pdf_name"), chunk.get("page"), chunk.get("type"),
+                   meta.get("table_index"), meta.get("table_chunk"), chunk.get("content"))
+            if (email_id and registry.get(email_id) != seg["id"]) or key in seen_chunks:
+                dropped += 1
+                continue
+            seen_chunks.add(key)
+            live.append((chunk, vectors[i]))
+    return live, dropped
+
+
+def _write_rewritten(live: List[tuple], partition: Optional[str], old_ids: List[str],
+                     storage_root: Path) -> Dict[str, Any]:
+    new_id = new_segment_id()
+    chunks = [c for c, _ in live]
+    embeddings = np.vstack([v for _, v in live]).astype("float32")
+    manifest = write_batch(new_id, chunks, embeddings, storage_root=storage_root, partition=partition)
+    manifest["compacted_from"] = old_ids
+    save_json(manifest, storage_root / segment_dir_name(new_id) / "manifest.json")
+    return manifest
+
+
+def _swap(group: List[Dict[str, Any]], by_partition: Dict[Optional[str], List[tuple]],
+          storage_root: Path) -> List[Dict[str, Any]]:
+    old_ids = [seg["id"] for seg in group]
+    manifests = []
+    email_segments: Dict[str, str] = {}
+    for partition, live in sorted(by_partition.items(), key=lambda kv: kv[0] or ""):
+        manifest = _write_rewritten(live, partition, old_ids, storage_root)
+        manifests.append(manifest)
+        for chunk, _ in live:
+            email_id = chunk_email_key(chunk.get("metadata", {}))
+            if email_id:
+                email_segments[email_id] = manifest["segment_id"]
+
+    # With no live chunks left the old segments are simply retired.
+    if not replace_segments(storage_root, old_ids, manifests, email_segments):
+        for manifest in manifests:
+            shutil.rmtree(storage_root / segment_dir_name(manifest["segment_id"]), ignore_errors=True)
+        return []
+    return manifests
+
+
+def merge_segments(group: List[Dict[str, Any]], catalog: Dict[str, Any], storage_root: Path = INDEX_ROOT) -> Optional[Dict[str, Any]]:
+    live, dropped = _live_chunks(group, catalog, storage_root)
+    manifests = _swap(group, {group[0].get("partition"): live} if live else {}, storage_root)
+    if not manifests:
+        return None
+    print(f"Compacted {len(group)} segments ({sum(s['chunks'] for s in group)} chunks, {dropped} dropped) into {manifests[0]['segment_id']}")
+    return manifests[0]
+
+
+def repartition_segments(catalog: Dict[str, Any], storage_root: Path = INDEX_ROOT) -> List[Dict[str, Any]]:
+    # Rewrites segments written before date partitioning (or by hand) into one
+    # segment per partition of their chunks' email dates.
+    manifests = []
+    for seg in [s for s in catalog["segments"] if not s.get("partition")]:
+        live, dropped = _live_chunks([seg], catalog, storage_root)
+        by_partition: Dict[Optional[str], List[tuple]] = {}
+        dates: Dict[Any, str] = {}
+        for chunk, vec in live:
+            raw = chunk.get("metadata", {}).get("date")
+            if raw not in dates:
+                dates[raw] = partition_key(raw) if raw else UNDATED_PARTITION
+            by_partition.setdefault(dates[raw], []).append((chunk, vec))
+        written = _swap([seg], by_partition, storage_root)
+        if written:
+            print(f"Repartitioned segment {seg['id']} ({seg['chunks']} chunks, {dropped} dropped) into {sorted(by_partition)}")
+        manifests.extend(written)
+    return manifests
+
+
+def _rewritable(catalog: Dict[str, Any], storage_root: Path) -> Dict[str, Any]:
+    # Catalogue view without segments whose exact vectors are gone: rebuilding
+    # them from quantized codes would lose precision on every round.
+    return {**catalog, "segments": [seg for seg in catalog["segments"]
+                                    if has_exact_vectors(storage_root / seg["dir"])]}
+
+
+def compact_once(storage_root: Path = INDEX_ROOT) -> List[Dict[str, Any]]:
+    if not _compaction_lock.acquire(blocking=False):
+        return []
+    try:
+        manifests = repartition_segments(_rewritable(load_catalog(storage_root), storage_root), storage_root)
+        catalog = load_catalog(storage_root)
+        for group in plan_compaction(_rewritable(catalog, storage_root)):
+            manifest = merge_segments(group, catalog, storage_root)
+            if manifest:
+                manifests.append(manifest)
+        purge_retired(storage_root)
+        return manifests
+    finally:
+        _compaction_lock.release()
+
+
+def _compaction_loop(storage_root: Path, interval: float):
+    while not _stop_event.wait(interval):
+        try:
+            compact_once(storage_root)
+        except Exception as e:
+            print(f"Compaction failed: {e}")
+
+
+def start_background_compaction(storage_root: Path = INDEX_ROOT, interval: float = COMPACTION_INTERVAL):
+    global _compaction_thread
+    if interval <= 0 or (_compaction_thread and _compaction_thread.is_alive()):
+        return _compaction_thread
+    _stop_event.clear()
+    _compaction_thread = threading.Thread(target=_compaction_loop, args=(storage_root, interval),
+                                          name="segment-compaction", daemon=True)
+    _compaction_thread.start()
+    return _compaction_thread
+
+
+def stop_background_compaction():
+    _stop_event.set()
+
+
+if __name__ == "__main__":
+    for m in compact_once():
+        print(m)
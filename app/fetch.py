@@ -1,6 +1,7 @@
 # fetch.py
 from app.service import get_gmail_service, get_outlook_service
-from app.gmail_utils import fetch_recent_emails as fetch_gmail  # ← now takes service
+from app.gmail_utils import iter_recent_emails as iter_gmail  # ← now takes service
+from app.segments import account_message_ids
 
 def fetch_outlook(service, start_iso, end_iso):
     filt = f"receivedDateTime ge {start_iso} and receivedDateTime lt {end_iso}"
@@ -25,13 +26,19 @@ def fetch_outlook(service, start_iso, end_iso):
     return emails
 
 
-def fetch_all_selected(session_id: str, start_str: str, end_str: str, accounts: dict):
-    all_emails = []
+def iter_all_selected(session_id: str, start_str: str, end_str: str, accounts: dict, seen: dict = None,
+                      known_ids: set = None):
+    # `seen` maps account -> message ids already yielded; those and the
+    # account's messages among `known_ids` (indexed email keys) are skipped
+    # before their bodies and attachments are downloaded.
     for provider, emails in accounts.items():
         for email in emails:
+            account = f"{email} ({provider})"
+            known = account_message_ids(known_ids or (), account)
+            skip_ids = seen.setdefault(account, known) if seen is not None else known
             if provider == "gmail":
                 svc = get_gmail_service(session_id, email)  # ← from services.py
-                batch = fetch_gmail(svc, start_str, end_str)  # ← pass service
+                batch = iter_gmail(svc, start_str, end_str, skip_ids=skip_ids)  # ← pass service
             else:
                 svc = get_outlook_service(session_id, email)
                 start_iso = f"{start_str.replace('/', '-')}T00:00:00Z"
@@ -39,6 +46,22 @@ def fetch_all_selected(session_id: str, start_str: str, end_str: str, accounts:
                 batch = fetch_outlook(svc, start_iso, end_iso)
 
             for rec in batch:
-                rec["account"] = f"{email} ({provider})"
-            all_emails.extend(batch)
-    return all_emails
\ No newline at end of file
+                if rec["id"] in skip_ids:
+                    continue
+                rec["account"] = account
+                if seen is not None:
+                    skip_ids.add(rec["id"])
+                yield rec
+
+
+def fetch_all_selected(session_id: str, start_str: str, end_str: str, accounts: dict):
+    return list(iter_all_selected(session_id, start_str, end_str, accounts))
+
+
+def iter_emails_for_windows(session_id: str, windows: list, accounts: dict, known_ids: set = None):
+    # Transaction date windows overlap, so the same message would otherwise be
+    # fetched once per window. `known_ids` (already indexed messages) are never
+    # downloaded at all.
+    seen = {}
+    for start_str, end_str in windows:
+        yield from iter_all_selected(session_id, start_str, end_str, accounts, seen=seen, known_ids=known_ids)
\ No newline at end of file
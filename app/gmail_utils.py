@@ -1,19 +1,107 @@
-import base64, hashlib, os
+import base64, hashlib, os, re, threading, time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from bs4 import BeautifulSoup
-from datetime import datetime
+from app.blob_store import put_blob, blob_path, has_blob
+from datetime import datetime, timezone
 from dateutil import parser as date_parser
 import pandas as pd
 
 
+DATE_FORMATS = [
+    "%m/%d/%Y", "%Y-%m-%d", "%m-%d-%Y", "%d/%m/%Y", "%Y/%m/%d",
+    "%b %d, %Y", "%d %b %Y", "%m/%d/%y", "%d/%m/%y"
+]
+DATE_CACHE_SIZE = int(os.getenv("DATE_CACHE_SIZE", "65536"))
+# Fast paths only take strings they read exactly as dateutil would: RFC 2822
+# headers with a 4-digit year and a numeric or UTC zone (dateutil ignores
+# the offset when a comment names the local zone, so other comments go to
+# it), and plain ISO 8601.
+RFC2822_DATE = re.compile(r'(?:[A-Za-z]{3},\s*)?\d{1,2}\s+[A-Za-z]{3}\s+\d{4}\s+\d{1,2}:\d{2}(?::\d{2})?\s+'
+                          r'(?:[+-](?!0000)\d{4}|\+0000(?:\s+\((?:UTC|GMT)\))?|GMT|UTC|Z)')
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?(?:Z|[+-]\d{2}:\d{2})?)?')
+_TWO_DIGIT_YEAR_FORMATS = {f for f in DATE_FORMATS if "%y" in f}
+_FORMAT_DIRECTIVES = {"%m": r"\d{1,2}", "%d": r"\d{1,2}", "%Y": r"\d{4}", "%y": r"\d{2}", "%b": r"[A-Za-z]{3}"}
+# Shape of each format, checked before strptime (a failing strptime costs
+# about as much as dateutil itself).
+_FORMAT_SHAPES = [
+    (fmt, re.compile("".join(_FORMAT_DIRECTIVES.get(part) or re.escape(part)
+                             for part in re.split(r"(%[a-zA-Z])", fmt) if part)))
+    for fmt in DATE_FORMATS
+]
+
+_date_format_hits = Counter()
+_date_stats_lock = threading.Lock()
+
+
+def _dateutil_year(year: int) -> int:
+    # dateutil resolves two-digit years to within 50 years of today;
+    # strptime's %y pivots at 1969 instead.
+    this_year = time.localtime().tm_year
+    year = this_year // 100 * 100 + year % 100
+    if year >= this_year + 50:
+        year -= 100
+    elif year < this_year - 50:
+        year += 100
+    return year
+
+
+def _parse_date_uncached(text: str):
+    stripped = text.strip()
+    if RFC2822_DATE.fullmatch(stripped):
+        try:
+            return "rfc2822", parsedate_to_datetime(stripped)
+        except (TypeError, ValueError):
+            pass
+    if ISO_DATE.fullmatch(stripped):
+        try:
+            return "iso", datetime.fromisoformat(stripped.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+    for fmt, shape in _FORMAT_SHAPES:
+        if not shape.fullmatch(stripped):
+            continue
+        try:
+            dt = datetime.strptime(stripped, fmt)
+        except ValueError:
+            continue
+        if fmt in _TWO_DIGIT_YEAR_FORMATS:
+            try:
+                dt = dt.replace(year=_dateutil_year(dt.year))
+            except ValueError:
+                continue
+        return fmt, dt
+    try:
+        return "fuzzy", date_parser.parse(text, fuzzy=True)
+    except: return "unparsed", None
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date_string(text: str):
+    # Memoised: mail headers and statement columns repeat the same strings.
+    # datetimes are immutable, so cached results are safe to share.
+    how, dt = _parse_date_uncached(text)
+    with _date_stats_lock:
+        _date_format_hits[how] += 1
+    return dt
+
+
+def date_parse_stats():
+    info = _parse_date_string.cache_info()
+    with _date_stats_lock:
+        formats = dict(_date_format_hits)
+    return {"cache": {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize},
+            "formats": formats}
+
+
 def parse_date_dynamic(date_value):
     if isinstance(date_value, pd.Timestamp):
         return date_value.to_pydatetime()
     if isinstance(date_value, (int, float)):
         return datetime.fromtimestamp(date_value)
     if isinstance(date_value, str):
-        try:
-            return date_parser.parse(date_value, fuzzy=True)
-        except: return None
+        return _parse_date_string(date_value)
     return None
 
 def get_email_body(payload):
@@ -51,7 +139,7 @@ def get_email_body(payload):
     return "[No text content found]"
 
 
-def fetch_recent_emails(service, start_date, end_date):
+def iter_recent_emails(service, start_date, end_date, skip_ids=None):
     query = f"after:{start_date} before:{end_date}"
     print(f"\n🔍 Gmail Query → {query}")
 
@@ -59,10 +147,10 @@ def fetch_recent_emails(service, start_date, end_date):
     messages = results.get("messages", [])
     print(f"📬 Found {len(messages)} emails\n")
 
-    email_data = []
-
     for i,msg in enumerate(messages):
         msg_id = msg["id"]
+        if skip_ids and msg_id in skip_ids:
+            continue
         print(f"📩 EMAIL {i+1}/{len(messages)} MSG-ID: {msg_id}")
 
         msg_data = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
@@ -112,10 +200,11 @@ def fetch_recent_emails(service, start_date, end_date):
                     file_bytes = base64.urlsafe_b64decode(data)
                     filename = part.get("filename","unknown.pdf")
 
+                    digest = put_blob(file_bytes, hashlib.sha256(file_bytes).hexdigest())
                     info["attachments"].append({
                         "filename":filename,
-                        "bytes":file_bytes,
-                        "hash":hashlib.sha256(file_bytes).hexdigest()
+                        "hash":digest,
+                        "size":len(file_bytes)
                     })
 
                 except Exception as e:
@@ -124,15 +213,14 @@ def fetch_recent_emails(service, start_date, end_date):
         else:
             print("❌ No parts found → No attachments")
 
-        email_data.append(info)
+        yield info
 
     print(f"\n====== DONE FETCHING EMAILS ======")
-    return email_data
 
 
-import os
-SAVE_DIR = "downloaded_pdfs"
-os.makedirs(SAVE_DIR, exist_ok=True)
+def fetch_recent_emails(service, start_date, end_date):
+    return list(iter_recent_emails(service, start_date, end_date))
+
 
 def save_only_pdf_attachments(messages):
     saved_files = []
@@ -141,20 +229,19 @@ def save_only_pdf_attachments(messages):
         for att in msg.get("attachments", []):
 
             file_name = att.get("filename")
-            pdf_bytes = att.get("bytes")   
-
-            if not pdf_bytes:
-                print(f"⚠ No PDF data found for {file_name}")
-                continue
-
-            path = os.path.join(SAVE_DIR, file_name)
+            pdf_bytes = att.get("bytes")
+            digest = att.get("hash")
 
             try:
-                with open(path, "wb") as f:
-                    f.write(pdf_bytes)
+                if pdf_bytes:
+                    digest = put_blob(pdf_bytes, digest)
+                elif not has_blob(digest):
+                    print(f"⚠ No PDF data found for {file_name}")
+                    continue
 
+                path = str(blob_path(digest))
                 saved_files.append(path)
-                print(f"📥 SAVED → {path}")
+                print(f"📥 SAVED → {path} ({file_name})")
 
             except Exception as e:
                 print(f"❌ Failed saving {file_name}: {e}")
@@ -1,8 +1,10 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from time import time
 import numpy as np
 
-from app.rag_pipeline import INDEX_ROOT, csv_row_to_enhanced_query, format_results, global_search
+from app.rag_pipeline import INDEX_ROOT, ZONE_DATE_WINDOW_DAYS, csv_row_to_enhanced_query, embed_queries, format_results, global_search
+from app.partitions import partitions_for_window
+from app.segments import load_catalog, segment_dirs
 
 
 RAG_THRESHOLD = 0.5
@@ -14,23 +16,8 @@ def score_rag_transaction(txn: dict, rag_results: List[Dict[str, Any]], threshol
     digest = []
     exceptions = []
 
-    if not rag_results:
-        exceptions.append({
-            "TransactionID": txn_id,
-            "TransactionDate": txn.get("date"),
-            "Amount": txn.get("amount"),
-            "VendorName": txn.get("vendor_name"),
-            "Description": txn.get("description"),
-            "Source": best_match["location"].get("pdf_name", ""),
-            "Page": best_match["location"].get("page", ""),
-            "EmailLink": f"https://mail.google.com/mail/u/0/#inbox/{best_match['location'].get('email_id', '')}",
-            "EmailSender": best_match["location"].get("sender", ""),
-            "EmailDate": best_match["location"].get("date", ""),
-            "BaseScore": f"{best_score_percent:.2f}%",
-            "ContentPreview": best_match["content"][:300]
-        })
-        return digest, exceptions
-
+    # No candidates (every batch pruned) ends in the "No confident RAG match"
+    # row below.
     best_match = None
     best_score = 0.0
     
@@ -109,18 +96,24 @@ def score_rag_transaction(txn: dict, rag_results: List[Dict[str, Any]], threshol
     return digest, exceptions
 
 
-def hybrid_match_rag(transactions: List[Dict[str, Any]], emails: List[Dict[str, Any]], top_k_per_batch: int = 20, global_top_k: int = 3):
+def hybrid_match_rag(transactions: List[Dict[str, Any]], top_k_per_batch: int = 20, global_top_k: int = 3,
+                     accounts: Optional[List[str]] = None):
+    # `accounts` ("email (provider)") limits matching to those mailboxes; the
+    # index is shared by every connected account.
 
     all_digest = []
     all_exceptions = []
 
-    batch_dirs = sorted([p for p in INDEX_ROOT.iterdir() if p.is_dir()])
+    catalog = load_catalog(INDEX_ROOT)
+    queries = [csv_row_to_enhanced_query(txn) for txn in transactions]
+    # One encoder call for every query not already cached.
+    embed_queries([q["text_query"] for q in queries])
 
-    for txn in transactions:
-        query_info = csv_row_to_enhanced_query(txn)
-        print(query_info)
-        rag_results_raw = global_search(query_info, batch_dirs, top_k=global_top_k, top_k_per_batch=top_k_per_batch, rerank=True)
-        print(rag_results_raw)
+    for txn, query_info in zip(transactions, queries):
+        partitions = partitions_for_window(txn.get("date"), ZONE_DATE_WINDOW_DAYS)
+        batch_dirs = segment_dirs(INDEX_ROOT, catalog, partitions, accounts)
+        rag_results_raw = global_search(query_info, batch_dirs, top_k=global_top_k, top_k_per_batch=top_k_per_batch, rerank=True,
+                                        accounts=accounts)
         formatted_results = format_results(rag_results_raw)
 
         digest, exceptions = score_rag_transaction(txn, formatted_results)
@@ -0,0 +1,324 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+
+EMBED_MODEL = "all-MiniLM-L6-v2"
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# "torch" (fp32 PyTorch), "onnx" (ONNX Runtime fp32), "onnx-int8" (ONNX
+# Runtime with dynamic int8 quantization) or "openvino".
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+# Intra-op threads per model; 0 keeps the runtime's default (all cores).
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "0"))
+# Quantization target for onnx-int8: "avx2", "avx512", "avx512_vnni" or "arm64".
+ONNX_QUANT_CONFIG = os.getenv("ONNX_QUANT_CONFIG", "avx2")
+MODEL_CACHE_DIR = Path(os.getenv("MODEL_CACHE_DIR", "models"))
+BACKENDS = ("torch", "onnx", "onnx-int8", "openvino")
+
+# Embedding jobs of at least EMBED_POOL_MIN_CHUNKS texts (or ingest runs,
+# once they have embedded that many) are spread over a pool of worker
+# processes, each with its own model copy. The pool only lives while some
+# job or run holds it.
+EMBED_POOL_WORKERS = int(os.getenv("EMBED_POOL_WORKERS", str(os.cpu_count() or 1)))
+EMBED_POOL_MIN_CHUNKS = int(os.getenv("EMBED_POOL_MIN_CHUNKS", "2000"))
+# Padded tokens per encoder batch: 64 full-length (256 token) chunks, or
+# more of the short ones.
+EMBED_TOKEN_BUDGET = 64 * 256
+EMBED_MAX_TOKENS = 256
+EMBED_MIN_BATCH = 16
+EMBED_MAX_BATCH = 256
+CHARS_PER_TOKEN = 4
+
+_embedder = None
+_reranker = None
+_model_lock = threading.Lock()
+_embed_pool = None
+_embed_pool_lock = threading.Lock()
+_embed_pool_users = 0
+_worker_embedder = None
+
+
+def _runtime_kwargs(backend: str) -> Dict[str, Any]:
+    if not INFERENCE_THREADS:
+        return {}
+    if backend.startswith("onnx"):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = INFERENCE_THREADS
+        opts.inter_op_num_threads = 1
+        return {"session_options": opts}
+    if backend == "openvino":
+        return {"ov_config": {"INFERENCE_NUM_THREADS": str(INFERENCE_THREADS)}}
+    return {}
+
+
+def _quantized_onnx(cls, model_name: str) -> Path:
+    # Exports and quantizes once; later loads reuse the files on disk.
+    export_dir = MODEL_CACHE_DIR / f"{model_name.replace('/', '__')}-onnx"
+    file_name = f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+    if not (export_dir / file_name).exists():
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        print(f"Exporting {model_name} to ONNX ({ONNX_QUANT_CONFIG} int8) in {export_dir}")
+        model = cls(model_name, backend="onnx")
+        model.save_pretrained(str(export_dir))
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANT_CONFIG, str(export_dir),
+                                            file_suffix=f"qint8_{ONNX_QUANT_CONFIG}")
+    return export_dir
+
+
+def load_model(cls, model_name: str, backend: str = INFERENCE_BACKEND):
+    # sentence_transformers (and torch) are imported by the callers below on
+    # first use, not when the API starts.
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    if backend == "torch":
+        if INFERENCE_THREADS:
+            import torch
+            torch.set_num_threads(INFERENCE_THREADS)
+        return cls(model_name)
+    kwargs = _runtime_kwargs(backend)
+    if backend == "onnx-int8":
+        export_dir = _quantized_onnx(cls, model_name)
+        kwargs["file_name"] = f"onnx/model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+        return cls(str(export_dir), backend="onnx", model_kwargs=kwargs)
+    return cls(model_name, backend=backend, model_kwargs=kwargs)
+
+
+def load_embedder(backend: str = INFERENCE_BACKEND):
+    from sentence_transformers import SentenceTransformer
+    return load_model(SentenceTransformer, EMBED_MODEL, backend)
+
+
+def load_reranker(backend: str = INFERENCE_BACKEND):
+    from sentence_transformers import CrossEncoder
+    return load_model(CrossEncoder, RERANK_MODEL, backend)
+
+
+def get_embedder():
+    global _embedder
+    with _model_lock:
+        if _embedder is None:
+            _embedder = load_embedder()
+    return _embedder
+
+
+def get_reranker():
+    # One cross-encoder per process instead of one per search.
+    global _reranker
+    with _model_lock:
+        if _reranker is None:
+            _reranker = load_reranker()
+    return _reranker
+
+
+def models_loaded() -> Dict[str, bool]:
+    return {"embedder": _embedder is not None, "reranker": _reranker is not None}
+
+
+def length_sorted_batches(texts: List[str], token_budget: int = EMBED_TOKEN_BUDGET) -> List[List[int]]:
+    # Positions of `texts`, longest first, cut into batches whose padded size
+    # (count x longest member) stays within the budget; similar lengths pad
+    # little, and short texts get larger batches.
+    order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+    batches: List[List[int]] = []
+    current: List[int] = []
+    width = 0
+    for i in order:
+        if not current:
+            width = min(len(texts[i]) // CHARS_PER_TOKEN + 2, EMBED_MAX_TOKENS)
+        current.append(i)
+        size = len(current)
+        if size >= EMBED_MAX_BATCH or (size >= EMBED_MIN_BATCH and (size + 1) * width > token_budget):
+            batches.append(current)
+            current = []
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _init_embed_worker(backend: str, threads: int):
+    global _worker_embedder, INFERENCE_THREADS
+    INFERENCE_THREADS = threads
+    _worker_embedder = load_embedder(backend)
+
+
+def _embed_in_worker(texts: List[str]) -> np.ndarray:
+    return _worker_embedder.encode(texts, batch_size=len(texts), show_progress_bar=False,
+                                   convert_to_numpy=True, normalize_embeddings=True)
+
+
+def _start_embed_pool(workers: int):
+    # Spawned (not forked) so workers never inherit the API's threads; cores
+    # are split between workers to avoid oversubscription. Caller holds the lock.
+    global _embed_pool
+    if _embed_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        _embed_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                          initializer=_init_embed_worker, initargs=(INFERENCE_BACKEND, threads))
+    return _embed_pool
+
+
+def get_embed_pool(workers: int = EMBED_POOL_WORKERS):
+    with _embed_pool_lock:
+        return _start_embed_pool(workers)
+
+
+def _stop_embed_pool():
+    global _embed_pool
+    if _embed_pool is not None:
+        _embed_pool.shutdown()
+        _embed_pool = None
+
+
+def shutdown_embed_pool():
+    with _embed_pool_lock:
+        _stop_embed_pool()
+
+
+def acquire_embed_pool(workers: int = EMBED_POOL_WORKERS):
+    global _embed_pool_users
+    with _embed_pool_lock:
+        _embed_pool_users += 1
+        return _start_embed_pool(workers)
+
+
+def release_embed_pool():
+    # The last holder shuts the pool down, freeing its model copies.
+    global _embed_pool_users
+    with _embed_pool_lock:
+        _embed_pool_users = max(0, _embed_pool_users - 1)
+        if _embed_pool_users == 0:
+            _stop_embed_pool()
+
+
+class PooledEncoding:
+    # Texts submitted to the pool in length-sorted batches; result() gives
+    # the vectors in input order, the same as a single-process encode.
+    def __init__(self, pool, texts: List[str]):
+        self.size = len(texts)
+        self.batches = length_sorted_batches(texts)
+        self.futures = [pool.submit(_embed_in_worker, [texts[i] for i in batch]) for batch in self.batches]
+
+    def done(self) -> bool:
+        return all(f.done() for f in self.futures)
+
+    def result(self) -> np.ndarray:
+        out = None
+        for batch, future in zip(self.batches, self.futures):
+            emb = future.result()
+            if out is None:
+                out = np.empty((self.size, emb.shape[1]), dtype=np.float32)
+            out[batch] = emb
+        return out
+
+
+def encode_multi_process(texts: List[str], workers: int = EMBED_POOL_WORKERS) -> np.ndarray:
+    pool = acquire_embed_pool(workers)
+    try:
+        return PooledEncoding(pool, texts).result()
+    finally:
+        release_embed_pool()
+
+
+def _sample_texts(storage_root: Path, limit: int) -> List[str]:
+    from app.segment_store import load_chunks
+    from app.segments import load_catalog, segment_dirs
+
+    texts = []
+    for batch_dir in segment_dirs(storage_root, load_catalog(storage_root)):
+        for chunk in load_chunks(batch_dir):
+            texts.append(chunk["content"])
+            if len(texts) >= limit:
+                return texts
+    return texts
+
+
+def compare_on_texts(texts: List[str], backend: str, reference: str = "torch") -> Dict[str, Any]:
+    # Encodes and reranks `texts` with both backends; reports agreement with
+    # the reference and throughput.
+    from time import perf_counter
+
+    # Short leading spans of other texts stand in for transaction queries.
+    queries = [" ".join(t.split()[:8]) for t in texts[1::max(1, len(texts) // 50)]][:50]
+    pairs = [(q, t) for q in queries for t in texts[:20]]
+
+    report: Dict[str, Any] = {"chunks": len(texts), "pairs": len(pairs)}
+    outputs = {}
+    for name in (reference, backend):
+        embedder = load_embedder(name)
+        reranker = load_reranker(name)
+        embedder.encode(texts[:64], batch_size=64)
+        t0 = perf_counter()
+        emb = embedder.encode(texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+        embed_s = perf_counter() - t0
+        t0 = perf_counter()
+        scores = np.asarray(reranker.predict(pairs, batch_size=64), dtype=np.float64)
+        rerank_s = perf_counter() - t0
+        outputs[name] = (emb, scores)
+        report[name] = {"embed_chunks_per_s": len(texts) / embed_s, "rerank_pairs_per_s": len(pairs) / rerank_s}
+
+    ref_emb, ref_scores = outputs[reference]
+    emb, scores = outputs[backend]
+    cosine = np.sum(ref_emb * emb, axis=1)
+    ref_top = ref_scores.reshape(len(queries), -1).argmax(axis=1)
+    top = scores.reshape(len(queries), -1).argmax(axis=1)
+    report["embedding_cosine_min"] = float(cosine.min())
+    report["embedding_cosine_mean"] = float(cosine.mean())
+    report["rerank_max_abs_diff"] = float(np.abs(ref_scores - scores).max())
+    report["rerank_top1_agreement"] = float((ref_top == top).mean())
+    return report
+
+
+def compare_backends(backend: str, storage_root: Path = Path("storage"), limit: int = 2000,
+                     reference: str = "torch") -> Optional[Dict[str, Any]]:
+    # compare_on_texts over the indexed chunks.
+    texts = _sample_texts(storage_root, limit)
+    if not texts:
+        print(f"No chunks under {storage_root}")
+        return None
+    return compare_on_texts(texts, backend, reference)
+
+
+def benchmark_pool(storage_root: Path = Path("storage"), limit: int = 20000):
+    # Chunks/s of a single-process encode vs. the worker pool.
+    from time import perf_counter
+
+    texts = _sample_texts(storage_root, limit)
+    if not texts:
+        print(f"No chunks under {storage_root}")
+        return
+    model = load_embedder()
+    model.encode(texts[:64])
+    t0 = perf_counter()
+    single = model.encode(texts, batch_size=64, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
+    print(f"single process: {len(texts) / (perf_counter() - t0):.0f} chunks/s")
+    acquire_embed_pool()
+    try:
+        encode_multi_process(texts[:EMBED_POOL_WORKERS * EMBED_MIN_BATCH])
+        t0 = perf_counter()
+        pooled = encode_multi_process(texts)
+        print(f"{EMBED_POOL_WORKERS} workers: {len(texts) / (perf_counter() - t0):.0f} chunks/s, "
+              f"min cosine vs single {float(np.sum(single * pooled, axis=1).min()):.6f}")
+    finally:
+        release_embed_pool()
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "pool":
+        benchmark_pool(Path(sys.argv[2] if len(sys.argv) > 2 else "storage"))
+        sys.exit(0)
+
+    backend = sys.argv[1] if len(sys.argv) > 1 else "onnx-int8"
+    storage = Path(sys.argv[2] if len(sys.argv) > 2 else "storage")
+    report = compare_backends(backend, storage)
+    if report:
+        for key, value in report.items():
+            print(f"{key}: {value}")
@@ -0,0 +1,108 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+# A batch closes when it holds MICRO_BATCH_MAX_ITEMS items or the oldest
+# request has waited MICRO_BATCH_WAIT_MS, whichever comes first.
+MICRO_BATCH_MAX_ITEMS = int(os.getenv("MICRO_BATCH_MAX_ITEMS", "128"))
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "5"))
+# The wait only applies while more than one caller thread has submitted
+# within this window; a lone caller's batches run as soon as they arrive.
+MICRO_BATCH_ACTIVE_S = float(os.getenv("MICRO_BATCH_ACTIVE_S", "1"))
+
+
+class MicroBatcher:
+    # Queues model inputs from every caller thread and runs them through
+    # `fn` together on one worker thread; each caller gets a Future for the
+    # rows of the output that belong to its own inputs.
+    def __init__(self, fn: Callable[[List[Any]], Any], name: str,
+                 max_items: int = MICRO_BATCH_MAX_ITEMS, wait_ms: float = MICRO_BATCH_WAIT_MS):
+        self.fn = fn
+        self.name = name
+        self.max_items = max_items
+        self.wait_s = wait_ms / 1000
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._callers: Dict[int, float] = {}
+        self.requests = 0
+        self.batches = 0
+        self.items = 0
+        self.busy_s = 0.0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, items: Sequence[Any]) -> Future:
+        future: Future = Future()
+        self._ensure_started()
+        with self._lock:
+            self._callers[threading.get_ident()] = perf_counter()
+        self._queue.put((list(items), future))
+        return future
+
+    def __call__(self, items: Sequence[Any]):
+        return self.submit(items).result()
+
+    def _concurrent(self) -> bool:
+        cutoff = perf_counter() - MICRO_BATCH_ACTIVE_S
+        with self._lock:
+            for ident in [i for i, seen in self._callers.items() if seen < cutoff]:
+                del self._callers[ident]
+            return len(self._callers) > 1
+
+    def _collect(self) -> List[tuple]:
+        batch = [self._queue.get()]
+        total = len(batch[0][0])
+        wait = self.wait_s if self._concurrent() else 0.0
+        deadline = perf_counter() + wait
+        while total < self.max_items:
+            remaining = deadline - perf_counter()
+            try:
+                # Past the deadline, still take whatever is already queued.
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            total += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for request_items, _ in batch for item in request_items]
+            t0 = perf_counter()
+            try:
+                outputs = np.asarray(self.fn(items)) if items else None
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.busy_s += perf_counter() - t0
+            self.requests += len(batch)
+            self.batches += 1
+            self.items += len(items)
+            start = 0
+            for request_items, future in batch:
+                end = start + len(request_items)
+                future.set_result(outputs[start:end] if outputs is not None else np.zeros(0))
+                start = end
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_items": self.items / self.batches if self.batches else 0.0,
+            "busy_s": round(self.busy_s, 3),
+            "queued": self._queue.qsize(),
+        }
@@ -0,0 +1,363 @@
+import queue
+import threading
+from collections import deque
+from pathlib import Path
+from time import time, perf_counter
+from typing import List, Dict, Any, Iterable, Optional
+
+import numpy as np
+
+from app.inference import (EMBED_POOL_MIN_CHUNKS, EMBED_POOL_WORKERS, PooledEncoding, acquire_embed_pool,
+                           release_embed_pool)
+from app.partitions import email_partition
+from app.rag_pipeline import INDEX_ROOT, build_embeddings, email_to_chunks, write_batch
+from app.segment_store import scoped_key
+from app.segments import (
+    commit_segment, email_key, indexed_attachment_hashes, is_email_indexed, load_catalog, new_segment_id,
+)
+
+
+EXTRACT_WORKERS = 4
+QUEUE_SIZE = 32
+EMBED_MICRO_BATCH = 256
+EMBED_MAX_WAIT = 0.2
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.chunks = 0
+        self.busy_seconds = 0.0
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.started is None:
+                self.started = time()
+
+    def finish(self):
+        with self._lock:
+            self.finished = time()
+
+    def record(self, items: int, chunks: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.chunks += chunks
+            self.busy_seconds += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            end = self.finished or time()
+            wall = (end - self.started) if self.started else 0.0
+            return {
+                "items": self.items,
+                "chunks": self.chunks,
+                "busy_s": round(self.busy_seconds, 3),
+                "wall_s": round(wall, 3),
+                "items_per_s": round(self.items / wall, 2) if wall > 0 else 0.0,
+                "chunks_per_s": round(self.chunks / wall, 2) if wall > 0 else 0.0,
+            }
+
+
+class IngestPipeline:
+    # fetch -> extract (N workers) -> embed (micro-batches) -> write (segments of
+    # `batch_size` emails), each stage on its own thread(s) with bounded queues
+    # in between so a slow stage throttles the ones feeding it. Emails and
+    # attachments already in the segment catalogue are skipped. The writer
+    # buffers per date partition and account, and every written segment is
+    # published to the catalogue on its own. Once a run has embedded EMBED_POOL_MIN_CHUNKS
+    # chunks, its micro-batches go to the embedding process pool, up to one
+    # per worker in flight; the pool is released when the run ends.
+
+    def __init__(self, batch_size: int = 100, storage_root: Path = INDEX_ROOT,
+                 extract_workers: int = EXTRACT_WORKERS, queue_size: int = QUEUE_SIZE,
+                 embed_batch: int = EMBED_MICRO_BATCH):
+        self.batch_size = batch_size
+        self.storage_root = storage_root
+        self.extract_workers = extract_workers
+        self.embed_batch = embed_batch
+        self.catalog = load_catalog(storage_root)
+        self.known_hashes = indexed_attachment_hashes(self.catalog)
+        self._hash_lock = threading.Lock()
+
+        self.emails_q: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.chunks_q: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.embedded_q: queue.Queue = queue.Queue(maxsize=queue_size)
+
+        self.stages = {name: StageStats(name) for name in ("fetch", "extract", "embed", "write")}
+        self.skipped = 0
+        self.manifests: List[Dict[str, Any]] = []
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._embedded_chunks = 0
+        self._pool = None
+        self._inflight: deque = deque()
+        self._last_drain = 0.0
+
+    def _put(self, q: queue.Queue, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue, timeout: Optional[float] = None):
+        deadline = perf_counter() + timeout if timeout is not None else None
+        while not self._stop.is_set():
+            wait = 0.1 if deadline is None else min(0.1, max(0.0, deadline - perf_counter()))
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and perf_counter() >= deadline:
+                    raise
+        raise queue.Empty
+
+    def _fail(self, exc: BaseException):
+        if self._error is None:
+            self._error = exc
+        self._stop.set()
+
+    def _fetch_stage(self, email_iter: Iterable[Dict[str, Any]]):
+        stats = self.stages["fetch"]
+        try:
+            it = iter(email_iter)
+            seen = set()
+            while True:
+                t0 = perf_counter()
+                try:
+                    email = next(it)
+                except StopIteration:
+                    break
+                stats.record(1, 0, perf_counter() - t0)
+                key = email_key(email)
+                if is_email_indexed(email, self.catalog) or (key and key in seen):
+                    self.skipped += 1
+                    continue
+                seen.add(key)
+                self._put(self.emails_q, email)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.extract_workers):
+                self._put(self.emails_q, _DONE)
+            stats.finish()
+
+    def _extract_stage(self):
+        stats = self.stages["extract"]
+        try:
+            while True:
+                email = self._get(self.emails_q)
+                if email is _DONE:
+                    break
+                t0 = perf_counter()
+                skip, claimed = self._claim_attachments(email)
+                chunks = email_to_chunks(email, skip)
+                claimed = self._settle_claims(claimed, chunks)
+                stats.record(1, len(chunks), perf_counter() - t0)
+                account = email.get("account")
+                carried = [scoped_key(account, a["hash"]) for a in email.get("attachments", []) if a.get("hash")]
+                self._put(self.chunks_q, (email_key(email), email_partition(email), account, claimed, carried, chunks))
+        except queue.Empty:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(self.chunks_q, _DONE)
+            stats.finish()
+
+    def _claim_attachments(self, email: Dict[str, Any]):
+        # The first email to reach an attachment hash extracts it; later copies
+        # (already indexed, or being extracted by another email) are skipped.
+        # Hashes are claimed per account.
+        skip, claimed = set(), []
+        with self._hash_lock:
+            for att in email.get("attachments", []):
+                digest = scoped_key(email.get("account"), att.get("hash"))
+                if not digest or digest in claimed:
+                    continue
+                if digest in self.known_hashes:
+                    skip.add(digest)
+                else:
+                    self.known_hashes.add(digest)
+                    claimed.append(digest)
+        return skip, claimed
+
+    def _settle_claims(self, claimed: List[str], chunks: List[Dict[str, Any]]) -> List[str]:
+        # Only attachments that produced chunks are recorded as indexed; the
+        # claim on one that failed to extract (or had no text) is released,
+        # so a later copy or run tries it again.
+        produced = {scoped_key(c["metadata"].get("account"), c["metadata"].get("attachment_hash"))
+                    for c in chunks if "metadata" in c}
+        failed = [d for d in claimed if d not in produced]
+        if failed:
+            with self._hash_lock:
+                self.known_hashes.difference_update(failed)
+        return [d for d in claimed if d in produced]
+
+    def _emit(self, pending: List[tuple], embeddings: Optional[np.ndarray]):
+        offset = 0
+        for email_id, partition, account, hashes, carried, chunks in pending:
+            emb = embeddings[offset:offset + len(chunks)] if chunks else None
+            offset += len(chunks)
+            self._put(self.embedded_q, (email_id, partition, account, hashes, carried, chunks, emb))
+
+    def _embed_pending(self, pending: List[tuple]):
+        stats = self.stages["embed"]
+        flat = [c for *_, chunks in pending for c in chunks]
+        use_pool = EMBED_POOL_WORKERS > 1 and self._embedded_chunks >= EMBED_POOL_MIN_CHUNKS
+        self._embedded_chunks += len(flat)
+        if use_pool and flat:
+            if self._pool is None:
+                self._pool = acquire_embed_pool()
+            encoding = PooledEncoding(self._pool, [c["content"] for c in flat])
+            self._inflight.append((pending, len(flat), encoding, perf_counter()))
+            while len(self._inflight) > EMBED_POOL_WORKERS or (self._inflight and self._inflight[0][2].done()):
+                self._drain_one()
+            return
+
+        # Earlier pooled batches go out first so emails keep their order.
+        self._drain()
+        t0 = perf_counter()
+        embeddings = build_embeddings(flat) if flat else None
+        stats.record(len(pending), len(flat), perf_counter() - t0)
+        self._emit(pending, embeddings)
+
+    def _drain_one(self):
+        pending, count, encoding, submitted = self._inflight.popleft()
+        embeddings = encoding.result()
+        # Batches overlap in the pool; count each stretch of waiting once.
+        now = perf_counter()
+        self.stages["embed"].record(len(pending), count, now - max(submitted, self._last_drain))
+        self._last_drain = now
+        self._emit(pending, embeddings)
+
+    def _drain(self):
+        while self._inflight and not self._stop.is_set():
+            self._drain_one()
+
+    def _embed_stage(self):
+        stats = self.stages["embed"]
+        remaining = self.extract_workers
+        pending: List[tuple] = []
+        pending_chunks = 0
+        try:
+            while remaining:
+                try:
+                    waiting = pending or self._inflight
+                    item = self._get(self.chunks_q, timeout=EMBED_MAX_WAIT if waiting else None)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        break
+                    if pending:
+                        self._embed_pending(pending)
+                    self._drain()
+                    pending, pending_chunks = [], 0
+                    continue
+
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                pending.append(item)
+                pending_chunks += len(item[-1])
+                if pending_chunks >= self.embed_batch:
+                    self._embed_pending(pending)
+                    pending, pending_chunks = [], 0
+
+            if pending and not self._stop.is_set():
+                self._embed_pending(pending)
+            self._drain()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(self.embedded_q, _DONE)
+            stats.finish()
+
+    def _write(self, partition: str, batch: Dict[str, list]):
+        stats = self.stages["write"]
+        t0 = perf_counter()
+        emb = np.vstack(batch["embeddings"]) if batch["embeddings"] else None
+        manifest = write_batch(new_segment_id(), batch["chunks"], emb, storage_root=self.storage_root,
+                               partition=partition)
+        commit_segment(self.storage_root, manifest, batch["emails"], batch["hashes"], batch["refs"])
+        self.manifests.append(manifest)
+        stats.record(len(batch["emails"]), len(batch["chunks"]), perf_counter() - t0)
+
+    def _write_stage(self):
+        stats = self.stages["write"]
+        buffers: Dict[tuple, Dict[str, list]] = {}
+        try:
+            while True:
+                item = self._get(self.embedded_q)
+                if item is _DONE:
+                    break
+                email_id, partition, account, hashes, carried, chunks, emb = item
+                # One account per segment, so searches scoped to an account
+                # skip everyone else's segments outright.
+                key = (partition, account or "")
+                batch = buffers.setdefault(key, {"chunks": [], "embeddings": [], "emails": [], "hashes": [],
+                                                 "refs": {}})
+                batch["chunks"].extend(chunks)
+                if emb is not None:
+                    batch["embeddings"].append(emb)
+                batch["emails"].append(email_id)
+                batch["hashes"].extend(hashes)
+                if carried:
+                    batch["refs"][email_id] = carried
+                if len(batch["emails"]) >= self.batch_size:
+                    self._write(partition, buffers.pop(key))
+
+            for key in sorted(buffers):
+                self._write(key[0], buffers[key])
+        except queue.Empty:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            stats.finish()
+
+    def run(self, email_iter: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        threads = [threading.Thread(target=self._fetch_stage, args=(email_iter,), name="ingest-fetch", daemon=True)]
+        threads += [threading.Thread(target=self._extract_stage, name=f"ingest-extract-{i}", daemon=True)
+                    for i in range(self.extract_workers)]
+        threads.append(threading.Thread(target=self._embed_stage, name="ingest-embed", daemon=True))
+        threads.append(threading.Thread(target=self._write_stage, name="ingest-write", daemon=True))
+
+        for stage in self.stages.values():
+            stage.start()
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+        finally:
+            if self._pool is not None:
+                self._pool = None
+                release_embed_pool()
+
+        if self._error is not None:
+            raise self._error
+        return self.manifests
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stages": {name: s.snapshot() for name, s in self.stages.items()},
+            "queues": {
+                "emails": self.emails_q.qsize(),
+                "chunks": self.chunks_q.qsize(),
+                "embedded": self.embedded_q.qsize(),
+            },
+            "batches": len(self.manifests),
+            "skipped_indexed": self.skipped,
+        }
+
+
+def ingest_stream(email_iter: Iterable[Dict[str, Any]], batch_size: int = 100,
+                  storage_root: Path = INDEX_ROOT) -> List[Dict[str, Any]]:
+    pipeline = IngestPipeline(batch_size=batch_size, storage_root=storage_root)
+    return pipeline.run(email_iter)
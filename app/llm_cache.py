@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from time import time
+from typing import Any, Dict, Iterable, Optional
+
+
+# Where Gemini responses are kept across runs; empty disables the cache.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "storage/llm_cache.sqlite3")
+# Entries older than this are never served (default 30 days).
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", str(30 * 86400)))
+# Least recently used entries beyond this are dropped.
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+# Expired and surplus entries are pruned once every this many writes.
+LLM_CACHE_PRUNE_EVERY = 500
+# Hits only note their access time in memory; the notes are written in one
+# go with the next put or prune, or once this many are waiting.
+LLM_CACHE_TOUCH_FLUSH = 256
+
+
+def cache_key(model_name: str, prompt: str) -> str:
+    # The prompt is built deterministically from the transaction, email or
+    # CSV columns, so it is their canonical form; editing a prompt template
+    # changes every key and old answers stop being served.
+    payload = json.dumps([model_name, prompt], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    # SQLite table of (model, prompt) hash -> raw response text, shared by
+    # every thread. Only responses the caller could parse are stored. A
+    # response derived from an email records its account and message id, so
+    # disconnecting the account purges it.
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_s: float = LLM_CACHE_TTL_S,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._touched: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # Opened on first use, not at import.
+        if self._conn is None and self.path:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, "
+                         "created_at REAL NOT NULL, accessed_at REAL NOT NULL, account TEXT, email_id TEXT)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(responses)")}
+            if "account" not in columns:
+                # Older caches have no owners, so their email answers could
+                # never be purged; start those over.
+                conn.execute("DELETE FROM responses")
+                conn.execute("ALTER TABLE responses ADD COLUMN account TEXT")
+                conn.execute("ALTER TABLE responses ADD COLUMN email_id TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_account ON responses (account)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_email ON responses (email_id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, model_name: str, prompt: str) -> Optional[str]:
+        key = cache_key(model_name, prompt)
+        now = time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                if conn is None:
+                    return None
+                row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                if now - row[1] > self.ttl_s:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    conn.commit()
+                    self.expired += 1
+                    self.misses += 1
+                    return None
+                self._touched[key] = now
+                if len(self._touched) >= LLM_CACHE_TOUCH_FLUSH:
+                    self._flush_touched(conn)
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(f"LLM cache read failed: {e}")
+                return None
+            self.hits += 1
+            return row[0]
+
+    def _flush_touched(self, conn: sqlite3.Connection):
+        if self._touched:
+            conn.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                             [(at, key) for key, at in self._touched.items()])
+            self._touched.clear()
+
+    def put(self, model_name: str, prompt: str, response: str, account: Optional[str] = None,
+            email_id: Optional[str] = None):
+        key = cache_key(model_name, prompt)
+        now = time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                if conn is None:
+                    return
+                self._flush_touched(conn)
+                conn.execute("INSERT OR REPLACE INTO responses "
+                             "(key, model, response, created_at, accessed_at, account, email_id) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, model_name, response, now, now, account, email_id))
+                self._writes += 1
+                if self._writes % LLM_CACHE_PRUNE_EVERY == 0:
+                    self._prune(conn, now)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"LLM cache write failed: {e}")
+
+    def _prune(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_s,))
+        conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                     "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def prune(self):
+        with self._lock:
+            conn = self._connect()
+            if conn is not None:
+                self._flush_touched(conn)
+                self._prune(conn, time())
+                conn.commit()
+
+    def purge(self, account: Optional[str] = None, email_ids: Iterable[str] = ()) -> int:
+        # Drops every response derived from `account` or the given messages;
+        # returns how many went.
+        ids = [e for e in email_ids if e]
+        removed = 0
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return 0
+            if account:
+                removed += conn.execute("DELETE FROM responses WHERE account = ?", (account,)).rowcount
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                removed += conn.execute(f"DELETE FROM responses WHERE email_id IN ({','.join('?' * len(part))})",
+                                        part).rowcount
+            conn.commit()
+        return removed
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            if conn is not None:
+                conn.execute("DELETE FROM responses")
+                conn.commit()
+            self._touched.clear()
+            self.hits = self.misses = self.expired = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._flush_touched(self._conn)
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    print(f"LLM cache write failed: {e}")
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        entries = 0
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+LLM_CACHE = LLMResponseCache()
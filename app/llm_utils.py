@@ -2,21 +2,47 @@ import os
 import json
 import re
 import logging
+import threading
 from time import time
-import google.generativeai as genai
+from typing import Tuple
 from dotenv import load_dotenv
+from app.llm_cache import LLM_CACHE
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+SCORE_MODEL = 'gemini-2.0-flash'
+
+_genai = None
+_genai_lock = threading.Lock()
+
+
+def get_genai():
+    # google.generativeai is imported and configured on first use rather
+    # than when the API starts.
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+            _genai = genai
+    return _genai
+
+
+def generate_cached(model_name: str, prompt: str) -> Tuple[str, bool]:
+    # (response text, served from cache). Callers store the response with
+    # LLM_CACHE.put only once they have parsed it, so a malformed answer is
+    # asked again next time.
+    cached = LLM_CACHE.get(model_name, prompt)
+    if cached is not None:
+        return cached, True
+    response = get_genai().GenerativeModel(model_name).generate_content(prompt)
+    return response.text.strip(), False
 
 
 def score_match_with_gemini(transaction: dict, email_content: dict) -> dict:
     start_time = time()
     
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    
     attachments_text = ', '.join([a.get('filename', '') for a in email_content.get('attachments', [])])
     body_preview = email_content.get('body', 'N/A')[:2000]
     
@@ -55,13 +81,15 @@ RESPONSE FORMAT (JSON only, no markdown):
 }}"""
 
     try:
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
+        response_text, cached = generate_cached(SCORE_MODEL, prompt)
         
         if response_text.startswith("```json"):
             response_text = response_text.replace("```json", "").replace("```", "").strip()
         
         json_match = json.loads(response_text)
+        if not cached:
+            LLM_CACHE.put(SCORE_MODEL, prompt, response_text, account=email_content.get("account"),
+                          email_id=email_content.get("id"))
         
         result = {
             "score": int(json_match.get("score", 0)),
@@ -71,7 +99,7 @@ RESPONSE FORMAT (JSON only, no markdown):
         }
         
         elapsed = time() - start_time
-        logger.debug(f"Gemini API call successful ({elapsed:.2f}s) - Score: {result['score']}")
+        logger.debug(f"Gemini {'cache hit' if cached else 'API call successful'} ({elapsed:.2f}s) - Score: {result['score']}")
         
         return result
     
@@ -1,22 +1,37 @@
 import base64
+import os
+import threading
+from collections import OrderedDict
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
-import pandas as pd
 from io import BytesIO
 from datetime import datetime
 from typing import List, Dict
 from fastapi.middleware.cors import CORSMiddleware
 from app.auth import create_session, get_oauth_url, exchange_code
-from app.fetch import fetch_all_selected
-from app.gmail_utils import save_only_pdf_attachments
-from app.helper import hybrid_match_rag
-from app.semantic_parsing import parser
-from app.transaction_cleaner import clean_transactions
-from app.matching_engine import hybrid_match
-from app.rag_pipeline import INDEX_ROOT, csv_row_to_enhanced_query, format_results, global_search, ingest_all_emails
+from app.segments import INDEX_ROOT, delete_account
+from app import startup
+
+# The matching pipeline (pandas, torch, faiss, PDF/OCR and Gemini clients) is
+# imported by the endpoints that use it, so the auth endpoints serve as soon
+# as the worker boots.
 
 app = FastAPI(title="Financial Analyst API", version="1.0")
 
+# Stage stats of each session's most recent ingest run. Sessions never
+# expire, so only the INGEST_STATS_MAX_SESSIONS that ingested last are kept.
+INGEST_STATS_MAX_SESSIONS = int(os.getenv("INGEST_STATS_MAX_SESSIONS", "1000"))
+INGEST_STATS: "OrderedDict[str, Dict]" = OrderedDict()
+_ingest_stats_lock = threading.Lock()
+
+
+def record_ingest_stats(session_id: str, stats: Dict):
+    with _ingest_stats_lock:
+        INGEST_STATS[session_id] = stats
+        INGEST_STATS.move_to_end(session_id)
+        while len(INGEST_STATS) > INGEST_STATS_MAX_SESSIONS:
+            INGEST_STATS.popitem(last=False)
+
 origins = [
     "http://localhost:5173", 
 ]
@@ -31,6 +46,16 @@ app.add_middleware(
 
 
 
+@app.on_event("startup")
+def start_index_maintenance():
+    startup.start_index_maintenance()
+
+
+@app.on_event("shutdown")
+def stop_index_maintenance():
+    startup.stop_index_maintenance()
+
+
 @app.post("/session")
 def create_new_session():
     return {"session_id": create_session()}
@@ -90,21 +115,62 @@ def list_accounts(session_id: str = Header(alias="X-Session-ID")):
 def disconnect_account(account: str, session_id: str = Header(alias="X-Session-ID")):
     from app.auth import get_session
     session = get_session(session_id)
-    email, prov = account.rsplit(" (", 1)
+    try:
+        email, prov = account.rsplit(" (", 1)
+    except ValueError:
+        raise HTTPException(400, "Invalid account format")
     prov = prov.rstrip(")")
-    if prov in session and email in session[prov]:
-        del session[prov][email]
-        if not session[prov]:
-            del session[prov]
-    return {"status": "disconnected"}
+    # Only an account connected to this session may be removed from the
+    # shared index.
+    if prov not in session or email not in session[prov]:
+        raise HTTPException(404, "Account not connected to this session")
+    del session[prov][email]
+    if not session[prov]:
+        del session[prov]
+    # The session's last account is gone, and its ingest stats with it.
+    if not session:
+        with _ingest_stats_lock:
+            INGEST_STATS.pop(session_id, None)
+    removed = delete_account(INDEX_ROOT, account)
+    # Cached Gemini answers quote the account's emails, so they go as well.
+    from app.llm_cache import LLM_CACHE
+    removed["llm_cache"] = LLM_CACHE.purge(account=account)
+    return {"status": "disconnected", "removed": removed}
+
+
+@app.get("/stats")
+def get_stats(session_id: str = Header(alias="X-Session-ID")):
+    from app.auth import get_session
+    from app.gmail_utils import date_parse_stats
+    from app.llm_cache import LLM_CACHE
+    get_session(session_id)
+    from app.inference import models_loaded
+    from app.rag_pipeline import QUERY_EMBEDDINGS, QUERY_ENCODER, RERANKER
+    return {
+        "ingest": INGEST_STATS.get(session_id, {}),
+        "query_embeddings": QUERY_EMBEDDINGS.stats(),
+        "inference": {"query_embed": QUERY_ENCODER.stats(), "rerank": RERANKER.stats(), "loaded": models_loaded()},
+        "date_parsing": date_parse_stats(),
+        "llm_cache": LLM_CACHE.stats(),
+    }
 
 
+# Plain def: FastAPI runs it on its threadpool, so concurrent uploads keep
+# the event loop free and reach the micro-batchers together.
 @app.post("/process")
-async def process_csv(
+def process_csv(
     file: UploadFile = File(...),
     accounts: List[str] = Form(...),
     session_id: str = Header(alias="X-Session-ID")
 ):
+    import pandas as pd
+    from app.auth import get_session
+    from app.fetch import iter_emails_for_windows
+    from app.helper import hybrid_match_rag
+    from app.ingest_pipeline import IngestPipeline
+    from app.semantic_parsing import parser
+    from app.transaction_cleaner import clean_transactions
+
     if not accounts:
         raise HTTPException(400, "No accounts selected")
 
@@ -122,30 +188,40 @@ async def process_csv(
                 print(f"Invalid account format: {part} → {e}")
                 continue
 
-    content = await file.read()
+    # Matching is scoped to the selected mailboxes, so each must be connected
+    # to this session.
+    session = get_session(session_id)
+    for provider, emails in selected.items():
+        if any(email not in session.get(provider, {}) for email in emails):
+            raise HTTPException(404, "Account not connected to this session")
+    scope = [f"{email} ({provider})" for provider, emails in selected.items() for email in emails]
+
+    content = file.file.read()
     results = parser.parse_csv(BytesIO(content))
     transactions = clean_transactions(results)
 
 
-    all_emails = []
+    windows = []
 
     for txn in transactions:
         txn_date = pd.to_datetime(txn["date"], errors="coerce")
         start = (txn_date - pd.Timedelta(days=4)).strftime("%Y/%m/%d")
         end   = (txn_date + pd.Timedelta(days=4)).strftime("%Y/%m/%d")
 
-        emails = fetch_all_selected(session_id, start, end, selected)
-        all_emails.extend(emails)
+        if (start, end) not in windows:
+            windows.append((start, end))
 
-    manifests = ingest_all_emails(all_emails, batch_size=100)
-    print(manifests)
+    pipeline = IngestPipeline(batch_size=100)
+    known_ids = set(pipeline.catalog["indexed"]["emails"])
+    pipeline.run(iter_emails_for_windows(session_id, windows, selected, known_ids=known_ids))
+    record_ingest_stats(session_id, pipeline.stats())
 
 
     digest, exceptions = hybrid_match_rag(
         transactions=transactions,
-        emails=all_emails,    
         top_k_per_batch=20,
-        global_top_k=3
+        global_top_k=3,
+        accounts=scope
     )
 
 
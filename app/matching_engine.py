@@ -1,8 +1,14 @@
+import os
 import re
 import logging
-from datetime import datetime, timezone
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from time import time
+import numpy as np
 import pandas as pd
+from app.aho_corasick import PatternMatcher
 from app.gmail_utils import parse_date_dynamic
 from app.llm_utils import score_match_with_gemini
 
@@ -44,20 +50,225 @@ def extract_amounts(text: str) -> list:
     return amounts
 
 
-def filter_emails(txn: dict, emails: list, date_window: int = 3, min_matches: int = 1) -> list:
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROS_PER_DAY = 86_400_000_000
+AMOUNT_EXACT_TOLERANCE = 0.01
+AMOUNT_CLOSE_TOLERANCE = 5
+# Tokens of the uppercased searchable text. Any substring query's ASCII
+# alphanumeric runs lie inside such tokens, so the token index always
+# returns a superset of the emails containing the query.
+TOKEN_PATTERN = re.compile(r'[A-Z0-9]+')
+# "index" looks each transaction's vendor/description/invoice strings up in
+# the token index; "automaton" scans every email once per statement for all
+# of them together (see EmailFeatures.scan_patterns).
+TEXT_MATCH_MODE = os.getenv("TEXT_MATCH_MODE", "index")
+# Gemini calls in flight at once, across every transaction being matched.
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+# Gemini calls one transaction keeps in flight, taken in rank order.
+GEMINI_WINDOW = int(os.getenv("GEMINI_WINDOW", "2"))
+# Transactions matched at once by hybrid_match.
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", "8"))
+
+_gemini_pool = None
+_match_pool = None
+_pool_lock = threading.Lock()
+
+
+class EmailFeatures:
+    # Everything Stage 1 needs from an email, computed once per run instead
+    # of once per transaction, plus indexes so a transaction only visits
+    # emails that can score: sender domain -> rows, emails sorted by date,
+    # amounts sorted by value, and token -> rows over the searchable text.
+    # Dates are UTC microseconds since the epoch; amounts are one flat array
+    # in text order with the owning email of each.
+    def __init__(self, emails: list):
+        self.emails = emails
+        self.searchable = []
+        self.domain_rows = {}
+        dates = []
+        dated = []
+        amounts = []
+        counts = []
+        postings = {}
+        for row, email in enumerate(emails):
+            email_from = str(email.get("from", "")).lower()
+            searchable = (f"{email_from} {normalize_text(email.get('subject', ''))} "
+                          f"{normalize_text(email.get('body', ''))} {normalize_text(email.get('snippet', ''))}")
+            self.searchable.append(searchable)
+            self.domain_rows.setdefault(extract_domain(email_from), []).append(row)
+            email_date = make_aware(parse_date_dynamic(email.get("date")))
+            dated.append(email_date is not None)
+            dates.append((email_date - EPOCH) // timedelta(microseconds=1) if email_date is not None else 0)
+            found = extract_amounts(searchable)
+            amounts.extend(found)
+            counts.append(len(found))
+            for token in set(TOKEN_PATTERN.findall(searchable.upper())):
+                postings.setdefault(token, []).append(row)
+        self.searchable_upper = [t.upper() for t in self.searchable]
+
+        self.date_us = np.array(dates, dtype=np.int64)
+        self.has_date = np.array(dated, dtype=bool)
+        dated_rows = np.flatnonzero(self.has_date)
+        order = np.argsort(self.date_us[dated_rows], kind="stable")
+        self.date_sorted_rows = dated_rows[order]
+        self.date_sorted_us = self.date_us[self.date_sorted_rows]
+
+        self.amounts = np.array(amounts, dtype=np.float64)
+        self.amount_owner = np.repeat(np.arange(len(emails), dtype=np.int64), counts)
+        self.amount_order = np.argsort(self.amounts, kind="stable")
+        self.amount_sorted = self.amounts[self.amount_order]
+
+        # Vocabulary as one newline-separated string, so a substring scan of
+        # the vocabulary is a handful of str.find calls.
+        self.vocab = sorted(postings)
+        self.postings = [np.array(postings[t], dtype=np.int64) for t in self.vocab]
+        self.vocab_text = "\n" + "\n".join(self.vocab) + "\n"
+        self.vocab_starts = np.cumsum([0] + [len(t) + 1 for t in self.vocab[:-1]]) + 1 if self.vocab else np.zeros(0, dtype=np.int64)
+        self._query_rows = {}
+        self._scanned = {}
+
+    def __len__(self) -> int:
+        return len(self.emails)
+
+    def rows_with_domain(self, domain: str) -> list:
+        return self.domain_rows.get(domain, [])
+
+    def _rows_with_piece(self, piece: str) -> np.ndarray:
+        # Rows with a token containing `piece`.
+        hits = []
+        pos = self.vocab_text.find(piece)
+        while pos >= 0:
+            t = int(np.searchsorted(self.vocab_starts, pos, side="right")) - 1
+            hits.append(self.postings[t])
+            # Skip to the next token; one hit per token is enough.
+            pos = self.vocab_text.find(piece, int(self.vocab_starts[t]) + len(self.vocab[t]) + 1)
+        return np.unique(np.concatenate(hits)) if hits else np.zeros(0, dtype=np.int64)
+
+    def candidate_rows(self, query: str):
+        # Superset of the rows whose text contains `query` (None when the
+        # query has no alphanumeric run and every row is a candidate).
+        key = query.upper()
+        if key not in self._query_rows:
+            rows = None
+            for piece in sorted(set(TOKEN_PATTERN.findall(key)), key=len, reverse=True):
+                found = self._rows_with_piece(piece)
+                rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+                if len(rows) == 0:
+                    break
+            self._query_rows[key] = rows
+        return self._query_rows[key]
+
+    def scan_patterns(self, patterns: list, upper_patterns: list):
+        # Finds every pattern (in the searchable text) and upper pattern (in
+        # its uppercase) with one automaton pass per text; rows_containing
+        # then answers those queries from the result.
+        for texts, wanted, upper in ((self.searchable, patterns, False), (self.searchable_upper, upper_patterns, True)):
+            matcher = PatternMatcher(wanted)
+            rows = {p: [] for p in matcher.patterns}
+            if matcher.patterns:
+                for row, text in enumerate(texts):
+                    for pattern in matcher.find(text):
+                        rows[pattern].append(row)
+            for pattern, found in rows.items():
+                self._scanned[(pattern, upper)] = found
+
+    def rows_containing(self, query: str, upper: bool = False) -> list:
+        # Rows whose searchable text (or its uppercase) contains `query`.
+        if (query, upper) in self._scanned:
+            return self._scanned[(query, upper)]
+        texts = self.searchable_upper if upper else self.searchable
+        rows = self.candidate_rows(query)
+        rows = range(len(texts)) if rows is None else rows.tolist()
+        return [i for i in rows if query in texts[i]]
+
+    def first_close_amount(self, txn_amount: float):
+        # Per email, the first amount within AMOUNT_CLOSE_TOLERANCE of the
+        # transaction (the one the scalar loop would stop at): email rows,
+        # those amounts, and whether each is also an exact match. The sorted
+        # range is widened a little and re-checked exactly.
+        slack = AMOUNT_CLOSE_TOLERANCE + 1e-6
+        lo = np.searchsorted(self.amount_sorted, txn_amount - slack, side="left")
+        hi = np.searchsorted(self.amount_sorted, txn_amount + slack, side="right")
+        positions = np.sort(self.amount_order[lo:hi])
+        diff = np.abs(self.amounts[positions] - txn_amount)
+        positions, diff = positions[diff <= AMOUNT_CLOSE_TOLERANCE], diff[diff <= AMOUNT_CLOSE_TOLERANCE]
+        rows, first = np.unique(self.amount_owner[positions], return_index=True)
+        return rows, self.amounts[positions[first]], diff[first] <= AMOUNT_EXACT_TOLERANCE
+
+    def rows_near_date(self, txn_date: datetime, date_window: int):
+        # Rows whose abs(timedelta.days) to txn_date (days floor towards minus
+        # infinity, as timedelta does) is within date_window, with those days.
+        txn_us = (txn_date - EPOCH) // timedelta(microseconds=1)
+        lo = np.searchsorted(self.date_sorted_us, txn_us - (date_window + 1) * MICROS_PER_DAY, side="left")
+        hi = np.searchsorted(self.date_sorted_us, txn_us + (date_window + 1) * MICROS_PER_DAY, side="right")
+        rows = np.sort(self.date_sorted_rows[lo:hi])
+        days = np.abs(np.floor_divide(txn_us - self.date_us[rows], MICROS_PER_DAY))
+        keep = days <= date_window
+        return rows[keep], days[keep]
+
+
+def txn_text_terms(txn: dict) -> dict:
+    # The literal strings Stage 1 looks for in email text for a transaction;
+    # None (or empty) where the transaction has nothing usable.
+    vendor_name = normalize_text(txn.get("vendor_name", "") or txn.get("Vendor", "") or txn.get("VendorName", ""))
+    description = normalize_text(txn.get("description", "") or txn.get("description", "") or txn.get("Memo", ""))
+    invoice_number = str(txn.get("transaction_id", "") or txn.get("Invoice Number", "") or txn.get("TransactionID", "")).strip().upper()
+
+    vendor_core = None
+    if vendor_name and len(vendor_name) > 3:
+        vendor_core = vendor_name.split()[0] if ' ' in vendor_name else vendor_name
+        if len(vendor_core) <= 3:
+            vendor_core = None
+    desc_words = [w for w in description.split() if len(w) > 4][:3] if description and len(description) > 5 else []
+    invoice = invoice_number if invoice_number and len(invoice_number) > 2 else None
+    numeric_part = re.search(r'\d{3,}', invoice) if invoice else None
+    return {
+        "vendor_core": vendor_core,
+        "desc_words": desc_words,
+        "invoice": invoice,
+        "invoice_num": numeric_part.group() if numeric_part else None,
+    }
+
+
+def statement_patterns(transactions: list):
+    # All transactions' text terms: (searched in lowercase text, searched in
+    # uppercase text), for EmailFeatures.scan_patterns.
+    patterns, upper_patterns = set(), set()
+    for txn in transactions:
+        terms = txn_text_terms(txn)
+        patterns.update(p for p in [terms["vendor_core"], terms["invoice_num"], *terms["desc_words"]] if p)
+        if terms["invoice"]:
+            upper_patterns.add(terms["invoice"])
+    return sorted(patterns), sorted(upper_patterns)
+
+
+def filter_emails(txn: dict, emails: list, date_window: int = 3, min_matches: int = 1,
+                  features: EmailFeatures = None) -> list:
     start_time = time()
+    if features is None:
+        features = EmailFeatures(emails)
     
-    vendor_name = normalize_text(txn.get("vendor_name", "") or txn.get("Vendor", "") or txn.get("VendorName", ""))
     vendor_domain = (txn.get("Vendor", "") or txn.get("Vendor Domain", "")).lower()
     description = normalize_text(txn.get("description", "") or txn.get("description", "") or txn.get("Memo", ""))
     invoice_number = str(txn.get("transaction_id", "") or txn.get("Invoice Number", "") or txn.get("TransactionID", "")).strip().upper()
+    terms = txn_text_terms(txn)
     txn_amount = float(txn.get("amount", 0) or txn.get("amount", 0))
     txn_date = make_aware(parse_date_dynamic(txn.get("date") or txn.get("Date", "")))
     
     logger.info(f"Stage 1 Filter START - Transaction: {invoice_number}")
     logger.info(f"  Vendor: {txn.get('vendor') or 'N/A'}, Domain: {vendor_domain or 'N/A'}, Amount: ${txn_amount}, Description: {description[:30] if description else 'N/A'}")
     
-    filtered = []
+    # Each criterion looks up the emails it can match in the indexes, so only
+    # those are ever scored; an email no criterion hits keeps score 0.
+    scores = {}
+    reasons = {}
+
+    def hit(rows, points, reason):
+        for row in rows:
+            row = int(row)
+            scores[row] = scores.get(row, 0) + points
+            reasons.setdefault(row, []).append(reason)
+
     criteria_stats = {
         "domain": 0,
         "vendor_keyword": 0,
@@ -67,92 +278,116 @@ def filter_emails(txn: dict, emails: list, date_window: int = 3, min_matches: in
         "amount_match": 0,
         "date_proximity": 0
     }
-    
-    for email in emails:
-        email_from = str(email.get("from", "")).lower()
-        email_subject = normalize_text(email.get("subject", ""))
-        email_body = normalize_text(email.get("body", ""))
-        email_snippet = normalize_text(email.get("snippet", ""))
-        email_domain = extract_domain(email_from)
-        email_date = make_aware(parse_date_dynamic(email.get("date")))
-        
-        searchable = f"{email_from} {email_subject} {email_body} {email_snippet}"
-        
-        match_score = 0
-        match_reasons = []
-        
-        if vendor_domain and vendor_domain == email_domain:
-            match_score += 1
-            match_reasons.append("domain_match")
-            criteria_stats["domain"] += 1
-        
-        if vendor_name and len(vendor_name) > 3:
-            vendor_core = vendor_name.split()[0] if ' ' in vendor_name else vendor_name
-            if len(vendor_core) > 3 and vendor_core in searchable:
-                match_score += 1
-                match_reasons.append(f"vendor:{vendor_core}")
-                criteria_stats["vendor_keyword"] += 1
-        
-        if description and len(description) > 5:
-            desc_words = [w for w in description.split() if len(w) > 4]
-            for word in desc_words[:3]:
-                if word in searchable:
-                    match_score += 0.5
-                    match_reasons.append(f"desc:{word}")
-                    criteria_stats["description_keyword"] += 1
-                    break
-        
-        if invoice_number and len(invoice_number) > 2:
-            invoice_pattern = re.escape(invoice_number)
-            if re.search(invoice_pattern, searchable.upper()):
-                match_score += 3
-                match_reasons.append("invoice_exact")
-                criteria_stats["invoice_exact"] += 1
-            else:
-                numeric_part = re.search(r'\d{3,}', invoice_number)
-                if numeric_part:
-                    num = numeric_part.group()
-                    if num in searchable:
-                        match_score += 2
-                        match_reasons.append(f"invoice_num:{num}")
-                        criteria_stats["invoice_numeric"] += 1
-        
-        email_amounts = extract_amounts(searchable)
-        for amount in email_amounts:
-            if abs(amount - txn_amount) <= 0.01:
-                match_score += 2
-                match_reasons.append(f"amount_exact:${amount}")
-                criteria_stats["amount_match"] += 1
-                break
-            elif abs(amount - txn_amount) <= 5:
-                match_score += 1
-                match_reasons.append(f"amount_close:${amount}")
-                criteria_stats["amount_match"] += 1
-                break
-        
-        if txn_date and email_date:
-            days_diff = abs((txn_date - email_date).days)
-            if days_diff <= date_window:
-                match_score += 1
-                match_reasons.append(f"date_{days_diff}d")
-                criteria_stats["date_proximity"] += 1
-        
-        if match_score >= min_matches:
-            email_copy = email.copy()
-            email_copy['filter_score'] = match_score
-            email_copy['filter_reasons'] = match_reasons
-            filtered.append(email_copy)
-    
+
+    if vendor_domain:
+        rows = features.rows_with_domain(vendor_domain)
+        hit(rows, 1, "domain_match")
+        criteria_stats["domain"] = len(rows)
+
+    vendor_core = terms["vendor_core"]
+    if vendor_core:
+        rows = features.rows_containing(vendor_core)
+        hit(rows, 1, f"vendor:{vendor_core}")
+        criteria_stats["vendor_keyword"] = len(rows)
+
+    desc_rows = set()
+    if terms["desc_words"]:
+        # An email is credited for the first of these words it contains.
+        for word in terms["desc_words"]:
+            rows = [row for row in features.rows_containing(word) if row not in desc_rows]
+            hit(rows, 0.5, f"desc:{word}")
+            desc_rows.update(rows)
+        criteria_stats["description_keyword"] = len(desc_rows)
+
+    if terms["invoice"]:
+        exact_rows = features.rows_containing(terms["invoice"], upper=True)
+        hit(exact_rows, 3, "invoice_exact")
+        criteria_stats["invoice_exact"] = len(exact_rows)
+        num = terms["invoice_num"]
+        if num:
+            exact = set(exact_rows)
+            num_rows = [row for row in features.rows_containing(num) if row not in exact]
+            hit(num_rows, 2, f"invoice_num:{num}")
+            criteria_stats["invoice_numeric"] = len(num_rows)
+
+    rows, amounts, exact = features.first_close_amount(txn_amount)
+    for row, amount, is_exact in zip(rows, amounts, exact):
+        hit([row], 2 if is_exact else 1,
+            f"amount_exact:${float(amount)}" if is_exact else f"amount_close:${float(amount)}")
+    criteria_stats["amount_match"] = len(rows)
+
+    if txn_date:
+        rows, days = features.rows_near_date(txn_date, date_window)
+        for row, d in zip(rows, days):
+            hit([row], 1, f"date_{int(d)}d")
+        criteria_stats["date_proximity"] = len(rows)
+
+    # Email order, then stable by score, as the per-email loop produced them.
+    selected = range(len(features)) if min_matches <= 0 else sorted(r for r, s in scores.items() if s >= min_matches)
+    filtered = []
+    for row in selected:
+        score = scores.get(row, 0)
+        email_copy = features.emails[row].copy()
+        email_copy['filter_score'] = float(score) if row in desc_rows else int(score)
+        email_copy['filter_reasons'] = reasons.get(row, [])
+        filtered.append(email_copy)
     filtered.sort(key=lambda x: x['filter_score'], reverse=True)
     
     elapsed = time() - start_time
-    logger.info(f"Stage 1 Filter COMPLETE - {len(emails)} → {len(filtered)} emails ({elapsed:.2f}s)")
+    logger.info(f"Stage 1 Filter COMPLETE - {len(features)} → {len(filtered)} emails ({elapsed:.2f}s)")
     logger.info(f"  Criteria Stats: {criteria_stats}")
     
     return filtered
 
 
+def get_gemini_pool() -> ThreadPoolExecutor:
+    # Its size is the global limit on concurrent Gemini calls. Kept apart
+    # from the transaction pool so a transaction waiting on its calls never
+    # holds a slot they need.
+    global _gemini_pool
+    with _pool_lock:
+        if _gemini_pool is None:
+            _gemini_pool = ThreadPoolExecutor(max_workers=max(1, GEMINI_CONCURRENCY), thread_name_prefix="gemini")
+    return _gemini_pool
+
+
+def get_match_pool() -> ThreadPoolExecutor:
+    global _match_pool
+    with _pool_lock:
+        if _match_pool is None:
+            _match_pool = ThreadPoolExecutor(max_workers=max(1, MATCH_WORKERS), thread_name_prefix="match")
+    return _match_pool
+
+
+def _score_email(txn: dict, email: dict, rank: int, total: int) -> dict:
+    email_subject = email.get("subject", "")[:50]
+    logger.info(f"  Gemini call {rank}/{total} - Email: '{email_subject}...'")
+    gemini_start = time()
+
+    email_content = {
+        "id": email.get("id"),
+        "account": email.get("account"),
+        "from": email.get("from"),
+        "subject": email.get("subject"),
+        "body": email.get("body", email.get("snippet", "")),
+        "date": email.get("date"),
+        "attachments": email.get("attachments", [])
+    }
+
+    gemini_result = score_match_with_gemini(txn, email_content)
+    gemini_elapsed = time() - gemini_start
+    logger.info(f"    Score {rank}: {gemini_result.get('score', 0)}/100 ({gemini_elapsed:.2f}s) - {gemini_result.get('reason', '')[:60]}")
+    return gemini_result
+
+
 def score_with_gemini(txn: dict, filtered_emails: list, threshold: int = 60, max_emails: int = 10):
+    """Match `txn` to the first of the top `max_emails` candidates, in filter
+    rank order, whose Gemini score reaches `threshold`.
+
+    Unlike the original one-by-one loop, which scored all `max_emails` and
+    kept the best, scoring stops at that first match: a lower-ranked email
+    that would have scored higher is never asked about.
+    """
     start_time = time()
     
     transaction_id = txn.get("transaction_id")
@@ -175,45 +410,47 @@ def score_with_gemini(txn: dict, filtered_emails: list, threshold: int = 60, max
     
     best_match = None
     best_score = 0
-    emails_processed = 0
     
-    for email in filtered_emails[:max_emails]:
-        emails_processed += 1
-        email_subject = email.get("subject", "")[:50]
-        
+    # Candidates go out in rank order, at most GEMINI_WINDOW at a time, and
+    # are read back in that order. Once one reaches the threshold nothing
+    # more is sent, and the calls still queued behind it are cancelled.
+    candidates = filtered_emails[:max_emails]
+    pool = get_gemini_pool()
+    window = deque()
+    submitted = 0
+    email_rank = 0
+    
+    while True:
+        while submitted < len(candidates) and len(window) < max(1, GEMINI_WINDOW):
+            window.append(pool.submit(_score_email, txn, candidates[submitted], submitted + 1, len(candidates)))
+            submitted += 1
+        if not window:
+            break
+        future = window.popleft()
+        email = candidates[email_rank]
+        email_rank += 1
         try:
-            logger.info(f"  Gemini call {emails_processed}/{max_emails} - Email: '{email_subject}...'")
-            gemini_start = time()
-            
-            email_content = {
-                "from": email.get("from"),
-                "subject": email.get("subject"),
-                "body": email.get("body", email.get("snippet", "")),
-                "date": email.get("date"),
-                "attachments": email.get("attachments", [])
-            }
-            
-            gemini_result = score_match_with_gemini(txn, email_content)
-            gemini_elapsed = time() - gemini_start
-            
-            score = gemini_result.get("score", 0)
-            reason = gemini_result.get("reason", "")
-            
-            logger.info(f"    Score: {score}/100 ({gemini_elapsed:.2f}s) - {reason[:60]}")
-            
-            if score > best_score:
-                best_score = score
-                best_match = {
-                    "email": email,
-                    "score": score,
-                    "reason": reason,
-                    "gemini_data": gemini_result
-                }
-                logger.info(f"    ✓ New best match!")
-        
+            gemini_result = future.result()
         except Exception as e:
             logger.error(f"    ✗ Gemini error: {str(e)}")
             continue
+        
+        score = gemini_result.get("score", 0)
+        if score > best_score:
+            best_score = score
+            best_match = {
+                "email": email,
+                "score": score,
+                "reason": gemini_result.get("reason", ""),
+                "gemini_data": gemini_result
+            }
+            logger.info(f"    ✓ New best match (rank {email_rank})")
+            if score >= threshold:
+                break
+    
+    cancelled = sum(f.cancel() for f in window)
+    if cancelled:
+        logger.info(f"  Early exit - {cancelled} Gemini call(s) cancelled")
     
     if best_match and best_score >= threshold:
         email = best_match["email"]
@@ -258,18 +495,31 @@ def hybrid_match(transactions: list, emails: list, threshold: int = 90, date_win
 
     all_digest = []
     all_exceptions = []
+    features = EmailFeatures(emails)
+    if TEXT_MATCH_MODE == "automaton":
+        features.scan_patterns(*statement_patterns(transactions))
     
-    for idx, txn in enumerate(transactions):
+    def match_one(idx, txn):
         txn_start = time()
         
-        filtered_emails = filter_emails(txn, emails, date_window, min_matches)
+        filtered_emails = filter_emails(txn, emails, date_window, min_matches, features)
         
-        digest, exceptions = score_with_gemini(txn, filtered_emails, threshold, max_emails_to_score)
-        
-        all_digest.extend(digest)
-        all_exceptions.extend(exceptions)
+        result = score_with_gemini(txn, filtered_emails, threshold, max_emails_to_score)
         
         txn_elapsed = time() - txn_start
         logger.info(f"Transaction {idx+1} completed in {txn_elapsed:.2f}s")
+        return result
+    
+    # Transactions run side by side (their Gemini calls share the global
+    # limit); results are collected in statement order.
+    if MATCH_WORKERS <= 1 or len(transactions) <= 1:
+        results = [match_one(idx, txn) for idx, txn in enumerate(transactions)]
+    else:
+        pool = get_match_pool()
+        results = [f.result() for f in [pool.submit(match_one, idx, txn) for idx, txn in enumerate(transactions)]]
+    
+    for digest, exceptions in results:
+        all_digest.extend(digest)
+        all_exceptions.extend(exceptions)
     
     return all_digest, all_exceptions
\ No newline at end of file
@@ -0,0 +1,82 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Iterable, List, Optional, Set, Tuple
+
+from app.gmail_utils import parse_date_dynamic
+
+
+# Segments are partitioned by email date, per calendar "month" or ISO "week".
+PARTITION_BY = os.getenv("PARTITION_BY", "month")
+UNDATED_PARTITION = "undated"
+
+
+def to_utc(value) -> Optional[datetime]:
+    # Accepts datetimes/Timestamps or anything parse_date_dynamic understands;
+    # naive values are taken as UTC. NaT and unparseable input give None.
+    if value is None or value != value:
+        return None
+    dt = value if isinstance(value, datetime) else parse_date_dynamic(value)
+    if dt is None:
+        return None
+    if hasattr(dt, "to_pydatetime"):
+        dt = dt.to_pydatetime()
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def partition_key(date_value, granularity: str = PARTITION_BY) -> str:
+    dt = to_utc(date_value)
+    if dt is None:
+        return UNDATED_PARTITION
+    if granularity == "week":
+        year, week, _ = dt.isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == "month":
+        return f"{dt.year}-{dt.month:02d}"
+    raise ValueError(f"Unknown partition granularity: {granularity}")
+
+
+def partition_bounds(key: str) -> Tuple[Optional[str], Optional[str]]:
+    # [start, end) of a partition as UTC ISO strings.
+    if key == UNDATED_PARTITION:
+        return None, None
+    if "-W" in key:
+        year, week = key.split("-W")
+        start = datetime.fromisocalendar(int(year), int(week), 1).replace(tzinfo=timezone.utc)
+        end = start + timedelta(days=7)
+    else:
+        year, month = (int(p) for p in key.split("-"))
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start.isoformat(), end.isoformat()
+
+
+def partition_info(key: str) -> Dict[str, Any]:
+    start, end = partition_bounds(key)
+    return {"partition": key, "partition_start": start, "partition_end": end}
+
+
+def email_partition(email: Dict[str, Any], granularity: str = PARTITION_BY) -> str:
+    return partition_key(email.get("date"), granularity)
+
+
+def partitions_for_window(date_value, days: int, granularity: str = PARTITION_BY) -> Optional[Set[str]]:
+    # Partitions overlapping date +/- days (plus a day of slack for calendar
+    # dates), always including undated. None when the date is unknown.
+    center = to_utc(date_value)
+    if center is None:
+        return None
+    keys = {UNDATED_PARTITION}
+    day = center - timedelta(days=days + 1)
+    while day <= center + timedelta(days=days + 1):
+        keys.add(partition_key(day, granularity))
+        day += timedelta(days=1)
+    return keys
+
+
+def group_by_partition(emails: Iterable[Dict[str, Any]], granularity: str = PARTITION_BY) -> Dict[str, List[Dict[str, Any]]]:
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for email in emails:
+        groups.setdefault(email_partition(email, granularity), []).append(email)
+    return dict(sorted(groups.items()))
@@ -0,0 +1,199 @@
+import ctypes
+import io
+import mmap
+import os
+import threading
+from pathlib import Path
+from typing import List, Dict, Any, Tuple, Callable
+
+import pdfplumber
+from pdf2image import convert_from_path, convert_from_bytes
+import pytesseract
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+except ImportError:
+    pdfium = None
+    pdfium_c = None
+
+
+PDF_TEXT_BACKEND = os.getenv("PDF_TEXT_BACKEND", "pdfium")
+MIN_TEXT_CHARS = 50
+# A page is only handed to pdfplumber's table finder when it carries at least
+# this many ruling-like vector objects (straight lines and rectangles).
+TABLE_MIN_RULINGS = 4
+# Lines are 2 path segments, rectangles 4-5, and count as one ruling each.
+# Longer paths count one ruling per straight segment when they have no curves
+# (a whole table grid drawn as one path); curved ones are logos and glyphs.
+MAX_RULING_SEGMENTS = 5
+# Tesseract runs shared by every extracting thread.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "4"))
+
+# PDFium is not thread-safe: every call into it, from any thread, has to be
+# serialised. Table extraction and OCR run outside this lock.
+_pdfium_lock = threading.Lock()
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+
+def _is_stream(pdf_source) -> bool:
+    return hasattr(pdf_source, "read") and hasattr(pdf_source, "seek")
+
+
+def _open_plumber(pdf_source):
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return pdfplumber.open(io.BytesIO(pdf_source))
+    if _is_stream(pdf_source):
+        pdf_source.seek(0)
+        return pdfplumber.open(pdf_source)
+    return pdfplumber.open(str(Path(pdf_source)))
+
+
+def _path_rulings(path) -> int:
+    count = pdfium_c.FPDFPath_CountSegments(path)
+    if count <= MAX_RULING_SEGMENTS:
+        return 1
+    lines = 0
+    for i in range(count):
+        kind = pdfium_c.FPDFPathSegment_GetType(pdfium_c.FPDFPath_GetPathSegment(path, i))
+        if kind == pdfium_c.FPDF_SEGMENT_BEZIERTO:
+            return 0
+        if kind == pdfium_c.FPDF_SEGMENT_LINETO:
+            lines += 1
+    return lines
+
+
+def _pdfium_page_texts(pdf_source) -> List[Tuple[str, int]]:
+    if isinstance(pdf_source, bytearray):
+        source = bytes(pdf_source)
+    elif isinstance(pdf_source, mmap.mmap):
+        # Hand pdfium the mapped pages directly instead of copying them out.
+        source = (ctypes.c_char * len(pdf_source)).from_buffer(pdf_source)
+    elif _is_stream(pdf_source):
+        pdf_source.seek(0)
+        source = pdf_source
+    elif isinstance(pdf_source, bytes):
+        source = pdf_source
+    else:
+        source = str(Path(pdf_source))
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(source)
+        pages = []
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                text = textpage.get_text_range().replace("\r\n", "\n").replace("\r", "\n")
+                textpage.close()
+
+                rulings = 0
+                for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_PATH,)):
+                    rulings += _path_rulings(obj.raw)
+
+                pages.append((text, rulings))
+                page.close()
+        finally:
+            pdf.close()
+    return pages
+
+
+def _pdfplumber_page_texts(pdf_source) -> List[Tuple[str, int]]:
+    pages = []
+    with _open_plumber(pdf_source) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text() or ""
+            pages.append((text, len(page.lines) + len(page.rects)))
+    return pages
+
+
+TEXT_BACKENDS: Dict[str, Callable[[Any], List[Tuple[str, int]]]] = {
+    "pdfium": _pdfium_page_texts,
+    "pdfplumber": _pdfplumber_page_texts,
+}
+
+
+def get_text_backend(name: str = None) -> Callable[[Any], List[Tuple[str, int]]]:
+    name = name or PDF_TEXT_BACKEND
+    if name == "pdfium" and pdfium is None:
+        name = "pdfplumber"
+    if name not in TEXT_BACKENDS:
+        raise ValueError(f"Unknown PDF text backend: {name}")
+    return TEXT_BACKENDS[name]
+
+
+def is_tabular(rulings: int) -> bool:
+    return rulings >= TABLE_MIN_RULINGS
+
+
+def extract_tables_for_pages(pdf_source, page_numbers: List[int]) -> Dict[int, List]:
+    tables = {}
+    if not page_numbers:
+        return tables
+    with _open_plumber(pdf_source) as pdf:
+        for page_num in page_numbers:
+            tables[page_num] = pdf.pages[page_num - 1].extract_tables() or []
+    return tables
+
+
+def ocr_single_page(img):
+    return pytesseract.image_to_string(img)
+
+
+def get_ocr_pool() -> ThreadPoolExecutor:
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr")
+    return _ocr_pool
+
+
+def extract_pages_from_pdf(pdf_source, dpi: int = 150, backend: str = None) -> List[Dict[str, Any]]:
+    results = []
+    pages_need_ocr = []
+
+    page_texts = get_text_backend(backend)(pdf_source)
+    tabular_pages = [i for i, (_, rulings) in enumerate(page_texts, start=1) if is_tabular(rulings)]
+    tables_by_page = extract_tables_for_pages(pdf_source, tabular_pages)
+
+    for i, (text, _) in enumerate(page_texts, start=1):
+        page_data = {"page_number": i, "text": "", "tables": tables_by_page.get(i, []), "method": ""}
+        if text and len(text.strip()) > MIN_TEXT_CHARS:
+            page_data["text"] = text.strip()
+            page_data["method"] = "text_extraction"
+        else:
+            page_data["method"] = "ocr_pending"
+            pages_need_ocr.append(i)
+        results.append(page_data)
+
+    if pages_need_ocr:
+        groups = []
+        current = [pages_need_ocr[0]]
+        for p in pages_need_ocr[1:]:
+            if p == current[-1] + 1:
+                current.append(p)
+            else:
+                groups.append(current)
+                current = [p]
+        groups.append(current)
+
+        all_images = []
+        for g in groups:
+            first_page = min(g)
+            last_page = max(g)
+            if isinstance(pdf_source, (bytes, bytearray)):
+                images = convert_from_bytes(pdf_source, dpi=dpi, first_page=first_page, last_page=last_page)
+            elif _is_stream(pdf_source):
+                pdf_source.seek(0)
+                images = convert_from_bytes(pdf_source.read(), dpi=dpi, first_page=first_page, last_page=last_page)
+            else:
+                images = convert_from_path(str(pdf_source), dpi=dpi, first_page=first_page, last_page=last_page)
+            all_images.extend(images)
+
+        texts = list(get_ocr_pool().map(ocr_single_page, all_images))
+
+        for idx, page_num in enumerate(pages_need_ocr):
+            results[page_num - 1]["text"] = texts[idx].strip()
+            results[page_num - 1]["method"] = "ocr"
+
+    return results
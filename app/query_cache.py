@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional
+
+import numpy as np
+
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "20000"))
+# Where the cache is kept across restarts; empty disables persistence.
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", "storage/query_embeddings.npz")
+
+
+def normalise_query(text: str) -> str:
+    # The embedding model is uncased, so case and runs of whitespace do not
+    # change the vector.
+    return " ".join(str(text).lower().split())
+
+
+class QueryEmbeddingCache:
+    # LRU of normalised query text -> embedding, shared by every batch and
+    # request. Vectors from another model are never served.
+    def __init__(self, model_name: str, max_size: int = QUERY_CACHE_SIZE):
+        self.model_name = model_name
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, key: str, vec: np.ndarray):
+        with self._lock:
+            self._entries[key] = vec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def encode(self, texts: List[str], encoder: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        # Embeddings for `texts` in order; only distinct misses reach the
+        # encoder, in one call.
+        keys = [normalise_query(t) for t in texts]
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+        found = {k: self.get(k) for k in dict.fromkeys(keys)}
+        missing = [k for k, v in found.items() if v is None]
+        if missing:
+            vectors = np.asarray(encoder(missing), dtype=np.float32)
+            for k, vec in zip(missing, vectors):
+                vec.setflags(write=False)
+                self.put(k, vec)
+                found[k] = vec
+        return np.vstack([found[k] for k in keys])
+
+    def sample(self, n: int) -> Optional[np.ndarray]:
+        # Up to `n` of the most recently used embeddings, or None when empty.
+        with self._lock:
+            vectors = list(self._entries.values())[-n:]
+        return np.vstack(vectors) if vectors else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def save(self, path: str = QUERY_CACHE_PATH):
+        if not path:
+            return
+        with self._lock:
+            keys = list(self._entries)
+            vectors = np.vstack(list(self._entries.values())) if keys else np.zeros((0, 0), dtype=np.float32)
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp.npz")
+        # Fixed-width unicode, not pickled objects, so loading never unpickles.
+        np.savez(tmp, model=np.array(self.model_name, dtype=str), keys=np.array(keys, dtype=str), vectors=vectors)
+        tmp.replace(path)
+
+    def load(self, path: str = QUERY_CACHE_PATH) -> int:
+        # Restores a saved cache (most recent entries last); a missing,
+        # unreadable (including pickled, older-format) or other-model file is
+        # ignored.
+        if not path or not Path(path).exists():
+            return 0
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data["model"]) != self.model_name:
+                    return 0
+                keys, vectors = list(data["keys"]), data["vectors"]
+        except Exception as e:
+            print(f"Could not load query embedding cache {path}: {e}")
+            return 0
+        for key, vec in zip(keys[-self.max_size:], vectors[-self.max_size:]):
+            vec.setflags(write=False)
+            self.put(str(key), vec)
+        return len(self._entries)
@@ -1,69 +1,68 @@
-import io
+import heapq
 import json
 import math
+import os
 import re
-from pathlib import Path
-from typing import List, Dict, Any, Optional
-
-import pdfplumber
-from pdf2image import convert_from_path, convert_from_bytes
-import pytesseract
+import threading
 from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Dict, Any, Iterable, Optional
 
 import numpy as np
-from sentence_transformers import SentenceTransformer, CrossEncoder
 
 import faiss
 from rank_bm25 import BM25Okapi
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from app.blob_store import has_blob, open_blob
+from app.segments import (
+    INDEX_ROOT, SEGMENT_PREFIX, commit_segment, delete_emails, email_key, filter_unindexed, indexed_attachment_hashes,
+    load_catalog, new_segment_id, segment_dir_name, segment_dirs,
+)
+from app.chunking import CHUNK_SIZE, CHUNK_OVERLAP, normalize_amount, extract_amounts_from_text, split_with_amounts
+from app.pdf_extraction import extract_pages_from_pdf
+from app.inference import (
+    EMBED_MODEL, EMBED_POOL_MIN_CHUNKS, EMBED_POOL_WORKERS, INFERENCE_BACKEND, RERANK_MODEL,
+    encode_multi_process, get_embedder, get_reranker,
+)
+from app.inference_service import MicroBatcher
+from app.query_cache import QueryEmbeddingCache
+from app.partitions import group_by_partition, partition_info, to_utc
+from app.bloom import BLOOM_FILE, BloomFilter, bloom_may_contain, build_bloom
+from app.segment_store import (
+    MmapBM25, build_email_index, chunk_email_key, load_chunks, load_tombstones, scoped_key, write_bm25, write_chunks,
+)
+from app.vector_index import (
+    RECALL_SAMPLE, RESCORE_DTYPE, apply_search_params, build_index, is_lossy, load_or_fit_pca, needs_rescoring, rescore,
+)
 
 
 BATCH_SIZE_EMAILS = 200
-CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 200
-EMBED_MODEL = "all-MiniLM-L6-v2"
-RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
 TOP_K_PER_BATCH = 20  
 GLOBAL_TOP_K = 3
-INDEX_ROOT = Path("storage")
-INDEX_ROOT.mkdir(exist_ok=True)
 
 AMOUNT_TOLERANCE = 0.01  
+# Emails are fetched within +/- this many days of a transaction, so a batch
+# whose dates all fall outside that window cannot hold its receipt.
+ZONE_DATE_WINDOW_DAYS = 4
+
+DOMAIN_PATTERN = re.compile(r'@([\w\.-]+)')
+# "prioritise" searches batches whose Bloom filter may hold the query's
+# identifiers first and falls back to the rest when they yield too few
+# matches; "strict" never searches the rest; "off" disables the probe.
+BLOOM_MODE = os.getenv("BLOOM_MODE", "prioritise")
+# Compressed indexes return this many times more dense candidates than are
+# kept, so exact rescoring can recover neighbours quantization misranked.
+RESCORE_OVERFETCH = 2
+INDEX_MMAP = os.getenv("INDEX_MMAP", "1") != "0"
+# Batches are searched concurrently on one shared pool; FAISS and the NumPy
+# BM25 scoring release the GIL. 1 searches serially.
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+_search_pool: Optional[ThreadPoolExecutor] = None
+_search_pool_lock = threading.Lock()
 
 
-def normalize_amount(amount_str: str) -> Optional[float]:
-    if not amount_str:
-        return None
-    
-    amount_str = str(amount_str)
-    cleaned = re.sub(r'[$,\s€£¥₹]', '', amount_str)
-    match = re.search(r'-?\d+\.?\d*', cleaned)
-    if match:
-        try:
-            return float(match.group())
-        except ValueError:
-            return None
-    return None
-
-def extract_amounts_from_text(text: str) -> List[float]:
-
-    amounts = []
-
-    patterns = [
-        r'\$\s*[\d,]+\.?\d*', 
-        r'[\d,]+\.?\d*\s*(?:USD|EUR|GBP|dollars?)',  
-        r'(?:total|amount|sum|price|cost|invoice)[\s:]+\$?\s*[\d,]+\.?\d*',  
-    ]
-    
-    for pattern in patterns:
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
-            amt = normalize_amount(match.group())
-            if amt:
-                amounts.append(amt)
-    
-    return amounts
-
 def amounts_match(target: float, candidates: List[float], tolerance: float = AMOUNT_TOLERANCE) -> bool:
 
     if not candidates:
@@ -77,81 +76,6 @@ def amounts_match(target: float, candidates: List[float], tolerance: float = AMO
     
     return False
 
-def ocr_single_page(img):
-    return pytesseract.image_to_string(img)
-
-def extract_pages_from_pdf(pdf_source, dpi: int = 150) -> List[Dict[str, Any]]:
-    results = []
-    pages_need_ocr = []
-
-    if isinstance(pdf_source, (bytes, bytearray)):
-        pdf_fileobj = io.BytesIO(pdf_source)
-        with pdfplumber.open(pdf_fileobj) as pdf:
-            for i, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text() or ""
-                tables = page.extract_tables() or []
-                page_data = {"page_number": i, "text": "", "tables": tables, "method": ""}
-                if text and len(text.strip()) > 50:
-                    page_data["text"] = text.strip()
-                    page_data["method"] = "text_extraction"
-                else:
-                    page_data["method"] = "ocr_pending"
-                    pages_need_ocr.append(i)
-                results.append(page_data)
-    else:
-        pdf_path = Path(pdf_source)
-        with pdfplumber.open(str(pdf_path)) as pdf:
-            for i, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text() or ""
-                tables = page.extract_tables() or []
-                page_data = {"page_number": i, "text": "", "tables": tables, "method": ""}
-                if text and len(text.strip()) > 50:
-                    page_data["text"] = text.strip()
-                    page_data["method"] = "text_extraction"
-                else:
-                    page_data["method"] = "ocr_pending"
-                    pages_need_ocr.append(i)
-                results.append(page_data)
-
-    if pages_need_ocr:
-        groups = []
-        current = [pages_need_ocr[0]]
-        for p in pages_need_ocr[1:]:
-            if p == current[-1] + 1:
-                current.append(p)
-            else:
-                groups.append(current)
-                current = [p]
-        groups.append(current)
-
-        all_images = []
-        for g in groups:
-            first_page = min(g)
-            last_page = max(g)
-            if isinstance(pdf_source, (bytes, bytearray)):
-                images = convert_from_bytes(pdf_source, dpi=dpi, first_page=first_page, last_page=last_page)
-            else:
-                images = convert_from_path(str(pdf_source), dpi=dpi, first_page=first_page, last_page=last_page)
-            all_images.extend(images)
-
-        with ThreadPoolExecutor(max_workers=4) as ex:
-            texts = list(ex.map(ocr_single_page, all_images))
-
-        for idx, page_num in enumerate(pages_need_ocr):
-            results[page_num - 1]["text"] = texts[idx].strip()
-            results[page_num - 1]["method"] = "ocr"
-
-    return results
-
-
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=CHUNK_SIZE,
-    chunk_overlap=CHUNK_OVERLAP,
-    length_function=len,
-    separators=["\n\n", "\n", ". ", " ", ""],
-    is_separator_regex=False
-)
-
 def chunk_pages(pages: List[Dict[str, Any]], base_metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
 
     chunks = []
@@ -162,13 +86,10 @@ def chunk_pages(pages: List[Dict[str, Any]], base_metadata: Dict[str, Any]) -> L
         method = p.get("method", "unknown")
 
         if text.strip():
-            t_chunks = text_splitter.split_text(text)
-            for t in t_chunks:
+            for t, amounts in split_with_amounts(text):
                 if len(t.strip()) < 20:
                     continue
-        
-                amounts = extract_amounts_from_text(t)
-                
+
                 chunks.append({
                     "chunk_id": None,
                     "page": page_num,
@@ -186,14 +107,10 @@ def chunk_pages(pages: List[Dict[str, Any]], base_metadata: Dict[str, Any]) -> L
             if len(table_text) == 0:
                 continue
 
-            amounts = extract_amounts_from_text(table_text)
-            
             if len(table_text) > CHUNK_SIZE:
-                t_chunks = text_splitter.split_text(table_text)
-                for tc_idx, tc in enumerate(t_chunks):
+                for tc_idx, (tc, tc_amounts) in enumerate(split_with_amounts(table_text)):
                     if len(tc.strip()) < 20:
                         continue
-                    tc_amounts = extract_amounts_from_text(tc)
                     chunks.append({
                         "chunk_id": None,
                         "page": page_num,
@@ -212,7 +129,7 @@ def chunk_pages(pages: List[Dict[str, Any]], base_metadata: Dict[str, Any]) -> L
                     "content": table_text,
                     "extraction_method": "table",
                     "char_count": len(table_text),
-                    "amounts": amounts,
+                    "amounts": extract_amounts_from_text(table_text),
                     "metadata": {**base_metadata, "table_index": tidx}
                 })
     
@@ -222,29 +139,79 @@ def chunk_pages(pages: List[Dict[str, Any]], base_metadata: Dict[str, Any]) -> L
     return chunks
 
 
-embed_model = SentenceTransformer(EMBED_MODEL)
+# Quantized backends give slightly different vectors, so they are cached apart.
+QUERY_EMBEDDINGS = QueryEmbeddingCache(f"{EMBED_MODEL}:{INFERENCE_BACKEND}")
+# Query encoding and reranking from all concurrent requests are coalesced
+# into shared micro-batches.
+QUERY_ENCODER = MicroBatcher(lambda texts: get_embedder().encode(
+    texts, convert_to_numpy=True, normalize_embeddings=True), "query-embed")
+RERANKER = MicroBatcher(lambda pairs: get_reranker().predict(pairs), "rerank")
 
 def build_embeddings(chunks: List[Dict[str, Any]], batch_size: int = 64) -> np.ndarray:
     texts = [c["content"] for c in chunks]
-    embeddings = embed_model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
+    if EMBED_POOL_WORKERS > 1 and len(texts) >= EMBED_POOL_MIN_CHUNKS:
+        return encode_multi_process(texts)
+    embeddings = get_embedder().encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
     return embeddings
 
-def build_faiss_index(embeddings: np.ndarray) -> faiss.IndexFlatIP:
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    index.add(embeddings)
-    return index
+def embed_queries(texts: List[str]) -> np.ndarray:
+    # Query-side embeddings go through the shared LRU; statements repeat the
+    # same vendors and descriptions every month.
+    return QUERY_EMBEDDINGS.encode(texts, QUERY_ENCODER)
+
+def build_faiss_index(embeddings: np.ndarray, index_type: Optional[str] = None, compression: Optional[str] = None,
+                      pca=None):
+    # Returns (index, params); params carries the chosen type, compression and
+    # the tuned nprobe/efSearch that load_faiss re-applies. Search parameters
+    # are tuned on recently cached query embeddings where there are any.
+    return build_index(embeddings, index_type, compression, pca, queries=QUERY_EMBEDDINGS.sample(RECALL_SAMPLE))
 
-def build_bm25(chunks: List[Dict[str, Any]]):
+def build_bm25(chunks: List[Dict[str, Any]], batch_dir: Path):
     tokenized = [c["content"].lower().split() for c in chunks]
-    bm25 = BM25Okapi(tokenized)
-    return bm25, tokenized
+    return write_bm25(tokenized, batch_dir), tokenized
 
-def save_faiss(index: faiss.IndexFlat, path: Path):
+def load_bm25(batch_dir: Path, manifest: Dict[str, Any]):
+    if manifest.get("bm25"):
+        return MmapBM25(batch_dir, manifest["bm25"])
+    return BM25Okapi(load_json(batch_dir / "bm25_tokenized.json"))
+
+def save_faiss(index: faiss.Index, path: Path):
     faiss.write_index(index, str(path))
 
-def load_faiss(path: Path) -> faiss.IndexFlat:
-    return faiss.read_index(str(path))
+def load_faiss(path: Path, params: Optional[Dict[str, Any]] = None, mmap: bool = INDEX_MMAP) -> faiss.Index:
+    # Memory-mapped indexes are read-only and share the OS page cache across
+    # worker processes instead of each holding a private copy.
+    if mmap:
+        try:
+            index = faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            return apply_search_params(index, params)
+        except RuntimeError as e:
+            print(f"mmap load of {path} failed, reading into memory: {e}")
+    return apply_search_params(faiss.read_index(str(path)), params)
+
+def has_exact_vectors(batch_dir: Path) -> bool:
+    # Whether load_embeddings can give back the vectors as embedded. Lossy
+    # segments written with VECTOR_RESCORE=0 before the copy was always kept
+    # cannot, and are never rewritten.
+    if (batch_dir / "embeddings.npy").exists():
+        return True
+    return not is_lossy(load_json(batch_dir / "manifest.json").get("faiss"))
+
+
+def load_embeddings(batch_dir: Path) -> np.ndarray:
+    # Lossy indexes cannot give back exact vectors, so those segments keep a
+    # half-precision copy; the rest (and older flat segments) hold float32
+    # vectors the index can reconstruct.
+    path = batch_dir / "embeddings.npy"
+    if path.exists():
+        return np.load(path).astype("float32")
+    if not has_exact_vectors(batch_dir):
+        raise ValueError(f"{batch_dir.name} has a lossy index and no vector copy")
+    index = load_faiss(batch_dir / "faiss.index", mmap=False)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
 
 def save_json(obj: Any, path: Path):
     with open(path, 'w', encoding='utf-8') as f:
@@ -254,88 +221,160 @@ def load_json(path: Path):
     with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def process_batch(batch_id: int, emails: List[Dict[str, Any]], storage_root: Path = INDEX_ROOT) -> Dict[str, Any]:
-    
-    batch_dir = storage_root / f"batch_{batch_id:04d}"
-    batch_dir.mkdir(parents=True, exist_ok=True)
+def email_to_chunks(email: Dict[str, Any], skip_hashes: Optional[set] = None) -> List[Dict[str, Any]]:
 
-    all_chunks: List[Dict[str, Any]] = []
+    chunks: List[Dict[str, Any]] = []
 
-    for email in emails:
-        base_meta = {
-            "email_id": email.get("email_id") or email.get("id"),
-            "sender": email.get("from") or email.get("sender"),
-            "date": email.get("date"),
-        }
+    base_meta = {
+        "email_id": email.get("email_id") or email.get("id"),
+        "sender": email.get("from") or email.get("sender"),
+        "date": email.get("date"),
+        "account": email.get("account"),
+    }
+    
+    # NEW: Add email metadata as searchable chunks
+    email_text_parts = []
+    if email.get("subject"):
+        email_text_parts.append(f"Subject: {email['subject']}")
+    if email.get("snippet") or email.get("body"):
+        body = email.get("body") or email.get("snippet", "")
+        email_text_parts.append(f"Body: {body}")
+    
+    if email_text_parts:
+        email_content = "\n".join(email_text_parts)
+        amounts = extract_amounts_from_text(email_content)
         
-        # NEW: Add email metadata as searchable chunks
-        email_text_parts = []
-        if email.get("subject"):
-            email_text_parts.append(f"Subject: {email['subject']}")
-        if email.get("snippet") or email.get("body"):
-            body = email.get("body") or email.get("snippet", "")
-            email_text_parts.append(f"Body: {body}")
+        chunks.append({
+            "chunk_id": len(chunks),
+            "page": 0,
+            "type": "email_metadata",
+            "content": email_content,
+            "extraction_method": "email",
+            "char_count": len(email_content),
+            "amounts": amounts,
+            "metadata": {**base_meta, "pdf_name": "Email Content"}
+        })
+    
+    for att in email.get("attachments", []):
+        pdf_bytes = att.get("bytes")
+        digest = att.get("hash")
+        if skip_hashes and scoped_key(email.get("account"), digest) in skip_hashes:
+            continue
+        if not pdf_bytes and not has_blob(digest):
+            continue
+
+        try:
+            if pdf_bytes:
+                pages = extract_pages_from_pdf(pdf_bytes)
+            else:
+                with open_blob(digest) as pdf_map:
+                    pages = extract_pages_from_pdf(pdf_map)
+        except Exception as e:
+            print(f"Error extracting {att.get('filename')}: {e}")
+            continue
+
+        att_meta = {**base_meta, "pdf_name": att.get("filename"), "attachment_hash": digest}
+        page_chunks = chunk_pages(pages, att_meta)
         
-        if email_text_parts:
-            email_content = "\n".join(email_text_parts)
-            amounts = extract_amounts_from_text(email_content)
-            
-            all_chunks.append({
-                "chunk_id": len(all_chunks),
-                "page": 0,
-                "type": "email_metadata",
-                "content": email_content,
-                "extraction_method": "email",
-                "char_count": len(email_content),
-                "amounts": amounts,
-                "metadata": {**base_meta, "pdf_name": "Email Content"}
-            })
+        offset = len(chunks)
+        for i, pc in enumerate(page_chunks):
+            pc["chunk_id"] = offset + i
         
-        for att in email.get("attachments", []):
-            pdf_bytes = att.get("bytes")
-            if not pdf_bytes:
-                continue
+        chunks.extend(page_chunks)
+
+    return chunks
 
-            try:
-                pages = extract_pages_from_pdf(pdf_bytes)
-            except Exception as e:
-                print(f"Error extracting {att.get('filename')}: {e}")
-                continue
 
-            att_meta = {**base_meta, "pdf_name": att.get("filename")}
-            page_chunks = chunk_pages(pages, att_meta)
-            
-            offset = len(all_chunks)
-            for i, pc in enumerate(page_chunks):
-                pc["chunk_id"] = offset + i
-            
-            all_chunks.extend(page_chunks)
+def sender_domain(sender: Optional[str]) -> Optional[str]:
+    match = DOMAIN_PATTERN.search(str(sender or ""))
+    return match.group(1).lower().rstrip(".") if match else None
+
+
+def build_zone_map(chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # Per-batch min/max statistics used by global_search to skip batches
+    # before loading their indices.
+    dates, amounts, domains = [], [], set()
+    parsed = {}
+    for c in chunks:
+        meta = c.get("metadata", {})
+        raw = meta.get("date")
+        if raw:
+            if raw not in parsed:
+                parsed[raw] = to_utc(raw)
+            if parsed[raw] is not None:
+                dates.append(parsed[raw])
+        amounts.extend(a for a in c.get("amounts") or [] if a is not None)
+        domain = sender_domain(meta.get("sender"))
+        if domain:
+            domains.add(domain)
+
+    return {
+        "min_date": min(dates).isoformat() if dates else None,
+        "max_date": max(dates).isoformat() if dates else None,
+        "min_amount": min(amounts) if amounts else None,
+        "max_amount": max(amounts) if amounts else None,
+        "sender_domains": sorted(domains),
+    }
+
+
+def write_batch(batch_id, all_chunks: List[Dict[str, Any]], embeddings: Optional[np.ndarray] = None,
+                storage_root: Path = INDEX_ROOT, partition: Optional[str] = None,
+                index_type: Optional[str] = None) -> Dict[str, Any]:
+
+    batch_dir = storage_root / segment_dir_name(batch_id)
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    segment_id = batch_dir.name[len(SEGMENT_PREFIX):]
 
     if len(all_chunks) == 0:
-        save_json({"chunks_count": 0}, batch_dir / "manifest.json")
-        return {"batch_id": batch_id, "chunks": 0}
+        save_json({"chunks_count": 0, "segment_id": segment_id}, batch_dir / "manifest.json")
+        return {"batch_id": batch_id, "segment_id": segment_id, "chunks": 0}
+
+    for i, c in enumerate(all_chunks):
+        c["chunk_id"] = i
 
-    embeddings = build_embeddings(all_chunks)
-    faiss_index = build_faiss_index(embeddings)
+    if embeddings is None:
+        embeddings = build_embeddings(all_chunks)
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    faiss_index, faiss_params = build_faiss_index(embeddings, index_type, pca=load_or_fit_pca(storage_root, embeddings))
     save_faiss(faiss_index, batch_dir / "faiss.index")
+    if is_lossy(faiss_params):
+        np.save(batch_dir / "embeddings.npy", embeddings.astype(RESCORE_DTYPE))
 
-    bm25_index, tokenized_texts = build_bm25(all_chunks)
-    save_json([t for t in tokenized_texts], batch_dir / "bm25_tokenized.json")
+    bm25_meta, tokenized_texts = build_bm25(all_chunks, batch_dir)
+    bloom_meta = build_bloom(tokenized_texts).save(batch_dir / BLOOM_FILE)
 
-    save_json(all_chunks, batch_dir / "chunks.json")
+    write_chunks(all_chunks, batch_dir)
 
     manifest = {
         "batch_id": batch_id,
+        "segment_id": segment_id,
         "chunks": len(all_chunks),
         "faiss_path": str(batch_dir / "faiss.index"),
-        "bm25_tokenized": str(batch_dir / "bm25_tokenized.json"),
-        "chunks_path": str(batch_dir / "chunks.json")
+        "faiss": faiss_params,
+        "bm25": bm25_meta,
+        "chunks_path": str(batch_dir / "chunks.jsonl"),
+        "zone_map": build_zone_map(all_chunks),
+        "bloom": bloom_meta,
+        "emails": build_email_index(all_chunks),
     }
+    if partition is not None:
+        manifest.update(partition_info(partition))
     save_json(manifest, batch_dir / "manifest.json")
 
     return manifest
 
 
+def process_batch(batch_id, emails: List[Dict[str, Any]], storage_root: Path = INDEX_ROOT,
+                  skip_hashes: Optional[set] = None, partition: Optional[str] = None,
+                  index_type: Optional[str] = None) -> Dict[str, Any]:
+
+    all_chunks: List[Dict[str, Any]] = []
+    for email in emails:
+        all_chunks.extend(email_to_chunks(email, skip_hashes))
+
+    return write_batch(batch_id, all_chunks, storage_root=storage_root, partition=partition, index_type=index_type)
+
+
 def csv_row_to_enhanced_query(csv_row):
 
     structured = {}
@@ -365,7 +404,8 @@ def csv_row_to_enhanced_query(csv_row):
     }
 
 
-def hybrid_retrieve_one_batch(query_info: Dict[str, Any], batch_obj: Dict[str, Any], top_k=TOP_K_PER_BATCH):
+def hybrid_retrieve_one_batch(query_info: Dict[str, Any], batch_obj: Dict[str, Any], top_k=TOP_K_PER_BATCH,
+                              q_emb: Optional[np.ndarray] = None):
 
     faiss_idx = batch_obj["faiss"]
     bm25 = batch_obj["bm25"]
@@ -375,24 +415,51 @@ def hybrid_retrieve_one_batch(query_info: Dict[str, Any], batch_obj: Dict[str, A
     structured = query_info['structured_fields']
     target_amount = structured.get('amount')
 
-    q_emb = embed_model.encode([text_query], convert_to_numpy=True, normalize_embeddings=True)
+    if q_emb is None:
+        q_emb = embed_queries([text_query])
+    dense_k = min(top_k * 3, len(chunks))
+    vectors = batch_obj.get("vectors")
+    deleted = batch_obj.get("deleted")
+    fetch_k = min(dense_k * RESCORE_OVERFETCH, len(chunks)) if vectors is not None else dense_k
+    if deleted is not None:
+        # Tombstoned chunks stay in the index until compaction; fetch enough
+        # extra neighbours to make up for any that are filtered out.
+        fetch_k = min(fetch_k + int(np.count_nonzero(deleted)), len(chunks))
     try:
-        distances, indices = faiss_idx.search(q_emb, min(top_k * 3, len(chunks)))
+        distances, indices = faiss_idx.search(q_emb, fetch_k)
     except Exception:
         distances, indices = np.array([[]]), np.array([[]])
 
     dense_scores = {}
     for idx, score in zip(indices[0], distances[0]):
+        if deleted is not None and (idx < 0 or deleted[idx]):
+            continue
         dense_scores[int(idx)] = float(score)
+    if deleted is not None and vectors is None:
+        kept = list(dense_scores)[:dense_k]
+        dense_scores = {i: dense_scores[i] for i in kept}
+        indices = np.array([kept])
+    if vectors is not None:
+        # Compressed index: it only shortlists candidates. The dense scores
+        # used for ranking are recomputed from the stored vectors and
+        # the exact top `dense_k` kept.
+        exact = rescore(vectors, q_emb[0], dense_scores)
+        kept = sorted(exact, key=exact.get, reverse=True)[:dense_k]
+        dense_scores = {i: exact[i] for i in kept}
+        indices = np.array([kept])
 
     tok = text_query.lower().split()
     bm25_scores = bm25.get_scores(tok)
+    if deleted is not None:
+        bm25_scores[deleted] = 0.0
 
 
     candidate_idxs = set()
     candidate_idxs.update([int(i) for i in indices[0] if i is not None and i != -1])
     sparse_top = np.argsort(bm25_scores)[::-1][:top_k * 3]
     candidate_idxs.update([int(i) for i in sparse_top])
+    if deleted is not None:
+        candidate_idxs = {i for i in candidate_idxs if not deleted[i]}
 
     candidates = []
     for i in candidate_idxs:
@@ -458,49 +525,172 @@ def load_batch_indices(batch_dir: Path):
     manifest = load_json(batch_dir / "manifest.json")
     if manifest.get("chunks", 0) == 0:
         return None
-    faiss_idx = load_faiss(Path(manifest["faiss_path"]))
-    tokenized_texts = load_json(Path(manifest["bm25_tokenized"]))
-    bm25 = BM25Okapi(tokenized_texts)
-    chunks = load_json(Path(manifest["chunks_path"]))
-    return {"faiss": faiss_idx, "bm25": bm25, "chunks": chunks, "tokenized": tokenized_texts, "manifest": manifest}
+    # Artefacts are resolved next to the manifest; the absolute paths it records
+    # go stale when storage/ is moved or written on another OS.
+    faiss_idx = load_faiss(batch_dir / "faiss.index", manifest.get("faiss"))
+    bm25 = load_bm25(batch_dir, manifest)
+    chunks = load_chunks(batch_dir)
+    vectors = None
+    params = manifest.get("faiss") or {}
+    if needs_rescoring(params) and (batch_dir / "embeddings.npy").exists():
+        vectors = np.load(batch_dir / "embeddings.npy", mmap_mode="r")
+    deleted = load_tombstones(batch_dir, manifest["chunks"])
+    return {"faiss": faiss_idx, "bm25": bm25, "chunks": chunks, "manifest": manifest, "vectors": vectors,
+            "deleted": deleted if deleted is not None and deleted.any() else None}
+
+def _vendor_in_domains(vendor: str, domains: List[str]) -> bool:
+    vendor = vendor.lower().strip().split("@")[-1]
+    for d in domains:
+        if d == vendor or d.endswith("." + vendor) or vendor in d.split("."):
+            return True
+    return False
 
-def global_search(query_info: Dict[str, Any], batch_dirs: List[Path], top_k=GLOBAL_TOP_K, top_k_per_batch=TOP_K_PER_BATCH, rerank: bool = True):
 
-    batch_objs = []
+def zone_map_excludes(zone_map: Optional[Dict[str, Any]], query_info: Dict[str, Any],
+                      date_window_days: int = ZONE_DATE_WINDOW_DAYS) -> bool:
+    # True only when the batch provably cannot hold the transaction's email.
+    # The date window is a hard bound; amount and vendor are only boosts in
+    # scoring, so a batch is dropped on them only when it matches neither.
+    if not zone_map:
+        return False
+    structured = query_info.get("structured_fields", {})
+
+    txn_date = to_utc(structured.get("date"))
+    if txn_date is not None and zone_map.get("min_date"):
+        window = timedelta(days=date_window_days)
+        min_date = datetime.fromisoformat(zone_map["min_date"])
+        max_date = datetime.fromisoformat(zone_map["max_date"])
+        # Transaction dates are calendar days; allow the whole day either side.
+        if max_date < txn_date - window - timedelta(days=1) or min_date > txn_date + window + timedelta(days=1):
+            return True
+
+    amount = structured.get("amount")
+    vendor = structured.get("vendor")
+    amount_possible = vendor_possible = None
+    if isinstance(amount, (int, float)) and amount > 0 and zone_map.get("min_amount") is not None:
+        tol = amount * AMOUNT_TOLERANCE
+        amount_possible = zone_map["min_amount"] - tol <= amount <= zone_map["max_amount"] + tol
+    if isinstance(vendor, str) and vendor.strip() and zone_map.get("sender_domains"):
+        vendor_possible = _vendor_in_domains(vendor, zone_map["sender_domains"])
+
+    return amount_possible is False and vendor_possible is not True
+
+
+def query_identifiers(query_info: Dict[str, Any]) -> List[str]:
+    structured = query_info.get("structured_fields", {})
+    idents = []
+    for key in ("invoice_number", "invoice number", "vendor", "vendor_name"):
+        value = structured.get(key)
+        if isinstance(value, str) and value.strip() and value.strip().lower() not in ("nan", "none"):
+            idents.append(value)
+    return idents
+
+
+def select_batches(query_info: Dict[str, Any], batch_dirs: List[Path], bloom_mode: str = BLOOM_MODE):
+    # Returns (primary, deferred) batch dirs. Zone maps drop batches outright;
+    # Bloom filters move batches that certainly lack every query identifier
+    # to `deferred`.
+    idents = query_identifiers(query_info) if bloom_mode != "off" else []
+    primary, deferred = [], []
+    pruned = 0
     for bd in batch_dirs:
-        bo = load_batch_indices(bd)
-        if bo:
-            batch_objs.append(bo)
+        manifest = load_json(bd / "manifest.json")
+        if manifest.get("chunks", 0) == 0 or zone_map_excludes(manifest.get("zone_map"), query_info):
+            pruned += 1
+            continue
+        bloom_meta = manifest.get("bloom")
+        if idents and bloom_meta:
+            bloom = BloomFilter.load(bd, bloom_meta)
+            if not any(bloom_may_contain(bloom, ident) for ident in idents):
+                deferred.append(bd)
+                continue
+        primary.append(bd)
+    if pruned or deferred:
+        print(f"Batch selection: {pruned} pruned by zone maps, {len(deferred)} deferred by Bloom filters, {len(primary)} primary")
+    return primary, deferred
 
-    all_candidates = []
-    for bo in batch_objs:
-        cand = hybrid_retrieve_one_batch(query_info, bo, top_k=top_k_per_batch)
-        all_candidates.extend(cand)
 
-    if not all_candidates:
-        return []
+def get_search_pool() -> ThreadPoolExecutor:
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="batch-search")
+    return _search_pool
+
 
+def _search_one(query_info: Dict[str, Any], batch_dir: Path, top_k_per_batch: int, q_emb: np.ndarray) -> List[Dict[str, Any]]:
+    bo = load_batch_indices(batch_dir)
+    return hybrid_retrieve_one_batch(query_info, bo, top_k=top_k_per_batch, q_emb=q_emb) if bo else []
 
+
+def _search_batches(query_info: Dict[str, Any], batch_dirs: List[Path], top_k_per_batch: int,
+                    q_emb: np.ndarray) -> List[List[Dict[str, Any]]]:
+    # Results come back in batch order whatever order the searches finish
+    # in, so merging (and tie-breaking) is deterministic.
+    if SEARCH_WORKERS <= 1 or len(batch_dirs) <= 1:
+        return [_search_one(query_info, bd, top_k_per_batch, q_emb) for bd in batch_dirs]
+    pool = get_search_pool()
+    futures = [pool.submit(_search_one, query_info, bd, top_k_per_batch, q_emb) for bd in batch_dirs]
+    return [f.result() for f in futures]
+
+
+def _is_strong(candidate: Dict[str, Any]) -> bool:
+    md = candidate["match_details"]
+    return md["amount_match"] or md["vendor_match"] or md["invoice_match"]
+
+
+def merge_candidates(per_batch: List[List[Dict[str, Any]]], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Best-scoring copy per chunk, ordered by score (stable, so ties keep
+    # batch order); with `limit`, only the top `limit` are selected, by
+    # heapq.nlargest rather than a full sort. Dedupe keeps one entry per
+    # distinct chunk, so memory is the candidate count either way.
     best_by_key = {}
-    for c in all_candidates:
-        chunk = c["chunk"]
-        unique_key = json.dumps({
-            "chunk_id": chunk.get("chunk_id"),
-            "pdf": chunk.get("metadata", {}).get("pdf_name"),
-            "email": chunk.get("metadata", {}).get("email_id")
-        }, sort_keys=True)
-        if unique_key not in best_by_key or c["score"] > best_by_key[unique_key]["score"]:
-            best_by_key[unique_key] = c
+    for candidates in per_batch:
+        for c in candidates:
+            chunk = c["chunk"]
+            meta = chunk.get("metadata", {})
+            key = (chunk.get("chunk_id"), meta.get("pdf_name"), chunk_email_key(meta))
+            prev = best_by_key.get(key)
+            if prev is None or c["score"] > prev["score"]:
+                best_by_key[key] = c
+    if limit is None:
+        return sorted(best_by_key.values(), key=lambda x: x["score"], reverse=True)
+    return heapq.nlargest(limit, best_by_key.values(), key=lambda x: x["score"])
+
+
+def _owned_by(per_batch: List[List[Dict[str, Any]]], accounts: Iterable[str]) -> List[List[Dict[str, Any]]]:
+    owners = set(accounts)
+    return [[c for c in cands if c["chunk"].get("metadata", {}).get("account") in owners] for cands in per_batch]
+
+
+def global_search(query_info: Dict[str, Any], batch_dirs: List[Path], top_k=GLOBAL_TOP_K, top_k_per_batch=TOP_K_PER_BATCH, rerank: bool = True,
+                  bloom_mode: str = BLOOM_MODE, accounts: Optional[Iterable[str]] = None):
+    # With `accounts`, only chunks of those mailboxes are returned, whatever
+    # segments were passed in.
+    primary, deferred = select_batches(query_info, batch_dirs, bloom_mode)
+    if not primary and not deferred:
+        return []
 
-    merged = list(best_by_key.values())
-    merged = sorted(merged, key=lambda x: x["score"], reverse=True)
+    q_emb = embed_queries([query_info['text_query']])
+    per_batch = _search_batches(query_info, primary, top_k_per_batch, q_emb)
+    if accounts is not None:
+        per_batch = _owned_by(per_batch, accounts)
+    strong = sum(1 for cands in per_batch for c in cands if _is_strong(c))
+    if deferred and bloom_mode != "strict" and strong < top_k:
+        more = _search_batches(query_info, deferred, top_k_per_batch, q_emb)
+        per_batch.extend(_owned_by(more, accounts) if accounts is not None else more)
+
+    # Every distinct candidate goes to the reranker, whose scores decide the
+    # final order; without reranking only the top_k by score are needed.
+    merged = merge_candidates(per_batch, None if rerank else top_k)
+    if not merged:
+        return []
 
 
     if rerank and len(merged) > 0:
         texts = [m["chunk"]["content"] for m in merged]
         queries = [query_info['text_query']] * len(texts)
-        reranker = CrossEncoder(RERANK_MODEL)
-        rerank_scores = reranker.predict(list(zip(queries, texts)))
+        rerank_scores = RERANKER(list(zip(queries, texts)))
         for i, sc in enumerate(rerank_scores):
             amount_boost = 2.0 if merged[i]["match_details"]["amount_match"] else 0.0
             merged[i]["score_rerank"] = float(sc) + amount_boost
@@ -551,19 +741,53 @@ def format_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 
 
 
-def ingest_all_emails(email_inputs: List[Dict[str, Any]], batch_size: int = BATCH_SIZE_EMAILS) -> List[Dict[str, Any]]:
+def ingest_all_emails(email_inputs: List[Dict[str, Any]], batch_size: int = BATCH_SIZE_EMAILS,
+                      storage_root: Path = INDEX_ROOT) -> List[Dict[str, Any]]:
+    # Appends new segments for emails not yet in the catalogue; existing
+    # segments are never rewritten. Emails are grouped by date partition and
+    # account first, so every segment covers a single week/month of one
+    # mailbox.
+    catalog = load_catalog(storage_root)
+    email_inputs = filter_unindexed(email_inputs, catalog)
+    known_hashes = indexed_attachment_hashes(catalog)
+
+    groups = []
+    for partition, partition_emails in group_by_partition(email_inputs).items():
+        by_account: Dict[str, List[Dict[str, Any]]] = {}
+        for e in partition_emails:
+            by_account.setdefault(e.get("account") or "", []).append(e)
+        groups.extend((partition, emails) for _, emails in sorted(by_account.items()))
+
     manifests = []
-    total = len(email_inputs)
-    batches = math.ceil(total / batch_size)
-    for i in range(batches):
-        start = i * batch_size
-        end = min(total, start + batch_size)
-        batch_emails = email_inputs[start:end]
-        manifest = process_batch(i + 1, batch_emails)
-        manifests.append(manifest)
+    for partition, partition_emails in groups:
+        total = len(partition_emails)
+        batches = math.ceil(total / batch_size)
+        for i in range(batches):
+            start = i * batch_size
+            end = min(total, start + batch_size)
+            batch_emails = partition_emails[start:end]
+            manifest = process_batch(new_segment_id(), batch_emails, storage_root, skip_hashes=known_hashes,
+                                     partition=partition)
+            # Only attachments that produced chunks count as indexed.
+            hashes = sorted({scoped_key(entry.get("account"), d) for entry in manifest.get("emails", {}).values()
+                             for d in entry["attachments"]})
+            refs = {email_key(e): [scoped_key(e.get("account"), a["hash"]) for a in e.get("attachments", [])
+                                   if a.get("hash")] for e in batch_emails}
+            commit_segment(storage_root, manifest, [email_key(e) for e in batch_emails], hashes, refs)
+            known_hashes.update(hashes)
+            manifests.append(manifest)
     return manifests
 
 
+def reindex_emails(email_inputs: List[Dict[str, Any]], batch_size: int = BATCH_SIZE_EMAILS,
+                   storage_root: Path = INDEX_ROOT) -> List[Dict[str, Any]]:
+    # Replaces the indexed chunks of these emails (e.g. after fixing a PDF
+    # extraction): the old chunks are tombstoned and the emails appended as a
+    # new segment, touching nothing else.
+    delete_emails(storage_root, [email_key(e) for e in email_inputs])
+    return ingest_all_emails(email_inputs, batch_size, storage_root)
+
+
 import shutil
 
 def clean_storage():
@@ -579,7 +803,7 @@ if __name__ == "__main__":
 
     manifests = ingest_all_emails(emails_for_rag, batch_size=100)
 
-    batch_dirs = sorted([p for p in INDEX_ROOT.iterdir() if p.is_dir()])
+    batch_dirs = segment_dirs(INDEX_ROOT)
 
 
     csv_row = {
@@ -0,0 +1,237 @@
+import bisect
+import json
+import math
+import mmap
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Optional
+
+import numpy as np
+
+
+# Segment artefacts laid out so a loaded segment is a set of read-only memory
+# maps: every API worker shares one page-cache copy and loading no longer
+# reads or parses whole files.
+CHUNKS_FILE = "chunks.jsonl"
+CHUNK_OFFSETS_FILE = "chunk_offsets.npy"
+LEGACY_CHUNKS_FILE = "chunks.json"
+
+BM25_VOCAB_FILE = "bm25_vocab.bin"
+BM25_ARRAYS = ("vocab_offsets", "idf", "postings_ptr", "postings_doc", "postings_tf", "doc_len")
+# rank_bm25.BM25Okapi defaults; scores match it exactly.
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+# Bit per chunk position, set when the chunk's email is deleted.
+TOMBSTONE_FILE = "tombstones.bin"
+
+
+def _map_file(path: Path):
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_chunks(chunks: List[Dict[str, Any]], batch_dir: Path):
+    # One JSON document per line plus the byte offset of every line.
+    offsets = [0]
+    with open(batch_dir / CHUNKS_FILE, "wb") as f:
+        for c in chunks:
+            line = json.dumps(c, ensure_ascii=False).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.save(batch_dir / CHUNK_OFFSETS_FILE, np.array(offsets, dtype=np.int64))
+
+
+class ChunkStore:
+    def __init__(self, batch_dir: Path):
+        self._data = _map_file(batch_dir / CHUNKS_FILE)
+        self._offsets = np.load(batch_dir / CHUNK_OFFSETS_FILE, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._data[int(self._offsets[i]):int(self._offsets[i + 1])])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_chunks(batch_dir: Path, lazy: bool = True):
+    # Segments written before chunks.jsonl keep a single chunks.json array.
+    if (batch_dir / CHUNKS_FILE).exists():
+        store = ChunkStore(batch_dir)
+        return store if lazy else list(store)
+    with open(batch_dir / LEGACY_CHUNKS_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class _Vocab:
+    # Sorted terms stored as concatenated UTF-8; indexable for bisect.
+    def __init__(self, data, offsets: np.ndarray):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._data[int(self._offsets[i]):int(self._offsets[i + 1])].decode("utf-8")
+
+    def find(self, term: str) -> int:
+        i = bisect.bisect_left(self, term)
+        return i if i < len(self) and self[i] == term else -1
+
+
+def write_bm25(tokenized: List[List[str]], batch_dir: Path) -> Dict[str, Any]:
+    # Term-major postings (CSC) with precomputed BM25Okapi idf.
+    first_seen: Dict[str, int] = {}
+    doc_freq: Dict[str, int] = {}
+    doc_terms = []
+    for tokens in tokenized:
+        counts: Dict[str, int] = {}
+        for tok in tokens:
+            counts[tok] = counts.get(tok, 0) + 1
+        for tok in counts:
+            first_seen.setdefault(tok, len(first_seen))
+            doc_freq[tok] = doc_freq.get(tok, 0) + 1
+        doc_terms.append(counts)
+
+    n_docs = len(tokenized)
+    # Same summation order as rank_bm25 (first appearance), so the epsilon
+    # floor is bit-identical.
+    idf_by_term = {t: math.log(n_docs - doc_freq[t] + 0.5) - math.log(doc_freq[t] + 0.5) for t in first_seen}
+    idf_sum = 0
+    for t in first_seen:
+        idf_sum += idf_by_term[t]
+    eps = BM25_EPSILON * (idf_sum / len(idf_by_term)) if idf_by_term else 0.0
+
+    vocab = sorted(first_seen)
+    term_id = {t: i for i, t in enumerate(vocab)}
+    encoded = [t.encode("utf-8") for t in vocab]
+    vocab_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    vocab_offsets[1:] = np.cumsum([len(b) for b in encoded])
+    with open(batch_dir / BM25_VOCAB_FILE, "wb") as f:
+        f.write(b"".join(encoded))
+
+    terms, docs, tfs = [], [], []
+    for d, counts in enumerate(doc_terms):
+        for tok, tf in counts.items():
+            terms.append(term_id[tok])
+            docs.append(d)
+            tfs.append(tf)
+    terms = np.array(terms, dtype=np.int64)
+    docs = np.array(docs, dtype=np.int32)
+    tfs = np.array(tfs, dtype=np.int32)
+    order = np.lexsort((docs, terms))
+    postings_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+    postings_ptr[1:] = np.cumsum(np.bincount(terms, minlength=len(vocab)))
+
+    idf = np.array([idf_by_term[t] for t in vocab], dtype=np.float64)
+    idf[idf < 0] = eps
+    doc_len = np.array([len(t) for t in tokenized], dtype=np.int32)
+
+    arrays = {
+        "vocab_offsets": vocab_offsets,
+        "idf": idf,
+        "postings_ptr": postings_ptr,
+        "postings_doc": docs[order],
+        "postings_tf": tfs[order],
+        "doc_len": doc_len,
+    }
+    for name, arr in arrays.items():
+        np.save(batch_dir / f"bm25_{name}.npy", arr)
+    return {"docs": n_docs, "terms": len(vocab), "avgdl": float(doc_len.sum()) / n_docs if n_docs else 0.0}
+
+
+class MmapBM25:
+    # Drop-in for BM25Okapi.get_scores over the arrays written by write_bm25.
+    def __init__(self, batch_dir: Path, meta: Dict[str, Any], k1: float = BM25_K1, b: float = BM25_B):
+        arrays = {name: np.load(batch_dir / f"bm25_{name}.npy", mmap_mode="r") for name in BM25_ARRAYS}
+        self.vocab = _Vocab(_map_file(batch_dir / BM25_VOCAB_FILE), arrays["vocab_offsets"])
+        self.idf = arrays["idf"]
+        self.postings_ptr = arrays["postings_ptr"]
+        self.postings_doc = arrays["postings_doc"]
+        self.postings_tf = arrays["postings_tf"]
+        self.doc_len = arrays["doc_len"]
+        self.corpus_size = meta["docs"]
+        self.avgdl = meta["avgdl"]
+        self.k1 = k1
+        self.b = b
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        score = np.zeros(self.corpus_size)
+        for q in query:
+            t = self.vocab.find(q)
+            if t < 0:
+                continue
+            start, end = int(self.postings_ptr[t]), int(self.postings_ptr[t + 1])
+            docs = np.asarray(self.postings_doc[start:end])
+            q_freq = np.asarray(self.postings_tf[start:end], dtype=np.int64)
+            doc_len = np.asarray(self.doc_len[docs], dtype=np.int64)
+            score[docs] += float(self.idf[t]) * (q_freq * (self.k1 + 1) /
+                                                 (q_freq + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)))
+        return score
+
+
+def load_tombstones(batch_dir: Path, n_chunks: int):
+    # Bool mask of deleted chunk positions, or None if nothing was deleted.
+    path = batch_dir / TOMBSTONE_FILE
+    if not path.exists():
+        return None
+    bits = np.fromfile(path, dtype=np.uint8)
+    return np.unpackbits(bits, count=n_chunks, bitorder="little").astype(bool)
+
+
+def add_tombstones(batch_dir: Path, n_chunks: int, positions: List[int]) -> int:
+    # Marks chunk positions deleted; returns the segment's total tombstones.
+    # The bitmap is swapped in whole so readers never see a partial write.
+    mask = load_tombstones(batch_dir, n_chunks)
+    if mask is None:
+        mask = np.zeros(n_chunks, dtype=bool)
+    mask[positions] = True
+    path = batch_dir / TOMBSTONE_FILE
+    tmp = path.with_name(f"{TOMBSTONE_FILE}.tmp")
+    np.packbits(mask, bitorder="little").tofile(tmp)
+    tmp.replace(path)
+    return int(mask.sum())
+
+
+def scoped_key(account: Optional[str], key: Optional[str]) -> Optional[str]:
+    # Message ids and attachment hashes are tracked per mailbox: the index is
+    # shared by every connected account, and one account's copy of a message
+    # or PDF never stands in for another's. Chunks with no account (older
+    # segments) keep the bare key.
+    if not key or not account:
+        return key
+    return f"{account}#{key}"
+
+
+def chunk_email_key(meta: Dict[str, Any]) -> Optional[str]:
+    return scoped_key(meta.get("account"), meta.get("email_id"))
+
+
+def build_email_index(chunks: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # email key -> chunk position ranges [start, end), account and attachment
+    # hashes, so one email's chunks can be found without reading chunks.jsonl.
+    emails: Dict[str, Dict[str, Any]] = {}
+    for i, c in enumerate(chunks):
+        meta = c.get("metadata", {})
+        email_id = chunk_email_key(meta)
+        if not email_id:
+            continue
+        entry = emails.setdefault(email_id, {"ranges": [], "account": meta.get("account"), "attachments": []})
+        if entry["ranges"] and entry["ranges"][-1][1] == i:
+            entry["ranges"][-1][1] = i + 1
+        else:
+            entry["ranges"].append([i, i + 1])
+        digest = meta.get("attachment_hash")
+        if digest and digest not in entry["attachments"]:
+            entry["attachments"].append(digest)
+    return emails
@@ -0,0 +1,401 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from time import time, strftime, gmtime
+from typing import List, Dict, Any, Optional, Iterable
+
+from app.segment_store import add_tombstones, build_email_index, chunk_email_key, load_chunks, scoped_key
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# Created on first write (catalog_lock / write_batch), not at import.
+INDEX_ROOT = Path("storage")
+CATALOG_NAME = "catalog.json"
+LOCK_NAME = ".catalog.lock"
+SEGMENT_PREFIX = "batch_"
+# Segments swapped out by compaction stay on disk this long so searches that
+# took their catalogue snapshot earlier can still open them.
+RETIRE_GRACE_SECONDS = 600
+
+_THREAD_LOCK = threading.RLock()
+
+
+def new_segment_id() -> str:
+    return f"{strftime('%Y%m%dT%H%M%S', gmtime())}_{uuid.uuid4().hex[:8]}"
+
+
+def segment_dir_name(segment_id) -> str:
+    if isinstance(segment_id, int):
+        return f"{SEGMENT_PREFIX}{segment_id:04d}"
+    return f"{SEGMENT_PREFIX}{segment_id}"
+
+
+@contextmanager
+def catalog_lock(root: Path):
+    root.mkdir(parents=True, exist_ok=True)
+    with _THREAD_LOCK:
+        with open(root / LOCK_NAME, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _empty_catalog() -> Dict[str, Any]:
+    return {"version": 1, "generation": 0, "segments": [], "retired": [], "indexed": {"emails": {}, "attachments": {}}}
+
+
+def _bootstrap_catalog(root: Path) -> Dict[str, Any]:
+    # Storage written before the catalogue existed: adopt every batch_* dir
+    # that has a non-empty manifest as a live segment.
+    catalog = _empty_catalog()
+    if not root.exists():
+        return catalog
+
+    for d in sorted(p for p in root.iterdir() if p.is_dir() and p.name.startswith(SEGMENT_PREFIX)):
+        manifest_path = d / "manifest.json"
+        if not manifest_path.exists():
+            continue
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("chunks", 0) == 0:
+            continue
+
+        segment_id = d.name[len(SEGMENT_PREFIX):]
+        catalog["segments"].append(_segment_entry({**manifest, "segment_id": segment_id}, d.stat().st_mtime))
+
+        for chunk in load_chunks(d):
+            email_id = chunk_email_key(chunk.get("metadata", {}))
+            if email_id:
+                catalog["indexed"]["emails"][email_id] = segment_id
+    return catalog
+
+
+def _write_catalog(catalog: Dict[str, Any], root: Path):
+    path = root / CATALOG_NAME
+    tmp = root / f"{CATALOG_NAME}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _read_catalog(root: Path) -> Optional[Dict[str, Any]]:
+    path = root / CATALOG_NAME
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_catalog(root: Path) -> Dict[str, Any]:
+    # The catalogue file is only ever swapped in whole with os.replace, so a
+    # single read is a consistent snapshot of the live segments.
+    catalog = _read_catalog(root)
+    if catalog is not None:
+        return catalog
+
+    with catalog_lock(root):
+        catalog = _read_catalog(root)
+        if catalog is None:
+            catalog = _bootstrap_catalog(root)
+            _write_catalog(catalog, root)
+    return catalog
+
+
+def _segment_entry(manifest: Dict[str, Any], created: float) -> Dict[str, Any]:
+    entry = {
+        "id": manifest["segment_id"],
+        "dir": segment_dir_name(manifest["segment_id"]),
+        "chunks": manifest["chunks"],
+        "created": created,
+    }
+    if manifest.get("partition"):
+        entry["partition"] = manifest["partition"]
+    if "emails" in manifest:
+        entry["accounts"] = sorted({e["account"] for e in manifest["emails"].values() if e.get("account")})
+    return entry
+
+
+def segment_dirs(root: Path, catalog: Optional[Dict[str, Any]] = None,
+                 partitions: Optional[Iterable[str]] = None,
+                 accounts: Optional[Iterable[str]] = None) -> List[Path]:
+    # With `partitions`, only segments in those partitions are returned, plus
+    # any not yet partitioned (their dates are unknown to the catalogue).
+    # With `accounts`, only segments holding mail of one of those accounts;
+    # segments with no recorded accounts may belong to anyone and are left
+    # out.
+    catalog = catalog if catalog is not None else load_catalog(root)
+    segments = catalog["segments"]
+    if partitions is not None:
+        wanted = set(partitions)
+        segments = [seg for seg in segments if seg.get("partition") is None or seg["partition"] in wanted]
+    if accounts is not None:
+        owners = set(accounts)
+        segments = [seg for seg in segments if owners.intersection(seg.get("accounts", ()))]
+    return [root / seg["dir"] for seg in segments]
+
+
+def email_key(email: Dict[str, Any]) -> Optional[str]:
+    return scoped_key(email.get("account"), email.get("email_id") or email.get("id"))
+
+
+def account_message_ids(keys: Iterable[str], account: str) -> set:
+    # Bare message ids of `account` among registry keys.
+    prefix = f"{account}#"
+    return {k[len(prefix):] for k in keys if k.startswith(prefix)}
+
+
+def is_email_indexed(email: Dict[str, Any], catalog: Dict[str, Any]) -> bool:
+    key = email_key(email)
+    return bool(key) and key in catalog["indexed"]["emails"]
+
+
+def indexed_attachment_hashes(catalog: Dict[str, Any]) -> set:
+    return set(catalog["indexed"]["attachments"])
+
+
+def filter_unindexed(emails: Iterable[Dict[str, Any]], catalog: Dict[str, Any]) -> List[Dict[str, Any]]:
+    seen = set()
+    fresh = []
+    for email in emails:
+        key = email_key(email)
+        if is_email_indexed(email, catalog) or (key and key in seen):
+            continue
+        if key:
+            seen.add(key)
+        fresh.append(email)
+    return fresh
+
+
+def commit_segment(root: Path, manifest: Optional[Dict[str, Any]], email_ids: Iterable[str],
+                   attachment_hashes: Iterable[str],
+                   attachment_refs: Optional[Dict[str, Iterable[str]]] = None) -> Dict[str, Any]:
+    # Publishes a fully written segment and records its emails/attachments as
+    # indexed. A manifest with no chunks only updates the indexed registry.
+    # `attachment_refs` maps each email to every attachment hash it carries,
+    # extracted or skipped as a copy, so deletes know who else holds a PDF.
+    with catalog_lock(root):
+        catalog = _read_catalog(root) or _bootstrap_catalog(root)
+        segment_id = None
+        if manifest and manifest.get("chunks", 0) > 0:
+            segment_id = manifest["segment_id"]
+            # A catalogue bootstrapped just now has already adopted the
+            # segment from disk.
+            if all(seg["id"] != segment_id for seg in catalog["segments"]):
+                catalog["segments"].append(_segment_entry(manifest, time()))
+        for email_id in email_ids:
+            if email_id:
+                catalog["indexed"]["emails"][email_id] = segment_id
+        for digest in attachment_hashes:
+            if digest:
+                catalog["indexed"]["attachments"][digest] = segment_id
+        refs = catalog["indexed"].setdefault("attachment_refs", {})
+        for email_id, digests in (attachment_refs or {}).items():
+            for digest in set(digests):
+                if digest and email_id:
+                    holders = refs.setdefault(digest, [])
+                    if email_id not in holders:
+                        holders.append(email_id)
+        catalog["generation"] += 1
+        _write_catalog(catalog, root)
+
+    if manifest and segment_id is None and manifest.get("segment_id"):
+        shutil.rmtree(root / segment_dir_name(manifest["segment_id"]), ignore_errors=True)
+    return catalog
+
+
+def replace_segments(root: Path, old_ids: List[str], manifests: List[Dict[str, Any]],
+                     email_segments: Dict[str, str]) -> bool:
+    # Atomically swaps `old_ids` for the rewritten segments in `manifests`;
+    # `email_segments` maps each email kept by the rewrite to its new segment.
+    # Refused (returns False) if any old segment is gone or one of those
+    # emails was re-indexed or removed since the rewrite read it.
+    with catalog_lock(root):
+        catalog = _read_catalog(root) or _bootstrap_catalog(root)
+        live = {seg["id"]: seg for seg in catalog["segments"]}
+        old = set(old_ids)
+        registry = catalog["indexed"]["emails"]
+        if not old.issubset(live) or any(registry.get(e) not in old for e in email_segments if e):
+            return False
+
+        created = max(live[i].get("created", 0) for i in old)
+        new_entries = []
+        for manifest in manifests:
+            entry = _segment_entry(manifest, created)
+            entry["compacted_from"] = sorted(old)
+            new_entries.append(entry)
+
+        position = min(i for i, seg in enumerate(catalog["segments"]) if seg["id"] in old)
+        kept = [seg for seg in catalog["segments"] if seg["id"] not in old]
+        kept[position:position] = new_entries
+        catalog["segments"] = kept
+
+        # Emails without kept chunks and attachments are not tracked per
+        # segment, so they follow the first rewritten segment.
+        fallback = new_entries[0]["id"] if new_entries else None
+        for section in ("emails", "attachments"):
+            entries = catalog["indexed"][section]
+            for key, seg_id in entries.items():
+                if seg_id in old:
+                    entries[key] = email_segments.get(key, fallback) if section == "emails" else fallback
+
+        now = time()
+        catalog.setdefault("retired", []).extend({"dir": live[i]["dir"], "retired_at": now} for i in old_ids)
+        catalog["generation"] += 1
+        _write_catalog(catalog, root)
+    return True
+
+
+def purge_retired(root: Path, grace_seconds: float = RETIRE_GRACE_SECONDS) -> List[str]:
+    removed = []
+    with catalog_lock(root):
+        catalog = _read_catalog(root)
+        if not catalog or not catalog.get("retired"):
+            return removed
+        now = time()
+        still_retired = []
+        for entry in catalog["retired"]:
+            if now - entry["retired_at"] >= grace_seconds:
+                shutil.rmtree(root / entry["dir"], ignore_errors=True)
+                removed.append(entry["dir"])
+            else:
+                still_retired.append(entry)
+        if removed:
+            catalog["retired"] = still_retired
+            _write_catalog(catalog, root)
+    return removed
+
+
+def _segment_emails(root: Path, seg: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    batch_dir = root / seg["dir"]
+    with open(batch_dir / "manifest.json", "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if "emails" in manifest:
+        return manifest["emails"]
+    # Segments written before per-email ranges were recorded.
+    return build_email_index(list(load_chunks(batch_dir)))
+
+
+def _tombstone_emails(root: Path, catalog: Dict[str, Any], email_ids: Iterable[str]):
+    # Drops the emails from the registry and tombstones their chunks; returns
+    # the number of chunks and the attachment hashes whose extracted content
+    # sat among them.
+    registry = catalog["indexed"]["emails"]
+    by_segment: Dict[str, List[str]] = {}
+    for email_id in email_ids:
+        if email_id in registry:
+            seg_id = registry.pop(email_id)
+            if seg_id is not None:
+                by_segment.setdefault(seg_id, []).append(email_id)
+
+    removed_chunks = 0
+    owned = set()
+    for seg in catalog["segments"]:
+        ids = by_segment.get(seg["id"])
+        if not ids:
+            continue
+        emails = _segment_emails(root, seg)
+        positions = []
+        for email_id in ids:
+            entry = emails.get(email_id, {})
+            for start, end in entry.get("ranges", []):
+                positions.extend(range(start, end))
+            owned.update(scoped_key(entry.get("account"), d) for d in entry.get("attachments", []))
+        if positions:
+            seg["deleted"] = add_tombstones(root / seg["dir"], seg["chunks"], positions)
+            removed_chunks += len(positions)
+    return removed_chunks, owned
+
+
+def delete_emails(root: Path, email_ids: Iterable[str]) -> Dict[str, Any]:
+    # Tombstones every chunk of the given emails and drops them from the
+    # indexed registry, so they can be ingested again. Only the segments
+    # holding those emails are touched; compaction later removes the chunks
+    # physically.
+    #
+    # An attachment's text is indexed once, under the first email that
+    # carried it; copies in other emails were skipped. When that email goes
+    # while copies remain, the surviving holders are dropped from the
+    # registry too (and their chunks tombstoned), so the next fetch that
+    # covers them re-ingests one with the attachment's content. A hash is
+    # released only when its content is gone from the index.
+    wanted = {e for e in email_ids if e}
+    removed_chunks = 0
+    requeued = set()
+    with catalog_lock(root):
+        catalog = _read_catalog(root) or _bootstrap_catalog(root)
+        registry = catalog["indexed"]["emails"]
+        attachments = catalog["indexed"]["attachments"]
+        refs = catalog["indexed"].setdefault("attachment_refs", {})
+
+        done = set()
+        pending = set(wanted)
+        while pending:
+            done |= pending
+            chunks, owned = _tombstone_emails(root, catalog, pending)
+            removed_chunks += chunks
+            for digest in list(refs):
+                holders = [e for e in refs[digest] if e not in done]
+                if holders:
+                    refs[digest] = holders
+                else:
+                    del refs[digest]
+            pending = set()
+            for digest in owned:
+                attachments.pop(digest, None)
+                survivors = [e for e in refs.pop(digest, []) if e in registry and e not in done]
+                requeued.update(survivors)
+                pending.update(survivors)
+
+        catalog["generation"] += 1
+        _write_catalog(catalog, root)
+    return {"emails": len(wanted), "chunks": removed_chunks, "requeued": len(requeued)}
+
+
+def _account_emails(root: Path, account: str, catalog: Dict[str, Any]):
+    # (live emails of `account`, live emails with no recorded account).
+    # Segments written before chunks carried their account cannot be
+    # attributed to one.
+    registry = catalog["indexed"]["emails"]
+    found, unattributed = [], 0
+    for seg in catalog["segments"]:
+        for email_id, entry in _segment_emails(root, seg).items():
+            if registry.get(email_id) != seg["id"]:
+                continue
+            if entry.get("account") == account:
+                found.append(email_id)
+            elif not entry.get("account"):
+                unattributed += 1
+    return found, unattributed
+
+
+def emails_for_account(root: Path, account: str, catalog: Optional[Dict[str, Any]] = None) -> List[str]:
+    catalog = catalog if catalog is not None else load_catalog(root)
+    return _account_emails(root, account, catalog)[0]
+
+
+def delete_account(root: Path, account: str) -> Dict[str, Any]:
+    # "unattributed" counts indexed emails with no account on record (older
+    # segments); they are left in place since they may belong to anyone.
+    found, unattributed = _account_emails(root, account, load_catalog(root))
+    result = delete_emails(root, found)
+    result["unattributed"] = unattributed
+    return result
@@ -1,13 +1,15 @@
 import pandas as pd
 from typing import List, Set, Dict, Any, Tuple
 from datetime import datetime
-import google.generativeai as genai
 import json
 import os
 from pydantic import BaseModel
 from typing import Optional
 from typing import List
 from dotenv import load_dotenv
+from app.gmail_utils import DATE_FORMATS
+from app.llm_cache import LLM_CACHE
+from app.llm_utils import generate_cached
 load_dotenv()
 
 class Transaction(BaseModel):
@@ -20,12 +22,8 @@ class Transaction(BaseModel):
 
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
-DATE_FORMATS = [
-    "%m/%d/%Y", "%Y-%m-%d", "%m-%d-%Y", "%d/%m/%Y", "%Y/%m/%d",
-    "%b %d, %Y", "%d %b %Y", "%m/%d/%y", "%d/%m/%y"
-]
+COLUMN_MAP_MODEL="gemini-2.0-flash-exp"
 
 class TransactionCleaner:
     def __init__(self):
@@ -116,9 +114,8 @@ Example:
 }}
 """
         try:
-            model=genai.GenerativeModel("gemini-2.0-flash-exp")
-            response=model.generate_content(prompt)
-            response_json=response.text.strip()
+            response_json,cached=generate_cached(COLUMN_MAP_MODEL,prompt)
+            raw_response=response_json
 
             if response_json.startswith("```json"):
                 lines=response_json.split("\n")
@@ -126,6 +123,8 @@ Example:
                 response_json=response_json.replace("```json","").replace("```","").strip()
 
             mapping=json.loads(response_json)
+            if not cached:
+                LLM_CACHE.put(COLUMN_MAP_MODEL,prompt,raw_response)
 
             max_idx=len(column_info)-1
             for key,value in mapping.items():
@@ -0,0 +1,108 @@
+import os
+import re
+import subprocess
+import sys
+import threading
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+
+# Load the models right after startup rather than on the first /process.
+# Either way the API accepts requests before they are loaded.
+WARMUP_MODELS = os.getenv("WARMUP_MODELS", "0") == "1"
+
+_IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+_maintenance_thread: Optional[threading.Thread] = None
+
+
+def warm_up() -> Dict[str, float]:
+    # Imports the search pipeline and loads both models, running one input
+    # through each so first-request latency does not include it.
+    timings: Dict[str, float] = {}
+    t0 = perf_counter()
+    from app.inference import get_embedder, get_reranker
+    import app.rag_pipeline  # noqa: F401
+    timings["pipeline_import_s"] = perf_counter() - t0
+    t0 = perf_counter()
+    get_embedder().encode(["warm up"], convert_to_numpy=True, normalize_embeddings=True)
+    timings["embedder_s"] = perf_counter() - t0
+    t0 = perf_counter()
+    get_reranker().predict([("warm up", "warm up")])
+    timings["reranker_s"] = perf_counter() - t0
+    print("Warm-up: " + ", ".join(f"{k}={v:.2f}" for k, v in timings.items()))
+    return timings
+
+
+def _start_maintenance(warm: bool):
+    try:
+        from app.rag_pipeline import QUERY_EMBEDDINGS
+        from app.compaction import start_background_compaction
+        QUERY_EMBEDDINGS.load()
+        start_background_compaction()
+        if warm:
+            warm_up()
+    except Exception as e:
+        print(f"Index maintenance failed to start: {e}")
+
+
+def start_index_maintenance(warm: bool = WARMUP_MODELS) -> threading.Thread:
+    # Heavy imports happen on this thread so the server starts serving at once.
+    global _maintenance_thread
+    _maintenance_thread = threading.Thread(target=_start_maintenance, args=(warm,),
+                                           name="index-maintenance-start", daemon=True)
+    _maintenance_thread.start()
+    return _maintenance_thread
+
+
+def stop_index_maintenance():
+    # Only touches modules that were actually loaded.
+    if _maintenance_thread is not None:
+        _maintenance_thread.join()
+    if "app.compaction" in sys.modules:
+        sys.modules["app.compaction"].stop_background_compaction()
+    if "app.inference" in sys.modules:
+        sys.modules["app.inference"].shutdown_embed_pool()
+    if "app.rag_pipeline" in sys.modules:
+        sys.modules["app.rag_pipeline"].QUERY_EMBEDDINGS.save()
+    if "app.llm_cache" in sys.modules:
+        sys.modules["app.llm_cache"].LLM_CACHE.close()
+
+
+def import_time_report(module: str = "app.main", top: int = 15) -> List[Tuple[str, float]]:
+    # Imports `module` in a fresh interpreter under -X importtime; returns
+    # (package, cumulative seconds) for the slowest top-level imports.
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True)
+    # Output is post-order: a module's direct imports (one level deeper)
+    # are listed just before it.
+    timings: Dict[str, float] = {}
+    children: Dict[str, float] = {}
+    total = 0.0
+    for line in proc.stderr.splitlines():
+        m = _IMPORT_TIME_LINE.match(line)
+        if not m:
+            continue
+        cumulative = int(m.group(2)) / 1e6
+        level = (len(m.group(3)) - 1) // 2
+        name = m.group(4)
+        if level == 1:
+            children[name] = children.get(name, 0.0) + cumulative
+        elif level == 0:
+            if name == module:
+                timings, total = children, cumulative
+            children = {}
+    if proc.returncode != 0:
+        print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"import {module} failed")
+    ranked = sorted(timings.items(), key=lambda kv: kv[1], reverse=True)
+    print(f"import {module}: {total:.3f}s")
+    for name, seconds in ranked[:top]:
+        print(f"  {name:<32} {seconds:.3f}s")
+    return ranked[:top]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "warm":
+        warm_up()
+    else:
+        import_time_report(sys.argv[1] if len(sys.argv) > 1 else "app.main")
@@ -0,0 +1,367 @@
+import math
+import os
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+import faiss
+
+
+# "auto" picks the index type from the vector count; "flat", "hnsw",
+# "ivf_flat" and "ivf_pq" force one.
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+FLAT_MAX_VECTORS = 10_000
+HNSW_MAX_VECTORS = 100_000
+IVF_FLAT_MAX_VECTORS = 1_000_000
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+PQ_BITS = 8
+# Each IVF list needs ~39 training points per centroid to train well.
+IVF_MIN_TRAIN_PER_LIST = 39
+MAX_TRAIN_VECTORS = 256 * 1024
+
+# Stored codes: "none" (float32), "fp16" or "sq8" (8-bit scalar quantization).
+# IVF-PQ is compressed by construction and ignores this.
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", "none")
+# Optional PCA projection (e.g. 384 -> 128), fit once per corpus and stored
+# next to the segments. 0 disables it.
+VECTOR_PCA_DIM = int(os.getenv("VECTOR_PCA_DIM", "0"))
+PCA_MIN_TRAIN = 1000
+PCA_FILE = "pca_{dim}.vt"
+
+# sq8/PQ and PCA-projected indexes only shortlist; exact scores come from a
+# side copy of the vectors, kept at half precision (~1e-3 score error, well
+# under the quantization error it corrects). The copy costs 2 bytes per
+# dimension on disk and is always written for lossy indexes, since compaction
+# rebuilds segments from it rather than re-quantizing reconstructed codes;
+# VECTOR_RESCORE=0 only stops searches from using it.
+VECTOR_RESCORE = os.getenv("VECTOR_RESCORE", "1") == "1"
+RESCORE_DTYPE = "float16"
+
+_SQ_TYPES = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "sq8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+RECALL_TARGET = 0.95
+RECALL_K = 10
+RECALL_SAMPLE = 200
+# Noise added to stored vectors to make stand-in queries: each ends up near
+# cosine 0.6 to its source, about as close as a transaction query gets to
+# its best chunk, so no query is guaranteed to find itself first.
+RECALL_QUERY_NOISE = 0.07
+MAX_NPROBE = 256
+MAX_EF_SEARCH = 1024
+
+
+def choose_index_type(n_vectors: int) -> str:
+    if n_vectors <= FLAT_MAX_VECTORS:
+        return "flat"
+    if n_vectors <= HNSW_MAX_VECTORS:
+        return "hnsw"
+    if n_vectors <= IVF_FLAT_MAX_VECTORS:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def _nlist_for(n_vectors: int) -> int:
+    nlist = int(4 * math.sqrt(n_vectors))
+    return max(1, min(nlist, n_vectors // IVF_MIN_TRAIN_PER_LIST))
+
+
+def _pq_subquantizers(dim: int) -> int:
+    # 8-dim sub-vectors; PQ needs the dimension to be a multiple of m.
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def _train_sample(embeddings: np.ndarray) -> np.ndarray:
+    if len(embeddings) <= MAX_TRAIN_VECTORS:
+        return embeddings
+    rng = np.random.default_rng(0)
+    return embeddings[rng.choice(len(embeddings), MAX_TRAIN_VECTORS, replace=False)]
+
+
+def _base_index(index):
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def is_lossy(params: Optional[Dict[str, Any]]) -> bool:
+    # Indexes coarser than the half-precision copy (8-bit or PQ codes, or
+    # PCA-projected); float32 and fp16 codes are already as exact as the copy
+    # would be.
+    params = params or {}
+    return params.get("compression", "none") not in ("none", "fp16") or bool(params.get("pca_dim"))
+
+
+def needs_rescoring(params: Optional[Dict[str, Any]]) -> bool:
+    return VECTOR_RESCORE and is_lossy(params)
+
+
+def apply_search_params(index, params: Optional[Dict[str, Any]]):
+    if not params:
+        return index
+    if params.get("nprobe"):
+        faiss.extract_index_ivf(index).nprobe = int(params["nprobe"])
+    if params.get("efSearch"):
+        _base_index(index).hnsw.efSearch = int(params["efSearch"])
+    return index
+
+
+def fit_pca(vectors: np.ndarray, dim: int):
+    pca = faiss.PCAMatrix(vectors.shape[1], dim)
+    pca.train(vectors)
+    # Drop the mean shift: a pure projection keeps inner products (cosine on
+    # normalized embeddings) comparable, centring would not.
+    faiss.copy_array_to_vector(np.zeros(dim, dtype="float32"), pca.b)
+    return pca
+
+
+def load_or_fit_pca(storage_root: Path, embeddings: np.ndarray, dim: int = VECTOR_PCA_DIM):
+    # One projection per corpus, so every segment (and every query) lives in
+    # the same reduced space. Until enough vectors exist to fit it, segments
+    # are written unprojected.
+    if not dim or dim >= embeddings.shape[1]:
+        return None
+    path = storage_root / PCA_FILE.format(dim=dim)
+    if path.exists():
+        return faiss.read_VectorTransform(str(path))
+    if len(embeddings) < PCA_MIN_TRAIN:
+        return None
+    pca = fit_pca(_train_sample(embeddings), dim)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    faiss.write_VectorTransform(pca, str(tmp))
+    os.replace(tmp, path)
+    return pca
+
+
+def recall_queries(embeddings: np.ndarray, queries: Optional[np.ndarray] = None,
+                   sample: int = RECALL_SAMPLE) -> np.ndarray:
+    # Queries to tune on: real (cached) query embeddings when given, topped up
+    # with perturbed copies of sampled stored vectors. The stored vectors
+    # themselves would each find themselves first and overstate recall.
+    rng = np.random.default_rng(0)
+    real = np.zeros((0, embeddings.shape[1]), dtype="float32")
+    if queries is not None and len(queries) and queries.shape[1] == embeddings.shape[1]:
+        real = np.asarray(queries, dtype="float32")
+        if len(real) > sample:
+            real = real[rng.choice(len(real), sample, replace=False)]
+    need = sample - len(real)
+    if need <= 0:
+        return np.ascontiguousarray(real)
+    synthetic = embeddings[rng.choice(len(embeddings), need, replace=len(embeddings) < need)]
+    synthetic = synthetic + RECALL_QUERY_NOISE * rng.standard_normal(synthetic.shape).astype("float32")
+    synthetic /= np.linalg.norm(synthetic, axis=1, keepdims=True)
+    return np.ascontiguousarray(np.vstack([real, synthetic]), dtype="float32")
+
+
+def measure_recall(index, embeddings: np.ndarray, queries: np.ndarray, k: int = RECALL_K) -> float:
+    # recall@k of `index` against exact inner-product search over `embeddings`.
+    k = min(k, len(embeddings))
+    exact = faiss.IndexFlatIP(embeddings.shape[1])
+    exact.add(embeddings)
+    _, truth = exact.search(queries, k)
+    _, approx = index.search(queries, k)
+    hits = sum(len(set(t) & set(a)) for t, a in zip(truth, approx))
+    return hits / float(truth.size)
+
+
+def _tune(index, embeddings: np.ndarray, queries: np.ndarray, params: Dict[str, Any], key: str,
+          limit: int) -> Dict[str, Any]:
+    # Doubles nprobe/efSearch until the recall target is met or the limit hit.
+    while True:
+        apply_search_params(index, params)
+        params["recall"] = round(measure_recall(index, embeddings, queries), 4)
+        if params["recall"] >= RECALL_TARGET or params[key] >= limit:
+            return params
+        params[key] = min(limit, params[key] * 2)
+
+
+def build_index(embeddings: np.ndarray, index_type: Optional[str] = None, compression: Optional[str] = None,
+                pca=None, queries: Optional[np.ndarray] = None) -> Tuple[Any, Dict[str, Any]]:
+    # `queries`: real query embeddings to tune search parameters on, if any.
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    n = len(embeddings)
+    index_type = index_type or FAISS_INDEX_TYPE
+    if index_type == "auto":
+        index_type = choose_index_type(n)
+    compression = compression or VECTOR_COMPRESSION
+    if compression != "none" and compression not in _SQ_TYPES:
+        raise ValueError(f"Unknown vector compression: {compression}")
+    if index_type == "ivf_pq":
+        compression = "pq"
+    params: Dict[str, Any] = {"type": index_type, "compression": compression}
+
+    vectors = embeddings
+    if pca is not None:
+        vectors = pca.apply(embeddings)
+        params["pca_dim"] = pca.d_out
+    dim = vectors.shape[1]
+    qtype = _SQ_TYPES.get(compression)
+
+    if index_type == "flat":
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT) if qtype is not None else faiss.IndexFlatIP(dim)
+    elif index_type == "hnsw":
+        if qtype is not None:
+            index = faiss.IndexHNSWSQ(dim, qtype, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        params["efSearch"] = HNSW_EF_SEARCH
+    else:
+        nlist = _nlist_for(n)
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat" and qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivf_pq":
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_subquantizers(dim), PQ_BITS, faiss.METRIC_INNER_PRODUCT)
+        else:
+            raise ValueError(f"Unknown FAISS index type: {index_type}")
+        params.update({"nlist": nlist, "nprobe": max(1, nlist // 32)})
+
+    if not index.is_trained:
+        index.train(_train_sample(vectors))
+    index.add(vectors)
+    if pca is not None:
+        index = faiss.IndexPreTransform(pca, index)
+
+    # Recall is measured on the original vectors, so it covers PCA and
+    # quantization loss as well as the approximate search.
+    if "efSearch" in params or "nprobe" in params or compression != "none" or pca is not None:
+        queries = recall_queries(embeddings, queries)
+    if "efSearch" in params:
+        return index, _tune(index, embeddings, queries, params, "efSearch", MAX_EF_SEARCH)
+    if "nprobe" in params:
+        return index, _tune(index, embeddings, queries, params, "nprobe", min(MAX_NPROBE, params["nlist"]))
+    if compression != "none" or pca is not None:
+        apply_search_params(index, params)
+        params["recall"] = round(measure_recall(index, embeddings, queries), 4)
+    return index, params
+
+
+def rescore(vectors: np.ndarray, query: np.ndarray, ids) -> Dict[int, float]:
+    # Exact inner products for a handful of candidate rows; `vectors` is
+    # usually a memory-mapped embeddings.npy, so only those rows are read.
+    ids = [int(i) for i in ids if i is not None and i >= 0]
+    if not ids:
+        return {}
+    rows = np.asarray(vectors[sorted(ids)], dtype="float32")
+    scores = rows @ np.asarray(query, dtype="float32").reshape(-1)
+    return dict(zip(sorted(ids), (float(x) for x in scores)))
+
+
+def benchmark_compression(storage_root: Path, k: int = 60, final_k: int = 20, queries_per_segment: int = 100):
+    # Ranking drift of each compression setting against float32 flat search on
+    # the stored segment vectors: overlap of the top-`final_k` ids, the largest
+    # score gap at any rank (ties between duplicate chunks make id overlap < 1
+    # even for float32), and disk bytes per vector (the shared PCA matrix
+    # excluded). Lossy settings are shown with the top-`k` candidates rescored
+    # from the half-precision copy (its bytes included) and without it.
+    settings = [("none", 0), ("fp16", 0), ("sq8", 0), ("none", 128), ("fp16", 128), ("sq8", 128)]
+    segment_vectors = []
+    for path in sorted(storage_root.glob("*/faiss.index")):
+        if (path.parent / "embeddings.npy").exists():
+            segment_vectors.append(np.load(path.parent / "embeddings.npy").astype("float32"))
+        else:
+            index = faiss.read_index(str(path))
+            ivf = faiss.try_extract_index_ivf(index)
+            if ivf is not None:
+                ivf.make_direct_map()
+            segment_vectors.append(index.reconstruct_n(0, index.ntotal))
+    if not segment_vectors:
+        print(f"No segments under {storage_root}")
+        return
+    corpus = np.vstack(segment_vectors)
+
+    for compression, pca_dim in settings:
+        pca = None
+        if pca_dim:
+            if len(corpus) <= pca_dim:
+                continue
+            pca = fit_pca(corpus, pca_dim)
+        lossy = is_lossy({"compression": compression, "pca_dim": pca_dim})
+        for rescored in ((True, False) if lossy else (False,)):
+            rng = np.random.default_rng(0)
+            overlap, total, bytes_per_vec, gaps = 0, 0, [], []
+            for vectors in segment_vectors:
+                if len(vectors) <= final_k:
+                    continue
+                exact = faiss.IndexFlatIP(vectors.shape[1])
+                exact.add(vectors)
+                index, _ = build_index(vectors, "flat", compression, pca)
+                side = vectors.shape[1] * np.dtype(RESCORE_DTYPE).itemsize if lossy else 0
+                bytes_per_vec.append(len(faiss.serialize_index(_base_index(index))) / len(vectors) + side)
+                stored = vectors.astype(RESCORE_DTYPE)
+
+                # Perturbed stored vectors stand in for queries near real chunks.
+                queries = vectors[rng.choice(len(vectors), min(queries_per_segment, len(vectors)), replace=False)]
+                queries = queries + 0.05 * rng.standard_normal(queries.shape).astype("float32")
+                queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+                truth_scores, truth = exact.search(queries, final_k)
+                approx_scores, approx = index.search(queries, min(k if rescored else final_k, len(vectors)))
+                for q, t, ts, a, s in zip(queries, truth, truth_scores, approx, approx_scores):
+                    scores = rescore(stored, q, a) if rescored else dict(zip(a.tolist(), s.tolist()))
+                    top = sorted(scores, key=scores.get, reverse=True)[:final_k]
+                    overlap += len(set(t) & set(top))
+                    total += final_k
+                    got = np.array([scores[i] for i in top] + [0.0] * (final_k - len(top)))
+                    gaps.append(float(np.max(np.abs(ts - got))))
+            print(f"compression={compression:<5} pca={pca_dim or '-':<4} rescore={'fp16' if rescored else '-':<4} "
+                  f"top{final_k}_overlap={overlap / max(1, total):.4f} max_score_gap={np.max(gaps):.4f} "
+                  f"disk_bytes/vector={np.mean(bytes_per_vec):.0f}")
+
+
+def segment_disk_usage(storage_root: Path) -> Dict[str, Any]:
+    # Actual bytes on disk for the vector side of each segment (FAISS index
+    # plus any rescoring copy), per segment and per stored vector.
+    per_segment = {}
+    total_bytes = total_vectors = 0
+    for path in sorted(storage_root.glob("*/faiss.index")):
+        side = path.parent / "embeddings.npy"
+        size = path.stat().st_size + (side.stat().st_size if side.exists() else 0)
+        ntotal = faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY).ntotal
+        per_segment[path.parent.name] = {"bytes": size, "vectors": ntotal,
+                                         "bytes_per_vector": round(size / ntotal, 1) if ntotal else 0.0}
+        total_bytes += size
+        total_vectors += ntotal
+    return {"segments": per_segment, "bytes": total_bytes, "vectors": total_vectors,
+            "bytes_per_vector": round(total_bytes / total_vectors, 1) if total_vectors else 0.0}
+
+
+if __name__ == "__main__":
+    import sys
+    from time import perf_counter
+
+    if len(sys.argv) > 1 and sys.argv[1] == "drift":
+        benchmark_compression(Path(sys.argv[2] if len(sys.argv) > 2 else "storage"))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "disk":
+        usage = segment_disk_usage(Path(sys.argv[2] if len(sys.argv) > 2 else "storage"))
+        for name, seg in usage["segments"].items():
+            print(f"{name}: {seg['bytes']} bytes, {seg['vectors']} vectors, {seg['bytes_per_vector']} bytes/vector")
+        print(f"total: {usage['bytes']} bytes, {usage['bytes_per_vector']} bytes/vector")
+        sys.exit(0)
+
+    rng = np.random.default_rng(1)
+    for n in (5_000, 50_000, 200_000):
+        # Clustered vectors, closer to sentence embeddings than uniform noise.
+        centers = rng.standard_normal((256, 384)).astype("float32")
+        data = centers[rng.integers(0, 256, n)] + 0.5 * rng.standard_normal((n, 384)).astype("float32")
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+        t0 = perf_counter()
+        index, params = build_index(data)
+        build_s = perf_counter() - t0
+        queries = data[:500]
+        t0 = perf_counter()
+        index.search(queries, 60)
+        search_ms = (perf_counter() - t0) / len(queries) * 1000
+        print(f"n={n} {params} build={build_s:.1f}s search={search_ms:.3f}ms/query")
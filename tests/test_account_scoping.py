@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from app import ingest_pipeline, rag_pipeline
+from app.ingest_pipeline import IngestPipeline
+from app.rag_pipeline import csv_row_to_enhanced_query, global_search
+from app.segments import email_key, load_catalog, segment_dirs
+
+ALICE = "alice@example.com (gmail)"
+BOB = "bob@example.com (gmail)"
+DIM = 384
+
+
+def _vectors(n, seed=0):
+    v = np.random.default_rng(seed).standard_normal((n, DIM)).astype("float32")
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def _email(account, i):
+    # Both mailboxes hold a message with the same id and the same invoice.
+    return {"id": f"msg{i}", "account": account, "from": "billing@acme.com", "subject": f"Invoice INV-{100 + i}",
+            "body": f"Acme invoice INV-{100 + i}. Total due $1,234.56", "date": "2024-03-05", "attachments": []}
+
+
+@pytest.fixture
+def index_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_pipeline, "build_embeddings", lambda chunks: _vectors(len(chunks), len(chunks)))
+    monkeypatch.setattr(rag_pipeline, "embed_queries", lambda texts: _vectors(len(texts), 99))
+    emails = [_email(account, i) for account in (ALICE, BOB) for i in range(3)]
+    IngestPipeline(batch_size=10, storage_root=tmp_path, extract_workers=1).run(iter(emails))
+    return tmp_path
+
+
+def test_same_message_id_is_indexed_per_account(index_root):
+    registry = load_catalog(index_root)["indexed"]["emails"]
+    assert email_key(_email(ALICE, 0)) in registry
+    assert email_key(_email(BOB, 0)) in registry
+    assert email_key(_email(ALICE, 0)) != email_key(_email(BOB, 0))
+
+
+def test_segments_hold_one_account(index_root):
+    catalog = load_catalog(index_root)
+    assert sorted(seg["accounts"] for seg in catalog["segments"]) == [[ALICE], [BOB]]
+    assert len(segment_dirs(index_root, catalog, accounts=[ALICE])) == 1
+    assert segment_dirs(index_root, catalog, accounts=[]) == []
+
+
+def test_search_returns_only_selected_accounts(index_root):
+    query = csv_row_to_enhanced_query({"amount": "1234.56", "vendor_name": "Acme", "date": "2024-03-05"})
+    for account in (ALICE, BOB):
+        dirs = segment_dirs(index_root, accounts=[account])
+        results = global_search(query, dirs, top_k=10, rerank=False, accounts=[account])
+        assert results
+        assert {r["chunk"]["metadata"]["account"] for r in results} == {account}
+
+    # Even handed every segment, the search drops other mailboxes' chunks.
+    results = global_search(query, segment_dirs(index_root), top_k=10, rerank=False, accounts=[ALICE])
+    assert {r["chunk"]["metadata"]["account"] for r in results} == {ALICE}
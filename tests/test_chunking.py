@@ -0,0 +1,61 @@
+import random
+import re
+
+import pytest
+
+pytest.importorskip("langchain_text_splitters")
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from app.chunking import CHUNK_OVERLAP, CHUNK_SIZE, SEPARATORS, normalize_amount, split_with_amounts
+
+# The three regex passes chunks were tagged with before the single-pass scan.
+LEGACY_PATTERNS = [
+    r'\$\s*[\d,]+\.?\d*',
+    r'[\d,]+\.?\d*\s*(?:USD|EUR|GBP|dollars?)',
+    r'(?:total|amount|sum|price|cost|invoice)[\s:]+\$?\s*[\d,]+\.?\d*',
+]
+WORDS = ["invoice", "total", "amount", "due", "Acme", "payment", "USD", "$1,234.56", "99 dollars", "12.50 EUR",
+         "price: 40", "cost 7", "the", "of", "order", "INV-2024-001", "sum", "$ 5"]
+
+
+def _legacy_amounts(text):
+    amounts = []
+    for pattern in LEGACY_PATTERNS:
+        for match in re.finditer(pattern, text, re.IGNORECASE):
+            amount = normalize_amount(match.group())
+            if amount:
+                amounts.append(amount)
+    return amounts
+
+
+def _corpus():
+    rng = random.Random(0)
+    texts = [
+        # Amounts cut by a chunk edge, under the default separators and with
+        # only character splits left.
+        ("a" * 700 + " total 1234") + ". " + "b" * 500 + ". " + "c" * 500,
+        "x" * 995 + "$1,234.56 and total 99 " + "y" * 990 + "$77 " + "z" * 20,
+        "amount 12,345.67 USD " * 150,
+        "",
+        "short invoice total $5",
+    ]
+    for _ in range(150):
+        parts = []
+        for _ in range(rng.randint(20, 900)):
+            parts.append(rng.choice(WORDS))
+            parts.append(rng.choice([" ", " ", " ", "\n", "\n\n", ". ", ""]))
+        texts.append("".join(parts))
+    return texts
+
+
+@pytest.mark.parametrize("separators", [SEPARATORS, [""]])
+def test_matches_langchain_splitter(separators):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                              length_function=len, separators=separators, is_separator_regex=False)
+    for text in _corpus():
+        expected = splitter.split_text(text)
+        chunks = split_with_amounts(text, separators=separators)
+        assert [c for c, _ in chunks] == expected
+        for chunk, amounts in chunks:
+            assert amounts == _legacy_amounts(chunk), chunk
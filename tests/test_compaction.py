@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from app import vector_index
+from app.compaction import compact_once
+from app.rag_pipeline import load_embeddings, write_batch
+from app.segments import commit_segment, load_catalog, segment_dir_name
+
+ACCOUNT = "alice@example.com (gmail)"
+
+
+def _segment(root, n, seed):
+    v = np.random.default_rng(seed).standard_normal((n, 384)).astype("float32")
+    v /= np.linalg.norm(v, axis=1, keepdims=True)
+    chunks = [{"content": f"chunk {seed}-{i}", "type": "text", "amounts": [],
+               "metadata": {"email_id": f"m{seed}-{i}", "account": ACCOUNT, "date": "2024-03-05",
+                            "pdf_name": "Email Content"}} for i in range(n)]
+    manifest = write_batch(f"s{seed}", chunks, v, storage_root=root, partition="2024-03")
+    commit_segment(root, manifest, [f"{ACCOUNT}#m{seed}-{i}" for i in range(n)], [])
+    return manifest, v
+
+
+def test_lossy_segments_keep_exact_vectors(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "VECTOR_COMPRESSION", "sq8")
+    monkeypatch.setattr(vector_index, "VECTOR_RESCORE", False)
+    manifest, v = _segment(tmp_path, 50, 1)
+    batch_dir = tmp_path / segment_dir_name(manifest["segment_id"])
+    assert (batch_dir / "embeddings.npy").exists()
+    assert np.allclose(load_embeddings(batch_dir), v, atol=1e-3)
+
+
+def test_lossy_segments_without_copy_are_not_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "VECTOR_COMPRESSION", "sq8")
+    dirs = []
+    for seed in (1, 2):
+        manifest, _ = _segment(tmp_path, 20, seed)
+        dirs.append(tmp_path / segment_dir_name(manifest["segment_id"]))
+    # As written with VECTOR_RESCORE=0 before the copy was always kept.
+    (dirs[0] / "embeddings.npy").unlink()
+
+    before = {seg["id"] for seg in load_catalog(tmp_path)["segments"]}
+    assert compact_once(tmp_path) == []
+    assert {seg["id"] for seg in load_catalog(tmp_path)["segments"]} == before
+
+    # With both copies present the two small segments are merged.
+    np.save(dirs[0] / "embeddings.npy", np.zeros((20, 384), dtype="float16"))
+    assert len(compact_once(tmp_path)) == 1
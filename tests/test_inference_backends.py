@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+
+from app.inference import compare_on_texts
+
+
+# (minimum embedding cosine to torch, minimum rerank top-1 agreement).
+# fp32 runtimes must match torch to rounding; dynamic int8 quantization is
+# allowed a little drift in the vectors but should still pick the same best
+# chunk for nearly every query.
+THRESHOLDS = {
+    "onnx": (0.999, 0.98),
+    "onnx-int8": (0.95, 0.9),
+    "openvino": (0.999, 0.98),
+}
+RUNTIMES = {
+    "onnx": ("onnxruntime", "optimum.onnxruntime"),
+    "onnx-int8": ("onnxruntime", "optimum.onnxruntime"),
+    "openvino": ("openvino", "optimum.intel"),
+}
+
+VENDORS = ["Amazon", "Shell", "Uber", "Walmart", "Delta Air Lines", "Staples", "Adobe", "Comcast"]
+ITEMS = ["office supplies", "fuel", "ride to the airport", "software subscription", "flight change fee",
+         "printer toner", "internet service", "team lunch"]
+
+
+def _texts():
+    texts = []
+    for i in range(60):
+        vendor = VENDORS[i % len(VENDORS)]
+        item = ITEMS[(i * 3) % len(ITEMS)]
+        texts.append(f"{vendor} invoice INV-{1000 + i} for {item}. Total amount due ${(i + 1) * 17.35:.2f} "
+                     f"by 2024-{(i % 12) + 1:02d}-15. Thank you for your business.")
+    return texts
+
+
+@pytest.mark.parametrize("backend", sorted(THRESHOLDS))
+def test_backend_matches_torch(backend):
+    for module in RUNTIMES[backend]:
+        pytest.importorskip(module)
+    try:
+        report = compare_on_texts(_texts(), backend)
+    except OSError as e:
+        pytest.skip(f"models not available: {e}")
+
+    min_cosine, min_top1 = THRESHOLDS[backend]
+    assert report["embedding_cosine_min"] >= min_cosine, report
+    assert report["rerank_top1_agreement"] >= min_top1, report
@@ -0,0 +1,112 @@
+import random
+import re
+
+import pytest
+
+from app.gmail_utils import parse_date_dynamic
+from app.matching_engine import (EmailFeatures, extract_amounts, extract_domain, filter_emails, make_aware,
+                                 normalize_text, statement_patterns)
+
+VENDORS = ["amazon", "stripe", "acme corp", "globex", "initech"]
+AMOUNTS = [12.5, 99.99, 100, 250.0, 1234.56, 13.0, 17.49]
+
+
+def _baseline_filter_emails(txn, emails, date_window=3, min_matches=1):
+    # The per-email scoring loop filter_emails replaced, minus its logging.
+    vendor_name = normalize_text(txn.get("vendor_name", "") or txn.get("Vendor", "") or txn.get("VendorName", ""))
+    vendor_domain = (txn.get("Vendor", "") or txn.get("Vendor Domain", "")).lower()
+    description = normalize_text(txn.get("description", "") or txn.get("Memo", ""))
+    invoice_number = str(txn.get("transaction_id", "") or txn.get("Invoice Number", "") or txn.get("TransactionID", "")).strip().upper()
+    txn_amount = float(txn.get("amount", 0))
+    txn_date = make_aware(parse_date_dynamic(txn.get("date") or txn.get("Date", "")))
+
+    filtered = []
+    for email in emails:
+        email_from = str(email.get("from", "")).lower()
+        email_date = make_aware(parse_date_dynamic(email.get("date")))
+        searchable = (f"{email_from} {normalize_text(email.get('subject', ''))} "
+                      f"{normalize_text(email.get('body', ''))} {normalize_text(email.get('snippet', ''))}")
+        score, reasons = 0, []
+
+        if vendor_domain and vendor_domain == extract_domain(email_from):
+            score += 1
+            reasons.append("domain_match")
+        if vendor_name and len(vendor_name) > 3:
+            vendor_core = vendor_name.split()[0] if ' ' in vendor_name else vendor_name
+            if len(vendor_core) > 3 and vendor_core in searchable:
+                score += 1
+                reasons.append(f"vendor:{vendor_core}")
+        if description and len(description) > 5:
+            for word in [w for w in description.split() if len(w) > 4][:3]:
+                if word in searchable:
+                    score += 0.5
+                    reasons.append(f"desc:{word}")
+                    break
+        if invoice_number and len(invoice_number) > 2:
+            if re.search(re.escape(invoice_number), searchable.upper()):
+                score += 3
+                reasons.append("invoice_exact")
+            else:
+                numeric_part = re.search(r'\d{3,}', invoice_number)
+                if numeric_part and numeric_part.group() in searchable:
+                    score += 2
+                    reasons.append(f"invoice_num:{numeric_part.group()}")
+        for amount in extract_amounts(searchable):
+            if abs(amount - txn_amount) <= 0.01:
+                score += 2
+                reasons.append(f"amount_exact:${amount}")
+                break
+            elif abs(amount - txn_amount) <= 5:
+                score += 1
+                reasons.append(f"amount_close:${amount}")
+                break
+        if txn_date and email_date:
+            days_diff = abs((txn_date - email_date).days)
+            if days_diff <= date_window:
+                score += 1
+                reasons.append(f"date_{days_diff}d")
+
+        if score >= min_matches:
+            filtered.append({**email, "filter_score": score, "filter_reasons": reasons})
+    filtered.sort(key=lambda x: x["filter_score"], reverse=True)
+    return filtered
+
+
+def _data(seed=3):
+    rng = random.Random(seed)
+    emails = []
+    for i in range(600):
+        vendor, amount = rng.choice(VENDORS), rng.choice(AMOUNTS)
+        date = rng.choice([f"2024-03-0{rng.randint(1, 9)} 10:{rng.randint(0, 59):02d}:00",
+                           "Mon, 4 Mar 2024 23:30:00 -0500", None, "garbage", 20240305])
+        emails.append({
+            "id": f"m{i}", "from": f"Billing <billing@{vendor.split()[0]}.com>",
+            "subject": f"Invoice INV-{rng.randint(100, 120)} from {vendor}",
+            "body": f"Total ${amount:,} due. payment for consulting services {rng.choice(['hosting', 'widgets', 'software'])}",
+            "snippet": f"amount {amount}", "date": date,
+        })
+    transactions = [{
+        "transaction_id": f"INV-{rng.randint(100, 125)}",
+        "vendor_name": rng.choice(VENDORS + ["Acme Corp Intl", ""]),
+        "Vendor": rng.choice(["amazon.com", "stripe.com", ""]),
+        "description": rng.choice(["Consulting services hosting", "widgets purchase", "x", ""]),
+        "amount": rng.choice(AMOUNTS + [14]),
+        "date": rng.choice(["2024-03-05", "03/04/2024 22:00", "2024-03-01", ""]),
+    } for _ in range(30)]
+    return emails, transactions
+
+
+def _key(results):
+    return [(e["id"], e["filter_score"], type(e["filter_score"]), e["filter_reasons"]) for e in results]
+
+
+@pytest.mark.parametrize("scan", [False, True], ids=["index", "automaton"])
+@pytest.mark.parametrize("min_matches", [1, 3])
+def test_filter_emails_matches_baseline(scan, min_matches):
+    emails, transactions = _data()
+    features = EmailFeatures(emails)
+    if scan:
+        features.scan_patterns(*statement_patterns(transactions))
+    for txn in transactions:
+        expected = _baseline_filter_emails(txn, emails, 3, min_matches)
+        assert _key(filter_emails(txn, emails, 3, min_matches, features)) == _key(expected), txn
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("pdfplumber")
+pytest.importorskip("pypdfium2")
+
+from app.pdf_extraction import extract_pages_from_pdf
+
+ROWS = [["Item", "Amount"], ["Widget", "$100.00"], ["Gadget", "$250.00"]]
+
+
+def _grid_pdf() -> bytes:
+    # One page whose 3x2 table grid is a single path object (every ruling in
+    # one m/l ... S sequence), as many invoice generators draw it.
+    left, top, width, height = 72, 700, 240, 24
+    xs = [left, left + width / 2, left + width]
+    ys = [top - r * height for r in range(len(ROWS) + 1)]
+    path = [f"{xs[0]} {y} m {xs[-1]} {y} l" for y in ys] + [f"{x} {ys[0]} m {x} {ys[-1]} l" for x in xs]
+    ops = ["1 w", " ".join(path), "S", "BT /F1 11 Tf"]
+    for r, row in enumerate(ROWS):
+        for c, cell in enumerate(row):
+            ops.append(f"1 0 0 1 {xs[c] + 6} {ys[r] - 16} Tm ({cell}) Tj")
+    ops.append("ET")
+    ops.append("BT /F1 10 Tf 1 0 0 1 72 600 Tm (Thank you for your business. Payment is due within thirty days.) Tj ET")
+    content = "\n".join(ops).encode()
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % n + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def test_single_path_grid_tables_match_pdfplumber():
+    pdf = _grid_pdf()
+    plumber = extract_pages_from_pdf(pdf, backend="pdfplumber")
+    pdfium = extract_pages_from_pdf(pdf, backend="pdfium")
+    assert plumber[0]["tables"] == [ROWS]
+    assert [p["tables"] for p in pdfium] == [p["tables"] for p in plumber]
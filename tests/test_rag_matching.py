@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from app import helper, ingest_pipeline, rag_pipeline
+from app.helper import hybrid_match_rag, score_rag_transaction
+from app.ingest_pipeline import IngestPipeline
+
+ACCOUNT = "alice@example.com (gmail)"
+
+
+def _vectors(n, seed=0):
+    v = np.random.default_rng(seed).standard_normal((n, 384)).astype("float32")
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def _assert_no_match_row(exceptions, txn_id):
+    assert len(exceptions) == 1
+    row = exceptions[0]
+    assert row["TransactionID"] == txn_id
+    assert row["Reason"] == "No confident RAG match"
+    assert row["Source"] == row["EmailLink"] == "N/A"
+
+
+def test_no_candidates_is_an_exception_row():
+    digest, exceptions = score_rag_transaction({"transaction_id": "T1", "amount": 10.0}, [])
+    assert digest == []
+    _assert_no_match_row(exceptions, "T1")
+
+
+def test_every_batch_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_pipeline, "build_embeddings", lambda chunks: _vectors(len(chunks), len(chunks)))
+    monkeypatch.setattr(rag_pipeline, "embed_queries", lambda texts: _vectors(len(texts), 99))
+    monkeypatch.setattr(helper, "INDEX_ROOT", tmp_path)
+    monkeypatch.setattr(helper, "embed_queries", lambda texts: _vectors(len(texts), 99))
+    emails = [{"id": f"msg{i}", "account": ACCOUNT, "from": "billing@acme.com", "subject": f"Invoice INV-{i}",
+               "body": f"Acme invoice INV-{i}. Total due $12.{i:02d}", "date": "2024-03-05", "attachments": []}
+              for i in range(3)]
+    IngestPipeline(batch_size=10, storage_root=tmp_path, extract_workers=1).run(iter(emails))
+
+    # Neither the amount nor the vendor can be in any batch, so zone maps
+    # prune them all and the search has no candidates.
+    txn = {"transaction_id": "T2", "date": "2024-03-05", "amount": 98765.43, "vendor_name": "Globex"}
+    digest, exceptions = hybrid_match_rag([txn], accounts=[ACCOUNT])
+    assert digest == []
+    _assert_no_match_row(exceptions, "T2")
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("pdfplumber")
+
+from app import ingest_pipeline, rag_pipeline
+from app.ingest_pipeline import IngestPipeline
+from app.rag_pipeline import csv_row_to_enhanced_query, global_search
+from app.segments import delete_account, delete_emails, email_key, load_catalog, segment_dirs
+from tests.test_pdf_extraction import _grid_pdf
+
+ALICE = "alice@example.com (gmail)"
+BOB = "bob@example.com (gmail)"
+
+
+def _vectors(n, seed=0):
+    v = np.random.default_rng(seed).standard_normal((n, 384)).astype("float32")
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def _email(account, i, attachments=()):
+    return {"id": f"msg{i}", "account": account, "from": "billing@acme.com", "subject": f"Invoice INV-{100 + i}",
+            "body": f"Acme invoice INV-{100 + i}. Total due $1,234.56", "date": "2024-03-05",
+            "attachments": list(attachments)}
+
+
+@pytest.fixture
+def ingest(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_pipeline, "build_embeddings", lambda chunks: _vectors(len(chunks), len(chunks)))
+    monkeypatch.setattr(rag_pipeline, "embed_queries", lambda texts: _vectors(len(texts), 99))
+
+    def run(emails):
+        IngestPipeline(batch_size=10, storage_root=tmp_path, extract_workers=1).run(iter(emails))
+        return tmp_path
+    return run
+
+
+def _found_emails(root, account):
+    query = csv_row_to_enhanced_query({"amount": "1234.56", "vendor_name": "Acme", "date": "2024-03-05"})
+    results = global_search(query, segment_dirs(root, accounts=[account]), top_k=50, rerank=False, accounts=[account])
+    return {r["chunk"]["metadata"]["email_id"] for r in results}
+
+
+def test_deleted_emails_leave_search(ingest):
+    root = ingest([_email(ALICE, i) for i in range(3)])
+    assert _found_emails(root, ALICE) == {"msg0", "msg1", "msg2"}
+
+    result = delete_emails(root, [email_key(_email(ALICE, 1))])
+    assert result["emails"] == 1 and result["chunks"] > 0
+    assert _found_emails(root, ALICE) == {"msg0", "msg2"}
+    assert email_key(_email(ALICE, 1)) not in load_catalog(root)["indexed"]["emails"]
+
+
+def test_delete_account_keeps_other_accounts(ingest):
+    root = ingest([_email(account, i) for account in (ALICE, BOB) for i in range(2)])
+    result = delete_account(root, ALICE)
+    assert result["emails"] == 2
+    assert _found_emails(root, ALICE) == set()
+    assert _found_emails(root, BOB) == {"msg0", "msg1"}
+
+
+def test_deleting_attachment_owner_requeues_copies(ingest):
+    attachment = {"filename": "invoice.pdf", "hash": "abc123", "bytes": _grid_pdf()}
+    owner, copy = _email(ALICE, 0, [attachment]), _email(ALICE, 1, [attachment])
+    root = ingest([owner, copy])
+    catalog = load_catalog(root)
+    assert len(catalog["indexed"]["attachments"]) == 1
+
+    result = delete_emails(root, [email_key(owner)])
+    assert result["requeued"] == 1
+    catalog = load_catalog(root)
+    assert catalog["indexed"]["attachments"] == {}
+    assert email_key(copy) not in catalog["indexed"]["emails"]
+
+    # The next fetch re-ingests the copy, now with the attachment's content.
+    root = ingest([copy])
+    catalog = load_catalog(root)
+    assert len(catalog["indexed"]["attachments"]) == 1
+    assert email_key(copy) in catalog["indexed"]["emails"]
@@ -0,0 +1,48 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("rank_bm25")
+
+from rank_bm25 import BM25Okapi
+
+from app.segment_store import MmapBM25, load_chunks, write_bm25, write_chunks
+
+# A few terms in nearly every document push their idf below zero, so the
+# epsilon floor is exercised too.
+COMMON = ["invoice", "the", "total"]
+RARE = [f"term{i}" for i in range(300)] + ["café", "naïve", "$1,234.56", "inv-2024-001"]
+
+
+def _corpus(n=400, seed=0):
+    rng = random.Random(seed)
+    docs = []
+    for _ in range(n):
+        doc = [rng.choice(RARE) for _ in range(rng.randint(0, 40))]
+        doc += [t for t in COMMON if rng.random() < 0.9]
+        rng.shuffle(doc)
+        docs.append(doc)
+    return docs
+
+
+def test_mmap_bm25_matches_rank_bm25(tmp_path):
+    corpus = _corpus()
+    meta = write_bm25(corpus, tmp_path)
+    mapped = MmapBM25(tmp_path, meta)
+    reference = BM25Okapi(corpus)
+
+    rng = random.Random(1)
+    queries = [COMMON, ["unseen", "words"], []] + [rng.sample(RARE + COMMON, 4) for _ in range(50)]
+    for query in queries:
+        assert np.array_equal(mapped.get_scores(query), reference.get_scores(query)), query
+
+
+def test_chunks_round_trip(tmp_path):
+    chunks = [{"chunk_id": i, "content": f"chunk {i} café", "metadata": {"email_id": f"m{i}"}} for i in range(25)]
+    write_chunks(chunks, tmp_path)
+    lazy = load_chunks(tmp_path)
+    assert len(lazy) == len(chunks)
+    assert lazy[7] == chunks[7]
+    assert list(lazy) == chunks
+    assert load_chunks(tmp_path, lazy=False) == chunks